@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+--------------------------------------------------
+ Benchmarks for the Scan, Diff, BAK and Copy Phases
+--------------------------------------------------
+
+A synthetic SRC/DST/BAK setup is generated from the given parameters and the
+phases of fsync.sync_directory() are timed one after the other, followed by a
+whole sync_directory() run on a copy of the same setup. Results are
+appended as one JSON object per line to the output file, so runs of different
+commits can be compared, e.g.:
+
+  python bench_fsync.py --files 100000 --depth 4 --changed 0.01 --bak-depth 5
+
+
+
+MIT License
+
+Copyright (c) 2022 https://github.com/sintharic
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+"""
+
+
+
+import os, json, random, tempfile, subprocess, platform
+import argparse
+from time import perf_counter
+from datetime import datetime, timedelta
+from functools import partial
+import futil
+import fsync
+
+
+
+# ----- Synthetic Trees ----- #
+
+def make_tree(root, num_files=1000, depth=3, fanout=4, size_median=4096,
+              size_sigma=1.5, seed=0):
+  """ Generate a synthetic directory tree
+
+  Files are spread evenly over a tree of directories with <fanout>
+  subdirectories per level, and their sizes follow a log-normal distribution.
+
+  Parameters
+  ----------
+  root : str
+    directory in which the tree is created
+  num_files : int
+    total number of files
+  depth : int
+    number of directory levels below <root>
+  fanout : int
+    number of subdirectories per directory
+  size_median : int
+    median file size in bytes
+  size_sigma : float
+    width of the log-normal size distribution, 0 for equally sized files
+  seed : int
+    seed of the random number generator
+
+  Returns
+  -------
+  files : list of str
+    relative paths to all generated files
+
+  """
+
+  rng = random.Random(seed)
+  folders = [""]
+  for level in range(depth):
+    folders += [folder+"d"+str(i)+os.sep for folder in folders
+                if folder.count(os.sep) == level for i in range(fanout)]
+  futil.mkdirtree([root+os.sep+folder for folder in folders])
+
+  files = []
+  for i in range(num_files):
+    file = folders[i % len(folders)]+"f"+str(i)+".dat"
+    size = int(size_median*rng.lognormvariate(0, size_sigma)) if size_sigma else size_median
+    with open(root+os.sep+file, "wb") as fid: fid.write(rng.randbytes(size))
+    files.append(file)
+  return(files)
+
+
+def mutate_tree(root, files, changed=0.01, deleted=0.0, seed=0):
+  """ Change and delete random fractions of the files in a synthetic tree
+
+  Changed files are rewritten and their modification times moved an hour
+  into the future, so sync_directory() detects them.
+
+  Returns
+  -------
+  changed_files : list of str
+  deleted_files : list of str
+
+  """
+
+  rng = random.Random(seed+1)
+  sample = rng.sample(files, int(len(files)*(changed+deleted)))
+  changed_files = sample[:int(len(files)*changed)]
+  deleted_files = sample[len(changed_files):]
+  future = (datetime.now()+timedelta(hours=1)).timestamp()
+  for file in changed_files:
+    with open(root+os.sep+file, "ab") as fid: fid.write(b"changed")
+    os.utime(root+os.sep+file, (future, future))
+  for file in deleted_files: os.remove(root+os.sep+file)
+  return(changed_files, deleted_files)
+
+
+def fill_bak(bak_path, files, bak_depth=0):
+  """ Create <bak_depth> previous BAK versions for each of <files> """
+
+  index = fsync.bak_index(bak_path)
+  for file in files:
+    os.makedirs(bak_path+os.sep+os.path.split(file)[0], exist_ok=True)
+    for i in range(bak_depth):
+      timesig = (datetime(2000,1,1)+timedelta(days=i)).strftime("%Y-%m-%d_%H%M%S")
+      with open(index.add(file, timesig), "wb") as fid: fid.write(b"old")
+
+
+
+# ----- Benchmark ----- #
+
+def timed(results, phase, func, *args, **kwargs):
+  # run func and store its wall time in results[phase]
+
+  start = perf_counter()
+  out = func(*args, **kwargs)
+  results[phase] = perf_counter()-start
+  return(out)
+
+
+def run(workdir, files=1000, depth=3, fanout=4, size_median=4096, size_sigma=1.5,
+        changed=0.01, deleted=0.0, bak_depth=0, num_bak=5, workers=1, seed=0):
+  """ Generate a setup in <workdir> and time the phases of sync_directory()
+
+  Returns
+  -------
+  results : dict
+    parameters, counts and the wall time in seconds of each phase
+
+  """
+
+  params = dict(files=files, depth=depth, fanout=fanout, size_median=size_median,
+                size_sigma=size_sigma, changed=changed, deleted=deleted,
+                bak_depth=bak_depth, num_bak=num_bak, workers=workers, seed=seed)
+  src_path = workdir+os.sep+"SRC"
+  dst_path = workdir+os.sep+"DST"
+  bak_path = workdir+os.sep+"BAK"
+
+  timings = {}
+  all_files = timed(timings, "generate", make_tree, src_path, files, depth,
+                    fanout, size_median, size_sigma, seed)
+  futil.copytree(src_path, dst_path)
+  changed_files, deleted_files = mutate_tree(src_path, all_files, changed, deleted, seed)
+  os.makedirs(bak_path, exist_ok=True)
+  fill_bak(bak_path, changed_files, bak_depth)
+  futil.copytree(dst_path, dst_path+"_e2e")
+  futil.copytree(bak_path, bak_path+"_e2e")
+
+  # scan phase
+  timed(timings, "relDirsFiles", futil.relDirsFiles, src_path)
+  src_folders, src_entries = timed(timings, "scan_src", fsync._listing, src_path)
+  _, dst_entries = timed(timings, "scan_dst", fsync._listing, dst_path)
+
+  # diff phase
+  new, changed_list, unchanged, deleted_list = timed(timings, "diff", futil.diffTables,
+                                                     src_entries, dst_entries)
+  new = [src_entries.path(row) for row in new]
+  changed_list = [src_entries.path(row) for row in changed_list]
+
+  # BAK rotation phase
+  bak = fsync.bak_index(bak_path)
+  tasks = [partial(fsync._backup_changed, file, dst_path, bak, num_bak)
+           for file in changed_list]
+  timed(timings, "bak_rotation", lambda: list(futil.runTasks(tasks, workers, futil.LogBuffer())))
+
+  # copy phase
+  tasks = [partial(fsync._mirror_new, file, src_path, dst_path)
+           for file in changed_list+new]
+  timed(timings, "copy", lambda: list(futil.runTasks(tasks, workers, futil.LogBuffer())))
+
+  # the same run end to end on a copy of DST and BAK
+  timed(timings, "sync_directory", fsync.sync_directory, src_path, dst_path+"_e2e", 
+        bak_path+"_e2e", num_bak, logger=futil.LogBuffer(), workers=workers)
+
+  copied = set(changed_list+new)
+  counts = dict(files=len(src_entries), folders=len(src_folders), new=len(new),
+                changed=len(changed_list), unchanged=len(unchanged),
+                deleted=len(deleted_list),
+                bytes_copied=sum(e.size for e in src_entries if e.path in copied))
+  return(dict(params=params, counts=counts, timings=timings))
+
+
+def commit():
+  # current git commit of the repository, if available
+
+  try:
+    out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                         text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    return(out.stdout.strip() or None)
+  except OSError: return(None)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split("MIT License")[0],
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--files", type=int, default=1000, help="number of files")
+  parser.add_argument("--depth", type=int, default=3, help="directory levels")
+  parser.add_argument("--fanout", type=int, default=4, help="subdirectories per level")
+  parser.add_argument("--size-median", type=int, default=4096, help="median file size in bytes")
+  parser.add_argument("--size-sigma", type=float, default=1.5, help="log-normal width of file sizes")
+  parser.add_argument("--changed", type=float, default=0.01, help="fraction of changed files")
+  parser.add_argument("--deleted", type=float, default=0.0, help="fraction of deleted files")
+  parser.add_argument("--bak-depth", type=int, default=0, help="BAK versions per changed file")
+  parser.add_argument("--num-bak", type=int, default=5, help="num_bak of the sync")
+  parser.add_argument("--workers", type=int, default=1, help="parallel BAK moves and copies")
+  parser.add_argument("--seed", type=int, default=0, help="random seed")
+  parser.add_argument("--repeat", type=int, default=1, help="number of runs")
+  parser.add_argument("--dir", default=None, help="working directory (default: temporary)")
+  parser.add_argument("--output", default="bench_output.txt", help="JSON lines result file")
+  args = parser.parse_args(argv)
+
+  for i in range(args.repeat):
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+      results = run(workdir, args.files, args.depth, args.fanout, args.size_median,
+                    args.size_sigma, args.changed, args.deleted, args.bak_depth,
+                    args.num_bak, args.workers, args.seed)
+    results.update(commit=commit(), python=platform.python_version(),
+                   platform=platform.platform(), date=datetime.now().isoformat())
+    with open(args.output, "a") as fid: fid.write(json.dumps(results)+"\n")
+    print(" ".join(key+"="+"%.4f" % value for key, value in results["timings"].items()))
+
+
+if __name__ == "__main__":
+  main()
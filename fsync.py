@@ -7,7 +7,8 @@
 --------------------------------------------------
 
 CAUTION: sync_deleted not recommended if multiple devices or backup jobs use DST
-TODO: use existing halt condition to allow safely cancelling a sync job
+NOTE: job.cancel() stops a sync safely, an interrupted sync with a journal is 
+      resumed by the next run of the same job
 
 
 
@@ -41,10 +42,14 @@ DEBUG = False
 
 
 
-import os, sys
+import os, sys, shutil
 import futil
 from datetime import datetime
 import logging, traceback
+import sqlite3, re, threading, time, asyncio, tarfile, random
+from functools import partial
+from collections import deque
+from contextlib import contextmanager
 
 TIMESIG = datetime.now().strftime("%Y-%m-%d_%H%M%S")
 USR = os.getlogin()
@@ -55,38 +60,625 @@ BAK = "test"+os.sep+"BAK"
 
 
 
-# ----- Main Function ----- #
+# ----- DST Manifest ----- #
 
-def sync_directory(src_path, dst_path, bak_path=None, num_bak=5, 
-                   include_subdirs=True, sync_deleted=False, logger=logging):
-  """ synchronize the contents of a destination directory with a source directory
-  
-  Files and folders in <src_path> are mirrored in <dst_path>. If specified, 
-  older pre-existing versions in <dst_path> that would be overwritten are first 
-  backed up into <bak_path>, where the maximum number of stored older versions
-  is given by <num_bak>.
+class dst_manifest:
+  """ Persistent record of the files fsync has written to a DST directory
+
+  The records are stored in an SQLite database, which can hold several DST 
+  directories (e.g. all projects of job.sync_individual). A DST directory is 
+  marked as dirty while it is being synchronized, so the records of a run that
+  did not finish are never trusted and DST is scanned again instead. Changes 
+  are written in a single transaction by finish(), so that several DST 
+  directories can share the database file at the same time.
 
   Parameters
   ----------
-  src_path : str
-    source path, whose content is mirrored in <dst_path>
+  filename : str
+    SQLite database file
   dst_path : str
-    destination path, which is synchronized with <src_path>
-  bak_path : str
-    backup path, in which previous versions of files are stored.
-  num_bak : int
-    number of backups to kept for each file
+    DST directory whose contents are recorded
   include_subdirs : bool
-    whether to include the whole directory tree of <src_path> or just the files
-    in the root directory.
-  sync_deleted : bool
-    if True, files deleted in <src_path> will also be removed from <dst_path>
-    (or moved to <bak_path> if that is given)
-  logger : logging.Logger
-    Logger, to which potential errors and warnings are redirected
+    whether the whole directory tree or just the root directory is recorded
+
+  """
+
+  def __init__(self, filename, dst_path, include_subdirs=True):
+    self.root = os.path.abspath(dst_path)
+    self.subdirs = int(include_subdirs)
+    self.db = sqlite3.connect(filename, timeout=60)
+    self.rebuilt = None
+    self.updates = {}
+    self.db.execute("CREATE TABLE IF NOT EXISTS roots (root TEXT, subdirs INTEGER, "
+                    "clean INTEGER, PRIMARY KEY (root, subdirs))")
+    self.db.execute("CREATE TABLE IF NOT EXISTS files (root TEXT, subdirs INTEGER, "
+                    "path TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+                    "PRIMARY KEY (root, subdirs, path))")
+    self.db.commit()
+
+  def listing(self):
+    # recorded file entries, or None if DST is unknown or dirty
+
+    if not self.is_clean(): return(None)
+    rows = self.db.execute("SELECT path, size, mtime_ns, inode FROM files "
+                           "WHERE root=? AND subdirs=? ORDER BY rowid", 
+                           (self.root, self.subdirs))
+    return(futil.FileTable(futil.Entry(*row, False) for row in rows))
+
+  def is_clean(self):
+    row = self.db.execute("SELECT clean FROM roots WHERE root=? AND subdirs=?",
+                          (self.root, self.subdirs)).fetchone()
+    return((row is not None) and bool(row[0]))
+
+  def begin(self):
+    # mark DST as dirty until finish() is called
+
+    self.db.execute("INSERT OR REPLACE INTO roots VALUES (?,?,0)", 
+                    (self.root, self.subdirs))
+    self.db.commit()
+
+  def rebuild(self, entries):
+    # replace all records by the file entries of a full scan
+
+    self.rebuilt = entries
+    self.updates = {}
+
+  def record(self, path, fullname):
+    # record the current state of the file <fullname> under relative <path>
+
+    stat = os.stat(fullname)
+    self.updates[path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+  def remove(self, path):
+    self.updates[path] = None
+
+  def finish(self):
+    # write all records of this run and mark DST as clean
+
+    key = (self.root, self.subdirs)
+    with self.db:
+      if self.rebuilt is not None:
+        self.db.execute("DELETE FROM files WHERE root=? AND subdirs=?", key)
+        self.db.executemany("INSERT INTO files VALUES (?,?,?,?,?,?)", 
+          (key+(e.path, e.size, e.mtime_ns, e.inode) for e in self.rebuilt))
+      for path, record in self.updates.items():
+        if record is None:
+          self.db.execute("DELETE FROM files WHERE root=? AND subdirs=? AND path=?", 
+                          key+(path,))
+        else: 
+          self.db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?)", 
+                          key+(path,)+record)
+      self.db.execute("INSERT OR REPLACE INTO roots VALUES (?,?,1)", key)
+    self.rebuilt = None
+    self.updates = {}
+
+  def close(self):
+    self.db.close()
+
+
+
+# ----- BAK Versions ----- #
+
+BAK_VERSION = re.compile(r"^(.*)__fsync_(\d{4}-\d{2}-\d{2}_\d{6})__(.*)$")
+
+
+class bak_index:
+  """ Index of the previous versions of files stored in a BAK directory
+
+  Each BAK folder is listed only once, when one of its files is first looked
+  up, and every original file name is mapped to its versions sorted from 
+  oldest to newest. Versions are matched by their exact original name, so 
+  e.g. the versions of "ab.txt" are never mistaken for versions of "a.txt".
+  The index can be shared by several threads.
+
+  With <pack_threshold>, the versions of files smaller than that are not stored
+  as loose files, but appended to a single tar archive per run, 
+  BAK/__fsync_pack_<TIMESIG>.tar (optionally compressed), so a run adds one 
+  file instead of one per changed file. An archive is removed once all of its
+  versions have been pruned, until then it keeps its size. With <store>, all
+  versions are added to an object_store instead, where identical contents are
+  only stored once. Packed and stored versions are recorded in the SQLite 
+  index BAK/__fsync_bak.db, from which restore() retrieves single versions.
+
+  Parameters
+  ----------
+  bak_path : str
+    backup path, in which previous versions of files are stored
+  pack_threshold : int or None
+    size in bytes below which versions are packed into the run's archive
+  compression : str or None
+    compression of new archives, "gz", "bz2" or "xz"
+  store : str or None
+    directory of the object_store for new versions, takes precedence over
+    <pack_threshold>
+
+  """
+
+  def __init__(self, bak_path, pack_threshold=None, compression=None, store=None):
+    self.bak_path = bak_path
+    self.pack_threshold = pack_threshold
+    self.compression = compression
+    self.folders = {}
+    self.lock = threading.RLock()
+    self.db = None
+    self.archive = None
+    self.archive_name = None
+    self.stores = {}
+    self.store = None
+    if (pack_threshold is not None) or (store is not None) or os.path.isfile(self._index_file()): 
+      self.db = sqlite3.connect(self._index_file(), timeout=60, check_same_thread=False)
+      self.db.execute("CREATE TABLE IF NOT EXISTS versions (folder TEXT, name TEXT, "
+                      "timesig TEXT, archive TEXT, digest TEXT, "
+                      "PRIMARY KEY (folder, name, timesig))")
+      self.db.commit()
+    if store is not None: self.store = self._store(os.path.abspath(store))
+
+  def _index_file(self):
+    return(self.bak_path+os.sep+"__fsync_bak.db")
+
+  def _store(self, path):
+    # object_store at <path>, opened once
+
+    with self.lock:
+      if path not in self.stores: self.stores[path] = object_store(path)
+      return(self.stores[path])
+
+  def _folder(self, folder):
+    # map of original file names to (timesig, version name, archive, digest) in 
+    # <folder>. archive and digest are None for loose versions, for versions
+    # in an object_store archive is the store's directory
+
+    with self.lock:
+      if folder in self.folders: return(self.folders[folder])
+      index = {}
+      if os.path.isdir(self._fullname(folder)):
+        with os.scandir(self._fullname(folder)) as it:
+          for obj in it:
+            match = BAK_VERSION.match(obj.name)
+            if match is None: continue
+            stub, timesig, ext = match.groups()
+            index.setdefault(stub+ext, []).append((timesig, obj.name, None, None))
+      if self.db is not None:
+        for name, timesig, archive, digest in self.db.execute(
+            "SELECT name, timesig, archive, digest FROM versions WHERE folder=?", (folder,)):
+          index.setdefault(name, []).append((timesig, name, archive, digest))
+      for versions in index.values(): versions.sort(key=lambda v: v[:2])
+      self.folders[folder] = index
+      return(index)
+
+  def _fullname(self, folder, name=""):
+    if folder == "": return(self.bak_path+os.sep+name)
+    return(self.bak_path+os.sep+folder+os.sep+name)
+
+  def _version(self, folder, version):
+    # full path of a (timesig, name, archive, digest) version of a file in <folder>
+
+    _, name, archive, digest = version
+    if digest is not None: return(object_name(archive, digest))
+    if archive is None: return(self._fullname(folder, name))
+    return(self.bak_path+os.sep+archive+os.sep+os.path.join(folder, name))
+
+  def _register(self, folder, name, version, record=True):
+    # replace the version of the same run by <version> and record it in the db
+    # unless the object_store already did
+
+    timesig, _, archive, digest = version
+    if record:
+      self.db.execute("INSERT OR REPLACE INTO versions VALUES (?,?,?,?,?)", 
+                      (folder, name, timesig, archive, digest))
+    versions = self._folder(folder).setdefault(name, [])
+    versions[:] = [v for v in versions if (v[0] != timesig) or (v[2] is None)]
+    versions.append(version)
+    versions.sort(key=lambda v: v[:2])
+
+  def versions(self, file):
+    """ Full paths to all BAK versions of the relative path <file>, oldest first
+
+    Packed versions are given as the path of the archive followed by <file>,
+    versions in an object store as the path of their object.
+
+    """
+
+    folder, name = os.path.split(file)
+    with self.lock:
+      versions = self._folder(folder).get(name, [])
+      return([self._version(folder, version) for version in versions])
+
+  def has_version(self, file, timesig):
+    # whether a version of <file> from the run <timesig> exists
+
+    folder, name = os.path.split(file)
+    with self.lock:
+      return(any(version[0] == timesig for version in self._folder(folder).get(name, [])))
+
+  def prune(self, file, num_keep):
+    """ Remove all but the <num_keep> newest BAK versions of <file> """
+
+    folder, name = os.path.split(file)
+    with self.lock:
+      versions = self._folder(folder).get(name, [])
+      num_remove = max(len(versions)-max(num_keep, 0), 0)
+      removed = versions[:num_remove]
+      del versions[:num_remove]
+      for timesig, _, archive, digest in removed:
+        if archive is None: continue
+        if digest is not None: 
+          # the store deletes the row in the transaction releasing the object
+          self.db.commit()
+          self._store(archive).release(digest, self._index_file(), (folder, name, timesig))
+          continue
+        self.db.execute("DELETE FROM versions WHERE folder=? AND name=? AND timesig=?", 
+                        (folder, name, timesig))
+        if archive == self.archive_name: continue
+        left = self.db.execute("SELECT COUNT(*) FROM versions WHERE archive=?", 
+                               (archive,)).fetchone()[0]
+        if left == 0: os.remove(self.bak_path+os.sep+archive)
+      # the store's transactions must not wait for this connection
+      if self.store is not None: self.db.commit()
+    for version in removed: 
+      if version[2] is None: os.remove(self._version(folder, version))
+
+  def add(self, file, timesig):
+    """ Register a new BAK version of <file> and return its full path """
+
+    folder, name = os.path.split(file)
+    stub, ext = os.path.splitext(name)
+    version = stub+"__fsync_"+timesig+"__"+ext
+    with self.lock:
+      versions = self._folder(folder).setdefault(name, [])
+      if (timesig, version, None, None) not in versions: 
+        versions.append((timesig, version, None, None))
+      versions.sort(key=lambda v: v[:2])
+    return(self._fullname(folder, version))
+
+  def pack(self, file, fullname, timesig):
+    """ Append <fullname> as a version of <file> to the run's archive
+
+    Returns False without packing if the file is too large or packing is off.
+
+    """
+
+    if (self.pack_threshold is None) or (os.path.getsize(fullname) >= self.pack_threshold):
+      return(False)
+    folder, name = os.path.split(file)
+    with self.lock:
+      if self.archive is None: self._open_archive(timesig)
+      self.archive.add(fullname, arcname=file.replace(os.sep, "/"), recursive=False)
+      self._register(folder, name, (timesig, name, self.archive_name, None))
+    return(True)
+
+  def dedup(self, file, fullname, timesig, move=False):
+    """ Add <fullname> as a version of <file> to the object store
+
+    If <move>, <fullname> is moved into the store if its content is new there.
+    Returns False if there is no store.
+
+    """
+
+    if self.store is None: return(False)
+    folder, name = os.path.split(file)
+    with self.lock: self.db.commit()
+    digest = self.store.put(fullname, move, self._index_file(), (folder, name, timesig))
+    with self.lock: 
+      self._register(folder, name, (timesig, name, self.store.path, digest), record=False)
+    return(True)
+
+  def _open_archive(self, timesig):
+    # start a new archive for the versions of this run
+
+    ext = ".tar" if self.compression is None else ".tar."+self.compression
+    self.archive_name = "__fsync_pack_"+timesig+ext
+    i = 1
+    while os.path.exists(self.bak_path+os.sep+self.archive_name):
+      i += 1
+      self.archive_name = "__fsync_pack_"+timesig+"_"+str(i)+ext
+    mode = "w" if self.compression is None else "w:"+self.compression
+    self.archive = tarfile.open(self.bak_path+os.sep+self.archive_name, mode)
+
+  def restore(self, file, timesig, destname):
+    """ Copy the version of <file> from the run <timesig> to <destname> """
+
+    folder, name = os.path.split(file)
+    with self.lock:
+      versions = [v for v in self._folder(folder).get(name, []) if v[0] == timesig]
+    if len(versions) == 0: raise FileNotFoundError("No BAK version of "+file+" from "+timesig)
+    _, _, archive, digest = versions[-1]
+    if (archive is None) or (digest is not None): 
+      futil.copyfile(self._version(folder, versions[-1]), destname)
+      return(destname)
+    if archive == self.archive_name: self.close()
+    with tarfile.open(self.bak_path+os.sep+archive, "r:*") as tar:
+      member = tar.getmember(file.replace(os.sep, "/"))
+      with tar.extractfile(member) as src, open(destname, "wb") as dst: 
+        shutil.copyfileobj(src, dst, futil.COPY_BUFSIZE)
+    os.utime(destname, ns=(int(member.mtime*1e9), int(member.mtime*1e9)))
+    return(destname)
+
+  def close(self):
+    # finish the run's archive and write the index of packed versions
+
+    with self.lock:
+      if self.archive is not None: 
+        self.archive.close()
+        self.archive = None
+        self.archive_name = None
+      if self.db is not None: self.db.commit()
+      for store in self.stores.values(): store.close()
+      self.stores = {}
+
+
+
+def object_name(path, digest):
+  # file of the object <digest> in the object_store at <path>
+  return(path+os.sep+digest[:2]+os.sep+digest)
+
+
+class object_store:
+  """ Content-addressed store of BAK versions
+
+  Each content is stored once as <path>/<hh>/<hash>, named by its BLAKE2b hash
+  (see futil.hashfile), no matter how many BAK versions of how many files 
+  share it. The number of versions referencing each object is counted in the
+  SQLite database <path>/__fsync_objects.db, and an object is deleted as soon 
+  as the last of them is pruned. The counts are updated in write transactions,
+  so several BAK directories and processes can share a store. The versions
+  table of a bak_index is attached to the same transaction, so a count never
+  differs from the versions recorded, even if a run is killed.
+
+  Parameters
+  ----------
+  path : str
+    directory of the store, created if necessary
+
+  """
+
+  def __init__(self, path):
+    self.path = path
+    os.makedirs(path, exist_ok=True)
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(path+os.sep+"__fsync_objects.db", timeout=60, 
+                              isolation_level=None, check_same_thread=False)
+    self.db.execute("CREATE TABLE IF NOT EXISTS objects (hash TEXT PRIMARY KEY, "
+                    "size INTEGER, refs INTEGER)")
+
+  @contextmanager
+  def _transaction(self, index=None):
+    # write transaction of the store, which also covers the versions table of 
+    # the bak_index file <index> (attached as "bak") if given
+
+    with self.lock:
+      if index is not None: self.db.execute("ATTACH DATABASE ? AS bak", (index,))
+      try:
+        self.db.execute("BEGIN IMMEDIATE")
+        try: 
+          yield
+          self.db.execute("COMMIT")
+        except BaseException:
+          self.db.execute("ROLLBACK")
+          raise
+      finally:
+        if index is not None: self.db.execute("DETACH DATABASE bak")
+
+  def put(self, fullname, move=False, index=None, version=None):
+    # add a reference to the content of <fullname>, storing it if it is new, 
+    # and return its hash. The (folder, name, timesig) <version> referencing 
+    # it is recorded in the bak_index file <index> in the same transaction
+
+    digest = futil.hashfile(fullname)
+    size = os.path.getsize(fullname)
+    obj = object_name(self.path, digest)
+    tmpname = None
+    if not os.path.isfile(obj):
+      os.makedirs(os.path.dirname(obj), exist_ok=True)
+      tmpname = obj+"."+str(os.getpid())+"_"+str(threading.get_ident())+futil.TMP_SUFFIX
+      if move: shutil.move(fullname, tmpname)
+      else: futil.copyfile(fullname, tmpname)
+    try:
+      with self._transaction(index):
+        self.db.execute("INSERT INTO objects VALUES (?,?,1) "
+                        "ON CONFLICT(hash) DO UPDATE SET refs=refs+1", (digest, size))
+        # the object may have been released since it was checked
+        if not os.path.isfile(obj):
+          if tmpname is None: futil.copyfile(fullname, obj)
+          else: os.replace(tmpname, obj)
+        if index is not None: self._record(version, digest)
+    finally:
+      if (tmpname is not None) and os.path.isfile(tmpname): os.remove(tmpname)
+    return(digest)
+
+  def _record(self, version, digest):
+    # point the (folder, name, timesig) <version> of the attached bak_index to 
+    # <digest>, releasing the object of the version it replaces
+
+    old = self.db.execute("SELECT archive, digest FROM bak.versions WHERE folder=? AND "
+                          "name=? AND timesig=?", version).fetchone()
+    self.db.execute("INSERT OR REPLACE INTO bak.versions VALUES (?,?,?,?,?)", 
+                    tuple(version)+(self.path, digest))
+    if (old is not None) and (old[0] == self.path) and (old[1] is not None): 
+      self._release(old[1])
+
+  def _release(self, digest):
+    # remove a reference within a transaction, deleting the object with the last one
+
+    self.db.execute("UPDATE objects SET refs=refs-1 WHERE hash=?", (digest,))
+    row = self.db.execute("SELECT refs FROM objects WHERE hash=?", (digest,)).fetchone()
+    if (row is None) or (row[0] <= 0):
+      self.db.execute("DELETE FROM objects WHERE hash=?", (digest,))
+      if os.path.isfile(object_name(self.path, digest)): 
+        os.remove(object_name(self.path, digest))
+
+  def release(self, digest, index=None, version=None):
+    # remove a reference to the object <digest>, deleting it with the last one,
+    # and the (folder, name, timesig) <version> from the bak_index file <index>
+
+    with self._transaction(index):
+      if index is not None:
+        self.db.execute("DELETE FROM bak.versions WHERE folder=? AND name=? AND timesig=?", 
+                        version)
+      self._release(digest)
+
+  def refs(self):
+    # number of references of each stored object
+
+    return(dict(self.db.execute("SELECT hash, refs FROM objects")))
+
+  def close(self):
+    self.db.close()
+
+
+
+# ----- Transfer Journal ----- #
+
+class transfer_journal:
+  """ Write-ahead journal of the file operations of a synchronization
+
+  Every operation (moving a deleted file to BAK, backing up and copying a 
+  changed file, copying a new file or updating metadata) is written to an 
+  SQLite database before it runs and checked off as soon as it has completed.
+  If a run is interrupted or cancelled, the next run finishes the remaining 
+  operations from the journal instead of comparing SRC and DST again. Like
+  dst_manifest, the database can hold the journals of several DST directories.
+
+  Parameters
+  ----------
+  filename : str
+    SQLite database file
+  dst_path : str
+    DST directory whose operations are journaled
+
+  """
+
+  def __init__(self, filename, dst_path):
+    self.root = os.path.abspath(dst_path)
+    self.seq = 0
+    self.db = sqlite3.connect(filename, timeout=60)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.execute("CREATE TABLE IF NOT EXISTS runs (root TEXT PRIMARY KEY, "
+                    "src TEXT, timesig TEXT, complete INTEGER)")
+    self.db.execute("CREATE TABLE IF NOT EXISTS ops (root TEXT, seq INTEGER, "
+                    "status TEXT, file TEXT, done INTEGER, PRIMARY KEY (root, seq))")
+    self.db.commit()
+
+  def pending(self):
+    # (src, timesig, complete, ops) of an interrupted run, or None. ops are the
+    # (status, file, seq) of all operations that have not completed
+
+    row = self.db.execute("SELECT src, timesig, complete FROM runs WHERE root=?", 
+                          (self.root,)).fetchone()
+    if row is None: return(None)
+    ops = self.db.execute("SELECT status, file, seq FROM ops WHERE root=? AND done=0 "
+                          "ORDER BY seq", (self.root,)).fetchall()
+    return(row+(ops,))
+
+  def begin(self, src_path, timesig):
+    # start the journal of a new run, discarding any previous one
+
+    with self.db:
+      self.db.execute("DELETE FROM ops WHERE root=?", (self.root,))
+      self.db.execute("INSERT OR REPLACE INTO runs VALUES (?,?,?,0)", 
+                      (self.root, os.path.abspath(src_path), timesig))
+    self.seq = 0
+
+  def plan(self, ops):
+    # journal the (status, file) operations <ops> and yield them with their seq.
+    # A list is written at once, other iterables one operation at a time
+
+    if isinstance(ops, list):
+      planned = [(status, file, self.seq+i) for i, (status, file) in enumerate(ops)]
+      self.seq += len(ops)
+      with self.db:
+        self.db.executemany("INSERT INTO ops VALUES (?,?,?,?,0)", 
+                            [(self.root, seq, status, file) for status, file, seq in planned])
+        self.db.execute("UPDATE runs SET complete=1 WHERE root=?", (self.root,))
+      yield from planned
+      return
+
+    for status, file in ops:
+      with self.db: 
+        self.db.execute("INSERT INTO ops VALUES (?,?,?,?,0)", 
+                        (self.root, self.seq, status, file))
+      self.seq += 1
+      yield(status, file, self.seq-1)
+    with self.db: self.db.execute("UPDATE runs SET complete=1 WHERE root=?", (self.root,))
+
+  def done(self, seq):
+    with self.db: 
+      self.db.execute("UPDATE ops SET done=1 WHERE root=? AND seq=?", (self.root, seq))
+
+  def finish(self):
+    # remove the journal of a run that has completed
+
+    with self.db:
+      self.db.execute("DELETE FROM ops WHERE root=?", (self.root,))
+      self.db.execute("DELETE FROM runs WHERE root=?", (self.root,))
+
+  def close(self):
+    self.db.close()
+
+
+
+# ----- Run Reports ----- #
+
+PHASES = ["scan_src", "scan_dst", "diff", "mkdirtree", "rename", "bak_rotation", 
+          "copy", "transfer"]
+
+
+def new_report(src_path, dst_path):
+  """ Create an empty report of a synchronization
+
+  All times are in seconds. "scan_src", "scan_dst", "diff", "mkdirtree", 
+  "rename" and "transfer" are wall times. In the transfer phase, the backup and copy of each
+  file run one after the other, so "bak_rotation" and "copy" are summed over 
+  all files and may exceed the wall time of the transfer with several workers.
 
   """
 
+  return(dict(src=src_path, dst=dst_path, ok=True, error=None, phase=None, 
+              phases={phase: 0. for phase in PHASES}, 
+              counts={status: 0 for status in ["new", "changed", "touched", 
+                                               "unchanged", "deleted", "renamed"]},
+              files_done=0, files_total=0, bytes_copied=0, wall_time=0., 
+              throughput=0.))
+
+
+@contextmanager
+def _phase(report, phase, progress=None):
+  # time a phase of the synchronization and report progress afterwards
+
+  report["phase"] = phase
+  start = time.perf_counter()
+  try: yield
+  finally:
+    report["phases"][phase] += time.perf_counter()-start
+    if progress is not None: progress(report)
+
+
+def _finish_report(report, start):
+  report["phase"] = "done"
+  report["wall_time"] = time.perf_counter()-start
+  if report["phases"]["transfer"] > 0:
+    report["throughput"] = report["bytes_copied"]/report["phases"]["transfer"]
+  return(report)
+
+
+
+# ----- Main Function ----- #
+
+def _listing(path, include_subdirs=True, prune=None, filter=None):
+  # folders and FileTable of the files from a single scan of <path>, without 
+  # the contents of the folders in <prune> and the entries excluded by <filter>
+
+  folders = []; files = futil.FileTable()
+  for entry in futil.scanTree(path, include_subdirs, prune, filter):
+    if not entry.is_dir: files.append(entry)
+    elif include_subdirs: folders.append(entry.path)
+  return(folders, files)
+
+
+def _check_paths(src_path, dst_path, bak_path, compare="mtime"):
+  # sanity checks of sync_directory(), returns the BAK path to be used
+
   # sanity check for src_path:
   if not os.path.isdir(src_path): 
     raise ValueError("Invalid SRC directory "+src_path)
@@ -109,100 +701,1305 @@ def sync_directory(src_path, dst_path, bak_path=None, num_bak=5,
         #logger.info(" [WARNING] Invalid bak_path encountered. Using None.")#DEBUG
         bak_path = None
 
-  # copy whole folder if directory is completely new
+  if compare not in ["mtime", "hash"]:
+    raise ValueError("Invalid compare mode "+str(compare))
+  return(bak_path)
+
+
+AUTO_WORKERS = 32 # maximum number of concurrent files with workers="auto"
+
+
+def _filter(filters):
+  # futil.Filter of the <filters> given to sync_directory() or None
+
+  if (filters is None) or isinstance(filters, futil.Filter): return(filters)
+  return(futil.Filter(filters))
+
+
+def _scheduler(workers, max_bytes_per_sec=None, max_ops_per_sec=None):
+  # <workers> for futil.runTasks(), a futil.Scheduler for "auto" or any limits
+
+  if isinstance(workers, futil.Scheduler): return(workers)
+  if workers == "auto": 
+    return(futil.Scheduler(AUTO_WORKERS, 1, max_bytes_per_sec, max_ops_per_sec))
+  if (max_bytes_per_sec is None) and (max_ops_per_sec is None): return(workers)
+  return(futil.Scheduler(workers, None, max_bytes_per_sec, max_ops_per_sec))
+
+
+def sync_directory(src_path, dst_path, bak_path=None, num_bak=5, 
+                   include_subdirs=True, sync_deleted=False, logger=logging,
+                   manifest=None, verify=False, workers=1, delta_threshold=None,
+                   compare="mtime", hash_cache=None, progress=None, 
+                   streaming=False, journal=None, halt=None, bak_pack=None, 
+                   bak_compression=None, bak_store=None, max_bytes_per_sec=None,
+                   max_ops_per_sec=None, renames=False, checksums=False, 
+                   verify_sample=0., tree_cache=None, filters=None):
+  """ synchronize the contents of a destination directory with a source directory
+  
+  Files and folders in <src_path> are mirrored in <dst_path>. If specified, 
+  older pre-existing versions in <dst_path> that would be overwritten are first 
+  backed up into <bak_path>, where the maximum number of stored older versions
+  is given by <num_bak>.
+
+  Parameters
+  ----------
+  src_path : str
+    source path, whose content is mirrored in <dst_path>
+  dst_path : str or list of str
+    destination path, which is synchronized with <src_path>. With a list of
+    several destinations, sync_fanout() is used and a list of reports is 
+    returned.
+  bak_path : str or list of str
+    backup path, in which previous versions of files are stored, or a list
+    with one (or None) for each of several destinations
+  num_bak : int
+    number of backups to kept for each file
+  include_subdirs : bool
+    whether to include the whole directory tree of <src_path> or just the files
+    in the root directory.
+  sync_deleted : bool
+    if True, files deleted in <src_path> will also be removed from <dst_path>
+    (or moved to <bak_path> if that is given)
+  logger : logging.Logger
+    Logger, to which potential errors and warnings are redirected
+  manifest : str or None
+    SQLite file in which the contents of <dst_path> are recorded (see 
+    dst_manifest). If given, <dst_path> is only scanned if its records are
+    missing or the previous run did not finish.
+  verify : bool
+    if True, <dst_path> is always scanned and its manifest rebuilt, e.g. when
+    other programs might have modified it
+  workers : int, "auto" or futil.Scheduler
+    number of files that are backed up and copied concurrently. Log messages 
+    are still written in a fixed order per file. With "auto", the number is 
+    tuned between 1 and AUTO_WORKERS by the throughput (see futil.Scheduler),
+    and a Scheduler can be given to share its limits with other runs. Then,
+    small files are transferred first.
+  delta_threshold : int or None
+    size in bytes from which changed files are updated in place by writing 
+    only their changed blocks (see futil.deltafile). If <bak_path> is given, 
+    this requires a file system with reflinks to keep the previous version.
+  compare : str
+    how files existing in both <src_path> and <dst_path> are compared. With 
+    "mtime", files are changed if they are newer in <src_path>. With "hash",
+    files are changed if their content differs, and files that only differ in
+    their modification time get a metadata update instead of a new BAK version.
+  hash_cache : str or None
+    SQLite file in which content hashes are cached (see futil.HashCache), so 
+    only files whose size, modification time or inode changed are read again.
+    Only used if <compare> is "hash".
+  progress : callable or None
+    function called with the report (see below) after every phase and every 
+    transferred file, e.g. to display live progress. Its "phase", "files_done"
+    and "files_total" entries show the current state.
+  streaming : bool
+    if True, <src_path> and <dst_path> are walked in sorted order and merged,
+    so files are backed up and copied while the trees are still being walked
+    and memory only grows with the depth of the trees, not the number of 
+    files. In this mode, all time is reported as "transfer" and <manifest> 
+    cannot be used.
+  journal : str or None
+    SQLite file in which the planned file operations are journaled (see 
+    transfer_journal). If a previous run was interrupted, its remaining 
+    operations are finished first, without comparing the directories again.
+  halt : threading.Event or None
+    event that cancels the synchronization once it is set. Files that are 
+    being transferred are completed, no further ones are started, and the 
+    report has "ok" set to False. With a <journal>, the next run resumes.
+  bak_pack : int or None
+    size in bytes below which BAK versions are packed into one tar archive per
+    run instead of being stored as loose files (see bak_index)
+  bak_compression : str or None
+    compression of the BAK archives, "gz", "bz2" or "xz"
+  bak_store : str or None
+    directory of a content-addressed object store (see object_store), in 
+    which each BAK version is stored only once per unique content. It can be 
+    shared by several BAK directories, e.g. all projects of a job.
+  max_bytes_per_sec : float or None
+    limit of the bytes copied per second, e.g. to leave I/O for other programs
+  max_ops_per_sec : float or None
+    limit of the files backed up or copied per second
+  renames : bool
+    if True, new files in <src_path> that match a file missing from it by size,
+    modification time and hash (cached if <compare> is "hash") are renamed 
+    within <dst_path> instead of being copied again. If 
+    the missing file would be moved to <bak_path>, it is renamed, otherwise it
+    is hard-linked. Not used in streaming mode.
+  checksums : bool
+    if True, the hash of each copied file is computed from the copied data 
+    (see futil.hashcopy) and recorded for DST in <hash_cache>, even if 
+    <compare> is "mtime". audit_directory() can then check DST without 
+    reading SRC. Files patched with <delta_threshold> get no checksum.
+  verify_sample : float
+    fraction of the copies with <checksums> that are read back and compared
+    before they replace the file in DST
+  tree_cache : str or None
+    SQLite file in which the directories of <src_path> are summarized after
+    each successful run (see futil.TreeSummary). Subtrees in which no file
+    has been added, removed, renamed or modified since are then skipped in 
+    <dst_path>, which is only scanned where <src_path> has changed. Changes
+    made to <dst_path> behind fsync's back are only found by a run with 
+    <verify>. Changed <filters> invalidate the summaries, and no subtree is
+    skipped with age rules. Cannot be used with <manifest> or in streaming mode.
+  filters : list of str, futil.Filter or None
+    gitignore-style rules (see futil.Filter) relative to <src_path> and 
+    <dst_path>, e.g. ["node_modules/", ".git/", "*.tmp", "size>4G"]. Excluded
+    entries are neither copied nor deleted, and excluded directories are 
+    never walked.
+
+  Returns
+  -------
+  report : dict
+    summary of the synchronization (see new_report()) with the wall time of 
+    each phase in "phases", the number of new, changed, touched, unchanged and
+    deleted files in "counts", as well as "bytes_copied", "wall_time" and 
+    "throughput" (bytes per second of the transfer phase). Renamed files are
+    counted in "renamed" instead of "new".
+
+  """
+
+  workers = _scheduler(workers, max_bytes_per_sec, max_ops_per_sec)
+  filters = _filter(filters)
+  if isinstance(dst_path, (list, tuple)):
+    if (manifest is not None) or (journal is not None) or streaming or \
+       (delta_threshold is not None) or renames or checksums or (tree_cache is not None):
+      raise ValueError("Several DST directories cannot be used with manifest, journal, "
+                       "streaming, delta_threshold, renames, checksums or tree_cache")
+    return(sync_fanout(src_path, dst_path, bak_path, num_bak, include_subdirs, 
+                       sync_deleted, logger, workers, compare, hash_cache, progress, 
+                       halt, bak_pack, bak_compression, bak_store, filters))
+  bak_path = _check_paths(src_path, dst_path, bak_path, compare)
+  if streaming and (manifest is not None):
+    raise ValueError("A manifest cannot be used in streaming mode")
+  if (tree_cache is not None) and (streaming or (manifest is not None)):
+    raise ValueError("A tree_cache cannot be used with a manifest or in streaming mode")
+  start = time.perf_counter()
+  report = new_report(src_path, dst_path)
+
+  if manifest is not None: 
+    manifest = dst_manifest(manifest, dst_path, include_subdirs)
+  cache = None
+  if (compare == "hash") or checksums: cache = futil.HashCache(hash_cache)
+  hash_cache = cache if compare == "hash" else None
+  checksums = (cache, verify_sample) if checksums else None
+  if tree_cache is not None: tree_cache = futil.TreeSummary(tree_cache)
+  if (journal is not None) and not DEBUG: 
+    journal = transfer_journal(journal, dst_path)
+  else: journal = None
+  try:
+    _sync_directory(src_path, dst_path, bak_path, num_bak, include_subdirs, 
+                    sync_deleted, logger, report, progress=progress, workers=workers, 
+                    delta_threshold=delta_threshold, manifest=manifest, 
+                    verify=verify, hash_cache=hash_cache, streaming=streaming,
+                    journal=journal, halt=halt, renames=renames, checksums=checksums,
+                    tree=tree_cache, filters=filters, 
+                    bak_options=(bak_pack, bak_compression, bak_store))
+  finally:
+    if manifest is not None: manifest.close()
+    if tree_cache is not None: tree_cache.close()
+    if cache is not None: cache.close()
+    if journal is not None: journal.close()
+  return(_finish_report(report, start))
+
+
+def _sync_directory(src_path, dst_path, bak_path, num_bak, include_subdirs, 
+                    sync_deleted, logger, report, progress=None, workers=1, 
+                    delta_threshold=None, manifest=None, verify=False, hash_cache=None,
+                    streaming=False, journal=None, halt=None, renames=False,
+                    checksums=None, tree=None, filters=None, bak_options=(None, None, None)):
+  # sync_directory() after the sanity checks, comparing hashes if <hash_cache>
+  # and skipping the subtrees that are unchanged according to the TreeSummary <tree>
+  # and the entries excluded by the futil.Filter <filters>.
+  # <bak_options> are the bak_pack, bak_compression and bak_store of BAK, and
+  # <checksums> the HashCache and verify_sample of copies with checksums
+
+  # copy whole folder if directory is completely new, file by file for checksums
+  # or filters
+  if ((checksums is not None) or (filters is not None)) and not os.path.isdir(dst_path) \
+     and not DEBUG:
+    os.makedirs(dst_path)
   if not os.path.isdir(dst_path):
     logger.info(" mirroring SRC's whole directory to DST\n")
-    if not DEBUG: futil.copytree(src_path, dst_path, logger=logger)
+    with _phase(report, "copy", progress):
+      if not DEBUG: 
+        if manifest is not None: manifest.begin()
+        futil.copytree(src_path, dst_path, logger=logger)
     return
 
-  # get contents and modification times of existing directories
-  if include_subdirs:
-    src_folders, src_files = futil.relDirsFiles(src_path)
-    _, dst_files = futil.relDirsFiles(dst_path)
-  else:
-    src_folders = []
-    src_files = [obj for obj in os.listdir(src_path) if os.path.isfile(src_path+os.sep+obj)]
-    dst_files = [obj for obj in os.listdir(dst_path) if os.path.isfile(dst_path+os.sep+obj)]
-  src_time = [os.path.getmtime(src_path+os.sep+obj) for obj in src_files]
-  dst_time = [os.path.getmtime(dst_path+os.sep+obj) for obj in dst_files]
-
-  # find files that have been changed or deleted
-  changed_files = []
-  deleted_files = []
-  for i_dst, file in enumerate(dst_files):
-    i_src = futil.find(file, src_files)
-    if i_src>=0: 
-      if src_time[i_src] > dst_time[i_dst]+1:
-        changed_files.append(file)
-      elif sync_deleted: 
-        deleted_files.append(file)
+  # finish an interrupted run first
+  if (journal is not None) and _resume(src_path, dst_path, bak_path, num_bak, logger, 
+                                       report, progress, workers, delta_threshold, 
+                                       hash_cache, journal, halt, bak_options,
+                                       checksums):
+    logger.info("")
+    return
 
-  if bak_path is not None:
-    # move deleted files to BAK
-    if len(deleted_files) > 0:
-      for file in deleted_files: 
-        logger.info(" (deleted) '"+file+"' moving from DST to BAK")
-        if not DEBUG: 
-          bak_stub = bak_path + os.sep + os.path.split(file)
-          os.makedirs(bak_stub, exist_ok=True)
-          futil.movefile(dst_path+os.sep+file, bak_path+os.sep+file, logger=logger)
-
-    # copy changed files to BAK
-    if len(changed_files) > 0:
-      for file in changed_files: 
-        logger.info(" (changed) '"+file+"' moving from DST to BAK")
-        file_stub, file_ext = os.path.splitext(os.path.split(file)[-1])
-        bak_folder = bak_path + os.sep + os.path.split(file)[0]
-        
-        if (num_bak is not None) and os.path.isdir(bak_folder):
-          # make list of previous backup versions
-          prev_bak_versions = []
-          for obj in os.listdir(bak_folder):
-            full_obj = bak_folder+os.sep+obj
-            check_stub, check_ext = os.path.splitext(obj)
-            check_stub = obj[:len(file_stub)]
-            if check_ext==file_ext and check_stub==file_stub:
-              prev_bak_versions.append(full_obj)
-          #print(len(prev_bak_versions))#DEBUG
-
-          # remove oldest backup if there are more than num_bak
-          if len(prev_bak_versions) > num_bak-1:
-            #print("HERE")#DEBUG
-            prev_bak_versions = sorted(prev_bak_versions)
-            if not DEBUG:
-              logger.info("           removing oldest BAK version(s)")
-              for obj in prev_bak_versions[:-(num_bak-1)]: os.remove(obj)
-
-        # move DST's previous version to bak
-        if not DEBUG: 
-          bak_stub = bak_path + os.sep + os.path.split(file)[0]
-          os.makedirs(bak_stub, exist_ok=True)
-          file_stub, file_ext = os.path.splitext(bak_path+os.sep+file)
-          dest_file = file_stub+"__fsync_"+TIMESIG+"__"+file_ext
-          futil.movefile(dst_path+os.sep+file, dest_file, logger=logger)
+  if streaming:
+    if journal is not None: journal.begin(src_path, TIMESIG)
+    ops = _stream_ops(src_path, dst_path, bak_path, include_subdirs, sync_deleted, 
+                      report, hash_cache, filters, logger, progress)
+    _run_transfer(_journaled(ops, journal), src_path, dst_path, bak_path, num_bak, 
+                  logger, report, progress, workers, delta_threshold, 
+                  hash_cache=hash_cache, journal=journal, halt=halt, bak_options=bak_options,
+                  checksums=checksums)
+    if (journal is not None) and report["ok"]: journal.finish()
+    logger.info("")
+    return
+
+  # get contents and modification times of existing directories
+  with _phase(report, "scan_src", progress):
+    pruned = set()
+    if (tree is not None) and include_subdirs:
+      pruned = tree.unchanged(src_path, "" if filters is None else filters.key(), filters)
+      # files pass age rules without any change of the tree
+      if verify or ((filters is not None) and any(
+          kind == "age" for _, _, kind, _, _ in filters.predicates)): 
+        pruned = set()
+      if pruned: logger.info(" skipping "+str(len(pruned))+" unchanged subtree(s) of SRC")
+    src_folders, src_entries = _listing(src_path, include_subdirs, pruned, filters)
+  with _phase(report, "scan_dst", progress):
+    dst_entries = None
+    if (manifest is not None) and not verify: 
+      dst_entries = manifest.listing()
+      # records of files that are excluded now stay in DST, like the files
+      if (dst_entries is not None) and (filters is not None):
+        dst_entries = futil.FileTable(entry for entry in dst_entries 
+                                      if not filters.excluded(entry.path, False, entry))
+    if dst_entries is None:
+      _, dst_entries = _listing(dst_path, include_subdirs, pruned, filters)
+      if (manifest is not None) and not DEBUG: manifest.rebuild(dst_entries)
+    if (manifest is not None) and not DEBUG: manifest.begin()
+
+  # find files that are new, have been changed or deleted
+  with _phase(report, "diff", progress):
+    new_rows, changed_rows, unchanged_rows, deleted_rows = futil.diffTables(
+      src_entries, dst_entries)
+    new_files = [src_entries.path(row) for row in new_rows]
+    changed_files = [src_entries.path(row) for row in changed_rows]
+    deleted_files = [dst_entries.path(row) for row in deleted_rows] if sync_deleted else []
+    touched_files = []
+    if hash_cache is not None:
+      changed_files, touched_files = _compare_hashes(
+        (src_entries.path(row) for row in changed_rows+unchanged_rows), 
+        src_path, src_entries, dst_path, dst_entries, hash_cache)
+    report["counts"]["unchanged"] = len(src_entries)-len(new_files)-len(changed_files)-len(touched_files)
+    if isinstance(workers, futil.Scheduler):
+      new_files = _small_first(new_files, src_entries)
+      changed_files = _small_first(changed_files, src_entries)
+    renamed = []
+    if renames:
+      renamed = _match_renames(src_entries, new_rows, dst_entries, deleted_rows, 
+                               src_path, dst_path, hash_cache)
+
+  # DST files in the way of SRC's new folders are moved to BAK before the tree
+  blocking = _backup_blocking(src_folders, deleted_files, src_path, dst_path, bak_path, 
+                              logger, report, progress, manifest)
+  if blocking:
+    deleted_files = [file for file in deleted_files if file not in blocking]
+    renamed = [(old, new) for old, new in renamed if old not in blocking]
 
   # copy the SRC's directory tree to DST
-  dst_tree = [dst_path+os.sep+obj for obj in src_folders]
-  if (len(dst_tree) > 0) and not DEBUG: 
-    futil.mkdirtree(dst_tree)
+  with _phase(report, "mkdirtree", progress):
+    dst_tree = [dst_path+os.sep+obj for obj in src_folders]
+    if (len(dst_tree) > 0) and not DEBUG: 
+      futil.mkdirtree(dst_tree)
+
+  # files moved within SRC are renamed (or linked) within DST instead of copied
+  if renamed:
+    move = (bak_path is not None) and sync_deleted
+    with _phase(report, "rename", progress):
+      _rename_files(renamed, dst_path, move, logger, report, progress, manifest, halt)
+    old_files, moved_files = map(set, zip(*renamed))
+    new_files = [file for file in new_files if file not in moved_files]
+    if move: deleted_files = [file for file in deleted_files if file not in old_files]
+
+  if journal is not None: journal.begin(src_path, TIMESIG)
+  _transfer(src_path, dst_path, bak_path, num_bak, deleted_files, changed_files, 
+            new_files, touched_files, logger, report, progress, workers, 
+            delta_threshold, manifest, hash_cache, journal, halt, bak_options, 
+            checksums)
+  
+  # a cancelled run leaves the manifest dirty and the journal for the next run
+  if report["ok"]:
+    if (manifest is not None) and not DEBUG: manifest.finish()
+    if journal is not None: journal.finish()
+    if (tree is not None) and include_subdirs and not DEBUG: tree.commit()
+  logger.info("")
+
 
-  # copy changed files
-  for file in changed_files:
+def _transfer(src_path, dst_path, bak_path, num_bak, deleted_files, changed_files, 
+              new_files, touched_files, logger, report, progress=None, workers=1, 
+              delta_threshold=None, manifest=None, hash_cache=None, journal=None,
+              halt=None, bak_options=(None, None, None), checksums=None):
+  # back up and copy the given files, updating <manifest> and <report>
+
+  # each file is moved to BAK before it is overwritten, files run in parallel
+  ops = []
+  if bak_path is not None: ops += [("deleted", file) for file in deleted_files]
+  ops += [("changed", file) for file in changed_files]
+  ops += [("new", file) for file in new_files]
+  ops += [("touched", file) for file in touched_files]
+  report["files_total"] += len(ops)
+
+  _run_transfer(_journaled(ops, journal), src_path, dst_path, bak_path, num_bak, 
+                logger, report, progress, workers, delta_threshold, manifest, 
+                hash_cache, journal, halt, bak_options=bak_options, checksums=checksums)
+
+
+def _backup_blocking(folders, deleted_files, src_path, dst_path, bak_path, logger, 
+                     report, progress=None, manifest=None):
+  # move the <deleted_files> of DST that are in the way of the SRC <folders> to 
+  # BAK right away, before the folders are created. Returns the files moved
+
+  blocking = set(deleted_files).intersection(folders) if bak_path is not None else set()
+  for file in sorted(blocking):
+    report["files_total"] += 1
+    _record(_backup_deleted(file, dst_path, bak_path, logger), None, src_path, dst_path, 
+            report, progress, manifest)
+  return(blocking)
+
+
+def _small_first(files, entries):
+  # <files> sorted by their size in the FileTable <entries>, so a Scheduler runs
+  # many small files concurrently first and streams the large ones at the end
+
+  return(sorted(files, key=lambda file: entries.get(file).size))
+
+
+def _journaled(ops, journal):
+  # (status, file, seq) of the operations <ops>, written to <journal> if given
+
+  if journal is None: return((status, file, None) for status, file in ops)
+  return(journal.plan(ops))
+
+
+def _run_transfer(ops, src_path, dst_path, bak_path, num_bak, logger, report, 
+                  progress=None, workers=1, delta_threshold=None, manifest=None, 
+                  hash_cache=None, journal=None, halt=None, resume=None, 
+                  bak_options=(None, None, None), checksums=None):
+  # run the (status, file, seq) operations <ops> and record their results. If 
+  # <resume> is the TIMESIG of an interrupted run, completed steps are skipped
+
+  bak = None
+  if bak_path is not None: bak = bak_index(bak_path, *bak_options)
+  seqs = deque()
+  verify_sample = None if checksums is None else checksums[1]
+  tasks = _op_tasks(ops, seqs, src_path, dst_path, bak, num_bak, delta_threshold, resume,
+                    verify_sample)
+
+  try:
+    with _phase(report, "transfer", progress):
+      for result in futil.runTasks(tasks, workers, logger, halt):
+        _record(result, seqs.popleft(), src_path, dst_path, report, progress, manifest, 
+                hash_cache, journal, None if checksums is None else checksums[0])
+  finally:
+    if bak is not None: bak.close()
+
+  if (halt is not None) and halt.is_set():
+    logger.info(" [WARNING] synchronization cancelled after "+str(report["files_done"])
+                +" of "+str(report["files_total"])+" files")
+    report.update(ok=False, error="cancelled")
+
+
+def _record(result, seq, src_path, dst_path, report, progress=None, manifest=None, 
+            hash_cache=None, journal=None, checksums=None):
+  # add the (status, file, stats) result of an operation to the report and records,
+  # and the checksum of a copy to the HashCache <checksums>
+
+  status, file, stats = result
+  report["counts"][status] += 1
+  report["files_done"] += 1
+  report["bytes_copied"] += stats.get("bytes", 0)
+  for phase in ["bak_rotation", "copy"]: report["phases"][phase] += stats.get(phase, 0.)
+  if progress is not None: progress(report)
+
+  if DEBUG: return
+  if (hash_cache is not None) and (status == "changed") and ("digest" not in stats):
+    hash_cache.store(dst_path+os.sep+file, hash_cache.hash(src_path+os.sep+file))
+  if (checksums is not None) and ("digest" in stats):
+    checksums.store(dst_path+os.sep+file, stats["digest"])
+  if manifest is not None: 
+    if status == "deleted": manifest.remove(file)
+    else: manifest.record(file, dst_path+os.sep+file)
+  if journal is not None: journal.done(seq)
+
+
+def _op_tasks(ops, seqs, src_path, dst_path, bak, num_bak, delta_threshold, resume=None,
+              verify_sample=None):
+  # task of each operation for futil.runTasks(), appending its seq to <seqs>
+
+  for status, file, seq in ops:
+    seqs.append(seq)
+    if resume is None: 
+      yield(partial(_run_op, status, file, src_path, dst_path, bak, num_bak, 
+                    delta_threshold, verify_sample=verify_sample))
+    else: 
+      yield(partial(_resume_op, status, file, src_path, dst_path, bak, num_bak, 
+                    resume, verify_sample=verify_sample))
+
+
+def _stream_ops(src_path, dst_path, bak_path, include_subdirs, sync_deleted, report, 
+                hash_cache=None, filters=None, logger=logging, progress=None):
+  # merge-join sorted walks of SRC and DST and yield the (status, file) operation
+  # of each file as soon as it is known, creating new directories on the way
+
+  src = futil.walkSorted(src_path, include_subdirs, filters)
+  dst = futil.walkSorted(dst_path, include_subdirs, filters)
+  for status, src_entry, dst_entry in futil.mergeDiff(src, dst):
+    # DST entries in the way of a folder or file of SRC with the same name are
+    # moved to BAK right away, as the operations still queued may run too late
+    if (status == "deleted") and sync_deleted and (bak_path is not None):
+      path = dst_entry.path
+      if dst_entry.is_dir and os.path.isfile(src_path+os.sep+path):
+        files = [path+os.sep+entry.path for entry in futil.scanTree(dst_path+os.sep+path) 
+                 if not entry.is_dir]
+        _backup_blocking(files, files, src_path, dst_path, bak_path, logger, report, progress)
+        if not DEBUG: futil.removetree(dst_path+os.sep+path, logger=logger)
+        continue
+      if (not dst_entry.is_dir) and os.path.isdir(src_path+os.sep+path):
+        _backup_blocking([path], [path], src_path, dst_path, bak_path, logger, report, 
+                         progress)
+        continue
+    if (src_entry or dst_entry).is_dir:
+      if (status == "new") and include_subdirs and not DEBUG: 
+        os.makedirs(dst_path+os.sep+src_entry.path, exist_ok=True)
+      continue
+    if (hash_cache is not None) and (status != "new") and (status != "deleted"):
+      status = _compare_hash(src_path, src_entry, dst_path, dst_entry, hash_cache)
+
+    if status == "unchanged": 
+      report["counts"]["unchanged"] += 1
+      continue
+    if (status == "deleted") and ((bak_path is None) or not sync_deleted): continue
+    report["files_total"] += 1
+    yield(status, (src_entry or dst_entry).path)
+
+
+def _resume(src_path, dst_path, bak_path, num_bak, logger, report, progress, workers, 
+            delta_threshold, hash_cache, journal, halt, bak_options=(None, None, None),
+            checksums=None):
+  # finish the operations of an interrupted run recorded in <journal>. Returns 
+  # True if no full synchronization is needed afterwards
+
+  run = journal.pending()
+  if run is None: return(False)
+  src, timesig, complete, ops = run
+  if src != os.path.abspath(src_path):
+    logger.info(" [WARNING] discarding the journal of an interrupted run from "+src)
+    journal.finish()
+    return(False)
+
+  logger.info(" resuming "+str(len(ops))+" remaining operation(s) of the run from "+timesig)
+  report["files_total"] += len(ops)
+  _run_transfer(ops, src_path, dst_path, bak_path, num_bak, logger, report, progress, 
+                workers, delta_threshold, hash_cache=hash_cache, journal=journal, 
+                halt=halt, resume=timesig, bak_options=bak_options, checksums=checksums)
+  if not report["ok"]: return(True)
+  journal.finish()
+  # operations after the interruption of a streaming run were never planned
+  return(bool(complete))
+
+
+def sync_paths(src_path, dst_path, paths, bak_path=None, num_bak=5, 
+               sync_deleted=False, logger=logging, manifest=None, workers=1, 
+               delta_threshold=None, progress=None, bak_pack=None, bak_compression=None,
+               bak_store=None, filters=None):
+  """ synchronize only some paths of a destination directory with a source
+
+  Same as sync_directory(), including the handling of <bak_path>, but only the
+  given relative paths are compared, e.g. the changes reported by a watcher.
+  Directories among <paths> are compared including their whole contents.
+
+  Parameters
+  ----------
+  src_path : str
+    source path, whose content is mirrored in <dst_path>
+  dst_path : str
+    destination path, which is synchronized with <src_path>
+  paths : iterable of str
+    paths relative to <src_path> and <dst_path> that may have changed
+
+  The remaining parameters and the returned report are the same as for 
+  sync_directory().
+
+  """
+
+  start = time.perf_counter()
+  report = new_report(src_path, dst_path)
+  filters = _filter(filters)
+  src_entries = {}; dst_entries = {}; src_folders = set()
+  for path in sorted(set(paths)):
+    for root, entries in [(src_path, src_entries), (dst_path, dst_entries)]:
+      try: stat = os.stat(root+os.sep+path)
+      except FileNotFoundError: continue
+      is_dir = os.path.isdir(root+os.sep+path)
+      if (filters is not None) and filters.excluded(path, is_dir, stat): continue
+      if not is_dir: 
+        entries[path] = futil.Entry(path, stat.st_size, stat.st_mtime_ns, stat.st_ino, False)
+        continue
+      if root == src_path: src_folders.add(path)
+      for entry in futil.scanTree(root+os.sep+path):
+        entry = entry._replace(path=path+os.sep+entry.path)
+        if (filters is not None) and filters.excluded(entry.path, entry.is_dir, entry): 
+          continue
+        if entry.is_dir and (root == src_path): src_folders.add(entry.path)
+        elif not entry.is_dir: entries[entry.path] = entry
+
+  new_files, changed_files, unchanged_files, deleted_files = futil.diffFiles(
+    list(src_entries), [e.mtime_ns/1e9 for e in src_entries.values()],
+    list(dst_entries), [e.mtime_ns/1e9 for e in dst_entries.values()])
+  if not sync_deleted: deleted_files = []
+  report["counts"]["unchanged"] = len(unchanged_files)
+  # parent directories of new files may be new as well
+  src_folders |= {os.path.split(file)[0] for file in new_files} - {""}
+
+  if manifest is not None: 
+    manifest = dst_manifest(manifest, dst_path)
+    clean = manifest.is_clean()
+    if not DEBUG: manifest.begin()
+  try:
+    blocking = _backup_blocking(src_folders, deleted_files, src_path, dst_path, bak_path, 
+                                logger, report, progress, manifest)
+    deleted_files = [file for file in deleted_files if file not in blocking]
+    with _phase(report, "mkdirtree", progress):
+      if not DEBUG: futil.mkdirtree([dst_path+os.sep+obj for obj in sorted(src_folders)])
+    _transfer(src_path, dst_path, bak_path, num_bak, deleted_files, changed_files, 
+              new_files, [], logger, report, progress, workers, delta_threshold, 
+              manifest, bak_options=(bak_pack, bak_compression, bak_store))
+    # records of a DST that was not clean before stay untrusted
+    if (manifest is not None) and clean and not DEBUG: manifest.finish()
+  finally:
+    if manifest is not None: manifest.close()
+  return(_finish_report(report, start))
+
+
+def _match_renames(src_entries, new_rows, dst_entries, gone_rows, src_path, dst_path, 
+                   hash_cache=None):
+  # (old, new) paths of the files missing from SRC that are new in SRC under 
+  # another path. Matches have the same size and mtime_ns, and always the same
+  # hash, so files that merely share their metadata are copied. A file that 
+  # <hash_cache> recorded under its old SRC path with the same inode has been
+  # renamed in SRC and is not read at all, other files are read at most once
+
+  gone = {}
+  for row in gone_rows:
+    gone.setdefault((dst_entries.size[row], dst_entries.mtime_ns[row]), []).append(row)
+
+  renamed = []; digests = {}
+  for row in new_rows:
+    candidates = gone.get((src_entries.size[row], src_entries.mtime_ns[row]))
+    if not candidates: continue
+    src = src_entries[row]
+    match = None
+    if hash_cache is not None:
+      match = next((candidate for candidate in candidates if _same_inode(
+        hash_cache, src_path+os.sep+dst_entries.path(candidate), src)), None)
+    if match is None:
+      digest = _memo_hash(digests, src_path+os.sep+src.path, src, hash_cache)
+      match = next((candidate for candidate in candidates if digest == _memo_hash(
+        digests, dst_path+os.sep+dst_entries.path(candidate), dst_entries[candidate], 
+        hash_cache)), None)
+    if match is None: continue
+    candidates.remove(match)
+    renamed.append((dst_entries.path(match), src.path))
+  return(renamed)
+
+
+def _same_inode(hash_cache, fullname, entry):
+  # whether <hash_cache> recorded <fullname> with the size, mtime and inode of <entry>
+
+  record = hash_cache.recorded(fullname)
+  return((record is not None) and (record[:3] == (entry.size, entry.mtime_ns, entry.inode)))
+
+
+def _memo_hash(digests, fullname, entry, hash_cache=None):
+  # content hash of a file, which is read only the first time within <digests>
+
+  if fullname not in digests: digests[fullname] = _hash(fullname, entry, hash_cache)
+  return(digests[fullname])
+
+
+def _hash(fullname, entry, hash_cache=None):
+  # content hash of a file, from <hash_cache> if given
+
+  if hash_cache is None: return(futil.hashfile(fullname))
+  return(hash_cache.hash(fullname, entry))
+
+
+def _rename_files(renamed, dst_path, move, logger, report, progress=None, manifest=None, 
+                  halt=None):
+  # rename (or hard-link unless <move>) the (old, new) paths of DST
+
+  report["files_total"] += len(renamed)
+  for old, new in renamed:
+    if (halt is not None) and halt.is_set(): return
+    if move: logger.info(" (renamed) '"+new+"' moving from '"+old+"' within DST")
+    else: logger.info(" (renamed) '"+new+"' linking to '"+old+"' within DST")
+    if not DEBUG:
+      if move: os.replace(dst_path+os.sep+old, dst_path+os.sep+new)
+      else:
+        # file systems without hard links still avoid reading SRC
+        try: os.link(dst_path+os.sep+old, dst_path+os.sep+new)
+        except OSError: 
+          futil.copyfile(dst_path+os.sep+old, dst_path+os.sep+new, logger=logger)
+      if (manifest is not None) and move: manifest.remove(old)
+    _record(("renamed", new, {}), None, None, dst_path, report, progress, manifest)
+
+
+def _compare_hashes(files, src_path, src_entries, dst_path, dst_entries, hash_cache):
+  # split files existing in SRC and DST (FileTables) into changed and merely touched ones
+
+  changed_files = []; touched_files = []
+  for file in files:
+    status = _compare_hash(src_path, src_entries.get(file), dst_path, 
+                           dst_entries.get(file), hash_cache)
+    if status == "changed": changed_files.append(file)
+    elif status == "touched": touched_files.append(file)
+  return(changed_files, touched_files)
+
+
+def _compare_hash(src_path, src, dst_path, dst, hash_cache):
+  # "changed", "touched" or "unchanged" status of the entries of a file
+
+  if src.size != dst.size: return("changed")
+  if hash_cache.hash(src_path+os.sep+src.path, src) != hash_cache.hash(dst_path+os.sep+dst.path, dst):
+    return("changed")
+  if src.mtime_ns != dst.mtime_ns: return("touched")
+  return("unchanged")
+
+
+def _run_op(status, file, src_path, dst_path, bak, num_bak, delta_threshold, logger,
+            verify_sample=None):
+  # run the operation <status> of a file with the task functions below
+
+  if status == "deleted": return(_backup_deleted(file, dst_path, bak.bak_path, logger))
+  if status == "changed":
+    return(_mirror_changed(file, src_path, dst_path, bak, num_bak, delta_threshold, 
+                           logger, verify_sample))
+  if status == "touched": return(_touch(file, src_path, dst_path, logger))
+  return(_mirror_new(file, src_path, dst_path, logger, verify_sample))
+
+
+def _resume_op(status, file, src_path, dst_path, bak, num_bak, timesig, logger,
+               verify_sample=None):
+  # run an operation of the interrupted run <timesig>, skipping the steps that 
+  # had already completed
+
+  src_name = src_path+os.sep+file; dst_name = dst_path+os.sep+file
+  if not DEBUG and os.path.lexists(futil.tempname(dst_name)): 
+    os.remove(futil.tempname(dst_name))
+  if status == "deleted":
+    if not os.path.lexists(dst_name): return(status, file, {})
+    return(_run_op(status, file, src_path, dst_path, bak, num_bak, None, logger))
+
+  # copies are renamed into place with SRC's metadata once they are complete
+  if not os.path.isfile(src_name):
+    logger.info(" ("+status+") '"+file+"' no longer exists in SRC")
+    return(status, file, {})
+  src = os.stat(src_name)
+  if os.path.isfile(dst_name):
+    dst = os.stat(dst_name)
+    if (dst.st_size, dst.st_mtime_ns) == (src.st_size, src.st_mtime_ns): 
+      return(status, file, {})
+    if status == "touched": return(_touch(file, src_path, dst_path, logger))
+
+  # DST's previous version may already be in BAK, or DST partially patched
+  backed_up = (bak is not None) and bak.has_version(file, timesig)
+  if (status == "changed") and os.path.isfile(dst_name) and not backed_up: 
+    return(_run_op(status, file, src_path, dst_path, bak, num_bak, None, logger, 
+                   verify_sample))
+  _, _, stats = _mirror_new(file, src_path, dst_path, logger, verify_sample)
+  return(status, file, stats)
+
+
+def _touch(file, src_path, dst_path, logger):
+  # copy only the metadata of a file whose content is unchanged
+
+  start = time.perf_counter()
+  logger.info(" (touched) '"+file+"' updating metadata in DST")
+  if not DEBUG: shutil.copystat(src_path+os.sep+file, dst_path+os.sep+file)
+  return("touched", file, dict(copy=time.perf_counter()-start))
+
+
+def _backup_deleted(file, dst_path, bak_path, logger):
+  # move a file deleted in SRC from DST to BAK
+
+  start = time.perf_counter()
+  logger.info(" (deleted) '"+file+"' moving from DST to BAK")
+  if not DEBUG: 
+    bak_stub = bak_path + os.sep + os.path.split(file)[0]
+    os.makedirs(bak_stub, exist_ok=True)
+    futil.movefile(dst_path+os.sep+file, bak_path+os.sep+file, logger=logger)
+    # a killed copy of the file may have left its temporary file behind
+    if os.path.lexists(futil.tempname(dst_path+os.sep+file)): 
+      os.remove(futil.tempname(dst_path+os.sep+file))
+  return("deleted", file, dict(bak_rotation=time.perf_counter()-start))
+
+
+def _backup_changed(file, dst_path, bak, num_bak, logger, keep=False):
+  # move DST's version of a changed file to the bak_index <bak>, keeping at most
+  # num_bak versions. If <keep>, DST's version is cloned (or packed) instead if 
+  # possible and True is returned
+
+  logger.info(" (changed) '"+file+"' moving from DST to BAK")
+
+  # remove oldest backup if there are more than num_bak
+  if (num_bak is not None) and (len(bak.versions(file)) > num_bak-1):
+    if not DEBUG:
+      logger.info("           removing oldest BAK version(s)")
+      bak.prune(file, num_bak-1)
+
+  # versions go to the object store or small files into the run's archive
+  if not DEBUG and bak.dedup(file, dst_path+os.sep+file, TIMESIG, move=not keep): 
+    return(keep)
+  if not DEBUG and bak.pack(file, dst_path+os.sep+file, TIMESIG): return(keep)
+
+  # move DST's previous version to bak
+  if not DEBUG: 
+    bak_stub = bak.bak_path + os.sep + os.path.split(file)[0]
+    os.makedirs(bak_stub, exist_ok=True)
+    dest_file = bak.add(file, TIMESIG)
+    if keep and futil.clonefile(dst_path+os.sep+file, dest_file, logger=logger): 
+      return(True)
+    futil.movefile(dst_path+os.sep+file, dest_file, logger=logger)
+  return(False)
+
+
+def _mirror_changed(file, src_path, dst_path, bak, num_bak, delta_threshold, 
+                    logger, verify_sample=None):
+  # back up DST's version of a changed file and copy the new one from SRC
+
+  # large files are patched in place, unless they are hard-linked elsewhere
+  start = time.perf_counter()
+  delta = False
+  if (delta_threshold is not None) and not DEBUG:
+    stat = os.stat(dst_path+os.sep+file)
+    delta = (stat.st_size >= delta_threshold) and (stat.st_nlink == 1)
+
+  if bak is not None: 
+    delta = _backup_changed(file, dst_path, bak, num_bak, logger, keep=delta)
+  stats = dict(bak_rotation=time.perf_counter()-start, bytes=0)
+  start = time.perf_counter()
+  if delta:
+    logger.info(" (changed) '"+file+"' patching changed blocks from SRC into DST")
+    stats["bytes"] = futil.deltafile(src_path+os.sep+file, dst_path+os.sep+file, 
+                                     logger=logger)
+  else:
     logger.info(" (changed) '"+file+"' mirroring from SRC to DST")
-    if not DEBUG: 
-      futil.copyfile(src_path+os.sep+file, dst_path+os.sep+file, logger=logger)
+    if not DEBUG: stats.update(_copy(file, src_path, dst_path, logger, verify_sample))
+  stats["copy"] = time.perf_counter()-start
+  return("changed", file, stats)
 
-  # copy new files
-  for file in src_files:
-    if not os.path.isfile(dst_path+os.sep+file):
-      logger.info(" (new) '"+file+"' mirroring from SRC to DST")
-      if not DEBUG: 
-        futil.copyfile(src_path+os.sep+file, dst_path+os.sep+file, logger=logger)
-  
+
+def _mirror_new(file, src_path, dst_path, logger, verify_sample=None):
+  # copy a file that does not exist in DST yet
+
+  start = time.perf_counter()
+  stats = dict(bytes=0)
+  logger.info(" (new) '"+file+"' mirroring from SRC to DST")
+  if not DEBUG: stats.update(_copy(file, src_path, dst_path, logger, verify_sample))
+  stats["copy"] = time.perf_counter()-start
+  return("new", file, stats)
+
+
+def _copy(file, src_path, dst_path, logger, verify_sample=None):
+  # copy a file from SRC to DST, with its checksum unless <verify_sample> is None.
+  # Returns the "bytes" and "digest" stats of the copy
+
+  if verify_sample is None:
+    return(dict(bytes=futil.copyfile(src_path+os.sep+file, dst_path+os.sep+file, 
+                                     logger=logger)))
+  size, digest = futil.hashcopy(src_path+os.sep+file, dst_path+os.sep+file, 
+                                random.random() < verify_sample, logger=logger)
+  return(dict(bytes=size, digest=digest))
+
+
+
+# ----- Audit ----- #
+
+def audit_directory(dst_path, hash_cache, include_subdirs=True, logger=logging, 
+                    workers=1):
+  """ check the files of a destination directory against their checksums
+
+  Every file in <dst_path> whose checksum was recorded by sync_directory() 
+  (with <checksums> or compare="hash") is read and hashed again, so corrupted
+  files in DST are found without reading SRC. Files whose size, modification 
+  time or inode changed since then have no valid checksum and are skipped.
+
+  Parameters
+  ----------
+  dst_path : str
+    destination path of previous synchronizations
+  hash_cache : str
+    SQLite file of the recorded checksums (see futil.HashCache)
+  include_subdirs : bool
+    whether to include the whole directory tree of <dst_path>
+  logger : logging.Logger
+    Logger, to which corrupted files are reported
+  workers : int or futil.Scheduler
+    number of files that are checked concurrently
+
+  Returns
+  -------
+  audit : dict
+    number of "checked" files and of files without a checksum ("unknown"), 
+    and the list of "corrupt" files whose content does not match
+
+  """
+
+  cache = futil.HashCache(hash_cache)
+  try:
+    tasks = []; unknown = 0
+    for entry in futil.scanTree(dst_path, include_subdirs):
+      if entry.is_dir: continue
+      digest = cache.cached(dst_path+os.sep+entry.path, entry)
+      if digest is None: unknown += 1
+      else: tasks.append(partial(_audit_file, entry.path, dst_path, digest))
+    corrupt = [file for file in futil.runTasks(tasks, workers, logger) if file is not None]
+  finally: cache.close()
+  logger.info(" audit: "+str(len(tasks))+" file(s) checked, "+str(len(corrupt))
+              +" corrupt, "+str(unknown)+" without checksum\n")
+  return(dict(checked=len(tasks), unknown=unknown, corrupt=corrupt))
+
+
+def _audit_file(file, dst_path, digest, logger):
+  # path of a file in DST if its content does not match <digest>, else None
+
+  if futil.hashfile(dst_path+os.sep+file) == digest: return(None)
+  logger.info(" [ERROR] '"+file+"' does not match its checksum")
+  return(file)
+
+
+
+# ----- Multiple Destinations ----- #
+
+def sync_fanout(src_path, dst_paths, bak_paths=None, num_bak=5, include_subdirs=True, 
+                sync_deleted=False, logger=logging, workers=1, compare="mtime", 
+                hash_cache=None, progress=None, halt=None, bak_pack=None, 
+                bak_compression=None, bak_store=None, filters=None):
+  """ synchronize several destination directories with one source directory
+
+  <src_path> is scanned once and compared with each of <dst_paths>. Every file
+  that is new or changed in at least one destination is read once and written
+  to all destinations that need it (see futil.copyfiles), so reading SRC does
+  not grow with the number of destinations. Each destination keeps its own BAK
+  directory and versions like with sync_directory().
+
+  Parameters
+  ----------
+  src_path : str
+    source path, whose content is mirrored in each of <dst_paths>
+  dst_paths : list of str
+    destination paths, which are synchronized with <src_path>
+  bak_paths : list of str or None
+    backup path of each destination, or None for no backups at all
+
+  The remaining parameters are the same as for sync_directory(). Delta 
+  transfers, manifests, journals and streaming are not available here.
+  Errors of single files are logged and reported for their destination only,
+  whose report then has "ok" False and the first error, while the other
+  destinations are still synchronized.
+
+  Returns
+  -------
+  reports : list of dict
+    report of each destination as returned by sync_directory()
+
+  """
+
+  if bak_paths is None: bak_paths = [None for dst_path in dst_paths]
+  if len(bak_paths) != len(dst_paths): 
+    raise ValueError("Each DST directory needs a BAK directory or None")
+  bak_paths = [_check_paths(src_path, dst_path, bak_path, compare) 
+               for dst_path, bak_path in zip(dst_paths, bak_paths)]
+  start = time.perf_counter()
+  reports = [new_report(src_path, dst_path) for dst_path in dst_paths]
+
+  if compare == "hash": hash_cache = futil.HashCache(hash_cache)
+  else: hash_cache = None
+  baks = [None if bak_path is None else bak_index(bak_path, bak_pack, bak_compression, bak_store)
+          for bak_path in bak_paths]
+  try:
+    _sync_fanout(src_path, dst_paths, baks, num_bak, include_subdirs, sync_deleted, 
+                 logger, reports, progress, workers, hash_cache, halt, _filter(filters))
+  finally:
+    for bak in baks: 
+      if bak is not None: bak.close()
+    if hash_cache is not None: hash_cache.close()
+  return([_finish_report(report, start) for report in reports])
+
+
+def _sync_fanout(src_path, dst_paths, baks, num_bak, include_subdirs, sync_deleted, 
+                 logger, reports, progress=None, workers=1, hash_cache=None, halt=None,
+                 filters=None):
+  # sync_fanout() after the sanity checks
+
+  with _phases(reports, "scan_src", progress):
+    src_folders, src_entries = _listing(src_path, include_subdirs, filter=filters)
+
+  # deletions and metadata updates run per destination, copies once per file
+  copies = {}; deleted = []; touched = []
+  for i, dst_path in enumerate(dst_paths):
+    report = reports[i]
+    with _phase(report, "scan_dst", progress):
+      if not DEBUG: os.makedirs(dst_path, exist_ok=True)
+      dst_entries = futil.FileTable()
+      if os.path.isdir(dst_path): 
+        _, dst_entries = _listing(dst_path, include_subdirs, filter=filters)
+    with _phase(report, "diff", progress):
+      new_rows, changed_rows, unchanged_rows, deleted_rows = futil.diffTables(
+        src_entries, dst_entries)
+      changed_files = [src_entries.path(row) for row in changed_rows]
+      touched_files = []
+      if hash_cache is not None:
+        changed_files, touched_files = _compare_hashes(
+          (src_entries.path(row) for row in changed_rows+unchanged_rows), 
+          src_path, src_entries, dst_path, dst_entries, hash_cache)
+      report["counts"]["unchanged"] = len(src_entries)-len(new_rows)-len(changed_files)-len(touched_files)
+      deleted_files = []
+      if sync_deleted and (baks[i] is not None):
+        deleted_files = [dst_entries.path(row) for row in deleted_rows]
+
+    # DST files in the way of SRC's new folders are moved to BAK before the tree,
+    # a destination whose tree cannot be created is reported and left out
+    try:
+      blocking = _backup_blocking(src_folders, deleted_files, src_path, dst_path, 
+                                  None if baks[i] is None else baks[i].bak_path, 
+                                  logger, report, progress)
+      with _phase(report, "mkdirtree", progress):
+        if src_folders and not DEBUG: 
+          futil.mkdirtree([dst_path+os.sep+obj for obj in src_folders])
+    except OSError as err:
+      report.update(ok=False, error=_fanout_error(".", dst_path, err, logger))
+      continue
+    deleted_files = [file for file in deleted_files if file not in blocking]
+    deleted += [(i, "deleted", file) for file in deleted_files]
+    for file in changed_files: copies.setdefault(file, []).append((i, "changed"))
+    for row in new_rows: copies.setdefault(src_entries.path(row), []).append((i, "new"))
+    touched += [(i, "touched", file) for file in touched_files]
+    report["files_total"] += len(deleted_files)+len(changed_files)+len(new_rows)+len(touched_files)
+
+  tasks = [partial(_other_fanout, i, status, file, src_path, dst_paths[i], baks[i], 
+                   num_bak) for i, status, file in deleted]
+  files = list(copies)
+  if isinstance(workers, futil.Scheduler): files = _small_first(files, src_entries)
+  tasks += [partial(_mirror_fanout, file, src_path, 
+                    [(i, status, dst_paths[i], baks[i], num_bak) for i, status in copies[file]])
+            for file in files]
+  tasks += [partial(_other_fanout, i, status, file, src_path, dst_paths[i], baks[i], 
+                    num_bak) for i, status, file in touched]
+  with _phases(reports, "transfer", progress):
+    for results in futil.runTasks(tasks, workers, logger, halt):
+      for i, result in results: 
+        # a failing destination is reported, while the others continue
+        if "error" in result[2]:
+          if reports[i]["ok"]: reports[i].update(ok=False, error=result[2]["error"])
+          continue
+        _record(result, None, src_path, dst_paths[i], reports[i], progress, 
+                hash_cache=hash_cache)
+  if (halt is not None) and halt.is_set():
+    logger.info(" [WARNING] synchronization cancelled")
+    for report in reports: report.update(ok=False, error="cancelled")
+  logger.info("")
+
+
+@contextmanager
+def _phases(reports, phase, progress=None):
+  # time a phase shared by the reports of several destinations
+
+  for report in reports: report["phase"] = phase
+  start = time.perf_counter()
+  try: yield
+  finally:
+    for report in reports: 
+      report["phases"][phase] += time.perf_counter()-start
+      if progress is not None: progress(report)
+
+
+def _mirror_fanout(file, src_path, targets, logger):
+  # back up and copy a file to all (index, status, dst_path, bak, num_bak) 
+  # <targets> that need it, reading it from SRC only once. The stats of a 
+  # target that failed hold its "error" instead
+
+  start = time.perf_counter()
+  errors = {}
+  for i, status, dst_path, bak, num_bak in targets:
+    try:
+      if (status == "changed") and (bak is not None): 
+        _backup_changed(file, dst_path, bak, num_bak, logger)
+    except Exception as err: 
+      errors[i] = _fanout_error(file, dst_path, err, logger)
+      continue
+    logger.info(" ("+status+") '"+file+"' mirroring from SRC to '"+dst_path+"'")
+  bak_rotation = time.perf_counter()-start
+
+  start = time.perf_counter()
+  size = 0
+  dst_paths = [(i, dst_path) for i, _, dst_path, _, _ in targets if i not in errors]
+  if dst_paths and not DEBUG:
+    try:
+      size = futil.copyfiles(src_path+os.sep+file, 
+                             [dst_path+os.sep+file for _, dst_path in dst_paths], 
+                             logger=logger)
+    except Exception:
+      # copy to one destination after the other to find those that fail
+      for i, dst_path in dst_paths:
+        try: size = futil.copyfile(src_path+os.sep+file, dst_path+os.sep+file, logger=logger)
+        except Exception as err: errors[i] = _fanout_error(file, dst_path, err, logger)
+  stats = dict(bak_rotation=bak_rotation/len(targets), bytes=size,
+               copy=(time.perf_counter()-start)/len(targets))
+  return([(i, (status, file, dict(error=errors[i]) if i in errors else stats)) 
+          for i, status, _, _, _ in targets])
+
+
+def _other_fanout(i, status, file, src_path, dst_path, bak, num_bak, logger):
+  # deleted or touched file of the destination <i>, which reads nothing from SRC
+
+  try: return([(i, _run_op(status, file, src_path, dst_path, bak, num_bak, None, logger))])
+  except Exception as err: 
+    return([(i, (status, file, dict(error=_fanout_error(file, dst_path, err, logger))))])
+
+
+def _fanout_error(file, dst_path, err, logger):
+  # log the error of a file in one destination and return its message
+
+  logger.info(" [ERROR] '"+file+"' could not be synchronized to '"+dst_path+"': "+repr(err))
+  return(repr(err))
+
+
+
+# ----- Asynchronous Sync ----- #
+
+async def sync_directory_async(src_path, dst_path, bak_path=None, num_bak=5, 
+                               include_subdirs=True, sync_deleted=False, 
+                               logger=logging, workers=32, delta_threshold=None,
+                               compare="mtime", hash_cache=None, progress=None, 
+                               aio=None, bak_pack=None, bak_compression=None, 
+                               bak_store=None):
+  """ asyncio variant of sync_directory() for high-latency network mounts
+
+  SRC and DST are listed concurrently, directory by directory, and up to 
+  <workers> file system calls (listings, backups and copies) are in flight at
+  the same time, so their round trips overlap instead of adding up. The files
+  are compared, backed up and copied like in sync_directory(), which writes 
+  the same log messages and returns the same report.
+
+  Parameters
+  ----------
+  workers : int
+    maximum number of file system calls in flight, if no <aio> is given
+  aio : futil.AsyncIO or None
+    runner of the blocking calls, e.g. shared by several synchronizations
+
+  The remaining parameters are the same as for sync_directory().
+
+  Returns
+  -------
+  report : dict
+    summary of the synchronization, see sync_directory()
+
+  """
+
+  if aio is None:
+    async with futil.AsyncIO(workers) as aio:
+      return(await sync_directory_async(src_path, dst_path, bak_path, num_bak, 
+                                        include_subdirs, sync_deleted, logger, 
+                                        workers, delta_threshold, compare, 
+                                        hash_cache, progress, aio, bak_pack, 
+                                        bak_compression, bak_store))
+
+  bak_path = await aio.run(_check_paths, src_path, dst_path, bak_path, compare)
+  start = time.perf_counter()
+  report = new_report(src_path, dst_path)
+
+  if compare == "hash": hash_cache = await aio.run(futil.HashCache, hash_cache)
+  else: hash_cache = None
+  try:
+    await _sync_directory_async(src_path, dst_path, bak_path, num_bak, include_subdirs, 
+                                sync_deleted, logger, report, progress, 
+                                delta_threshold, hash_cache, aio, 
+                                (bak_pack, bak_compression, bak_store))
+  finally:
+    if hash_cache is not None: await aio.run(hash_cache.close)
+  return(_finish_report(report, start))
+
+
+async def _sync_directory_async(src_path, dst_path, bak_path, num_bak, include_subdirs, 
+                                sync_deleted, logger, report, progress, delta_threshold, 
+                                hash_cache, aio, bak_options=(None, None, None)):
+  # sync_directory_async() after the sanity checks
+
+  # copy whole folder if directory is completely new
+  if not await aio.run(os.path.isdir, dst_path):
+    logger.info(" mirroring SRC's whole directory to DST\n")
+    with _phase(report, "copy", progress):
+      if not DEBUG: await aio.run(futil.copytree, src_path, dst_path, logger=logger)
+    return
+
+  # SRC and DST are listed at the same time
+  with _phase(report, "scan_src", progress):
+    src_scan = asyncio.ensure_future(futil.scanTreeAsync(src_path, include_subdirs, aio))
+    dst_scan = asyncio.ensure_future(futil.scanTreeAsync(dst_path, include_subdirs, aio))
+    src_entries = futil.FileTable(e for e in await src_scan if not e.is_dir)
+    src_folders = [e.path for e in src_scan.result() if e.is_dir and include_subdirs]
+  with _phase(report, "scan_dst", progress):
+    dst_entries = futil.FileTable(e for e in await dst_scan if not e.is_dir)
+
+  # find files that are new, have been changed or deleted
+  with _phase(report, "diff", progress):
+    new_rows, changed_rows, unchanged_rows, deleted_rows = futil.diffTables(
+      src_entries, dst_entries)
+    new_files = [src_entries.path(row) for row in new_rows]
+    changed_files = [src_entries.path(row) for row in changed_rows]
+    deleted_files = [dst_entries.path(row) for row in deleted_rows] if sync_deleted else []
+    touched_files = []
+    if hash_cache is not None:
+      changed_files, touched_files = await aio.run(_compare_hashes, 
+        [src_entries.path(row) for row in changed_rows+unchanged_rows], 
+        src_path, src_entries, dst_path, dst_entries, hash_cache)
+    report["counts"]["unchanged"] = len(src_entries)-len(new_files)-len(changed_files)-len(touched_files)
+
+  # DST files in the way of SRC's new folders are moved to BAK before the tree
+  blocking = await aio.run(_backup_blocking, src_folders, deleted_files, src_path, dst_path, 
+                           bak_path, logger, report, progress)
+  if blocking: deleted_files = [file for file in deleted_files if file not in blocking]
+
+  # directories of one level are created concurrently, parents first
+  with _phase(report, "mkdirtree", progress):
+    if not DEBUG:
+      levels = {}
+      for obj in src_folders: levels.setdefault(obj.count(os.sep), []).append(obj)
+      for depth in sorted(levels):
+        await asyncio.gather(*[aio.run(os.makedirs, dst_path+os.sep+obj, exist_ok=True) 
+                               for obj in levels[depth]])
+
+  ops = []
+  if bak_path is not None: ops += [("deleted", file) for file in deleted_files]
+  ops += [("changed", file) for file in changed_files]
+  ops += [("new", file) for file in new_files]
+  ops += [("touched", file) for file in touched_files]
+  report["files_total"] += len(ops)
+
+  bak = None
+  if bak_path is not None: bak = await aio.run(bak_index, bak_path, *bak_options)
+  seqs = deque()
+  tasks = _op_tasks(_journaled(ops, None), seqs, src_path, dst_path, bak, num_bak, 
+                    delta_threshold)
+  try:
+    with _phase(report, "transfer", progress):
+      async for result in futil.runTasksAsync(tasks, aio, logger):
+        # storing a hash reads the file, so it must not block the event loop
+        if hash_cache is None: _record(result, seqs.popleft(), src_path, dst_path, report, progress)
+        else: await aio.run(_record, result, seqs.popleft(), src_path, dst_path, report, 
+                            progress, hash_cache=hash_cache)
+  finally:
+    if bak is not None: await aio.run(bak.close)
   logger.info("")
 
 
 
+# ----- Snapshots ----- #
+
+SNAPSHOT = re.compile(r"^\d{4}-\d{2}-\d{2}_\d{6}$")
+
+
+def sync_snapshot(src_path, snap_path, num_snapshots=5, include_subdirs=True, 
+                  logger=logging, workers=1):
+  """ create a point-in-time snapshot of a source directory
+
+  Each call creates a new directory <snap_path>/<TIMESIG> holding the contents 
+  of <src_path>, like rsync --link-dest. Files that did not change since the 
+  latest snapshot (same size and modification time) are hard links into it, 
+  so only changed and new files take up space. The snapshot is built under a
+  temporary name and only renamed once it is complete.
+
+  Parameters
+  ----------
+  src_path : str
+    source path, of which a snapshot is taken
+  snap_path : str
+    directory containing all snapshots
+  num_snapshots : int or None
+    number of snapshots to be kept, older ones are removed
+  include_subdirs : bool
+    whether to include the whole directory tree of <src_path> or just the files
+    in the root directory.
+  logger : logging.Logger
+    Logger, to which potential errors and warnings are redirected
+  workers : int
+    number of files that are linked or copied concurrently
+
+  """
+
+  if not os.path.isdir(src_path): 
+    raise ValueError("Invalid SRC directory "+src_path)
+  if not os.path.isdir(snap_path):
+    if not os.path.isdir(os.path.split(snap_path)[0]): 
+      raise ValueError("Invalid snapshot directory "+snap_path)
+    if not DEBUG: os.makedirs(snap_path)
+
+  snapshots = []
+  if os.path.isdir(snap_path): 
+    snapshots = sorted(obj for obj in os.listdir(snap_path) if SNAPSHOT.match(obj))
+  new_path = snap_path+os.sep+TIMESIG
+  if TIMESIG in snapshots: raise ValueError("Snapshot already exists "+new_path)
+  tmp_path = new_path+".incomplete"
+
+  # files of the latest snapshot with unchanged size and mtime are linked
+  src_folders, src_entries = _listing(src_path, include_subdirs)
+  prev_entries = futil.FileTable()
+  if len(snapshots) > 0:
+    prev_path = snap_path+os.sep+snapshots[-1]
+    logger.info(" linking unchanged files to snapshot "+snapshots[-1])
+    _, prev_entries = _listing(prev_path, include_subdirs)
+
+  tasks = []
+  for entry in src_entries:
+    prev = prev_entries.get(entry.path)
+    if (prev is not None) and (prev.size, prev.mtime_ns) == (entry.size, entry.mtime_ns):
+      tasks.append(partial(_snapshot_link, entry.path, prev_path, tmp_path))
+    else:
+      status = "new" if prev is None else "changed"
+      tasks.append(partial(_snapshot_copy, entry.path, status, src_path, tmp_path))
+
+  if not DEBUG:
+    if os.path.isdir(tmp_path): futil.removetree(tmp_path, logger=logger)
+    futil.mkdirtree([tmp_path]+[tmp_path+os.sep+obj for obj in src_folders])
+  num_linked = sum(status == "linked" for status in futil.runTasks(tasks, workers, logger))
+  if not DEBUG: os.rename(tmp_path, new_path)
+  logger.info(" "+str(num_linked)+" of "+str(len(tasks))+" files linked to previous snapshot")
+
+  # remove the oldest snapshots
+  snapshots.append(TIMESIG)
+  if (num_snapshots is not None) and (len(snapshots) > num_snapshots):
+    for obj in snapshots[:-num_snapshots]:
+      logger.info(" removing oldest snapshot "+obj)
+      if not DEBUG: futil.removetree(snap_path+os.sep+obj, logger=logger)
+
+  logger.info("")
+
+
+def _snapshot_link(file, prev_path, new_path, logger):
+  # hard link an unchanged file into the new snapshot, copy it if that fails
+
+  if DEBUG: return("linked")
+  try: os.link(prev_path+os.sep+file, new_path+os.sep+file)
+  except OSError: 
+    futil.copyfile(prev_path+os.sep+file, new_path+os.sep+file, logger=logger)
+    return("copied")
+  return("linked")
+
+
+def _snapshot_copy(file, status, src_path, new_path, logger):
+  # copy a new or changed file from SRC into the new snapshot
+
+  logger.info(" ("+status+") '"+file+"' copying from SRC to snapshot")
+  if not DEBUG: 
+    futil.copyfile(src_path+os.sep+file, new_path+os.sep+file, logger=logger)
+  return(status)
+
+
+
 class job:
   name = "fsync_job"
   SRC = "__invalid__"
@@ -210,10 +2007,38 @@ class job:
   BAK = None
   num_bak = 5
   sync_deleted = False
+  manifest = False
+  verify = False
+  workers = 1
+  delta_threshold = None
+  compare = "mtime"
+  progress = None
+  streaming = False
+  journal = False
+  bak_pack = None
+  bak_compression = None
+  bak_dedup = False
+  targets = []
+  max_bytes_per_sec = None
+  max_ops_per_sec = None
+  renames = False
+  checksums = False
+  verify_sample = 0.
+  prune = False
+  filters = None
+  filter_file = None
+  scheduler = 1
+  halt = None
   LOG = logging
 
   def __init__(self, name, src_path=None, dst_path=None, 
-               bak_path=None, num_bak=5, sync_deleted=False):
+               bak_path=None, num_bak=5, sync_deleted=False, 
+               manifest=False, verify=False, workers=1, delta_threshold=None,
+               compare="mtime", progress=None, streaming=False, journal=False,
+               bak_pack=None, bak_compression=None, bak_dedup=False, targets=None,
+               max_bytes_per_sec=None, max_ops_per_sec=None, renames=False,
+               checksums=False, verify_sample=0., prune=False, filters=None,
+               filter_file=None):
     global TIMESIG
     TIMESIG = datetime.now().strftime("%Y-%m-%d_%H%M%S")
     
@@ -224,9 +2049,39 @@ class job:
     if bak_path is not None: self.BAK = bak_path 
     self.num_bak = num_bak
     self.sync_deleted = sync_deleted
-
-  def check_single(self):
-    # Sanity checks
+    self.manifest = manifest
+    self.verify = verify
+    self.workers = workers
+    self.delta_threshold = delta_threshold
+    self.compare = compare
+    self.progress = progress
+    self.streaming = streaming
+    self.journal = journal
+    self.bak_pack = bak_pack
+    self.bak_compression = bak_compression
+    self.bak_dedup = bak_dedup
+    if targets is not None: self.targets = targets
+    self.max_bytes_per_sec = max_bytes_per_sec
+    self.max_ops_per_sec = max_ops_per_sec
+    self.renames = renames
+    self.checksums = checksums
+    self.verify_sample = verify_sample
+    self.prune = prune
+    self.filters = filters
+    self.filter_file = filter_file
+    self.halt = threading.Event()
+
+  def check_single(self, fanout=False):
+    # Sanity checks. Further <targets> are only synchronized by the methods that
+    # <fanout> to them, and only with the options sync_fanout() supports
+
+    if self.targets and not fanout:
+      raise ValueError("Further targets are only synchronized by sync_directory() and "
+                       "sync_root()")
+    if self.targets and (self.manifest or self.journal or self.streaming or self.renames or 
+                         (self.delta_threshold is not None) or self.checksums or self.prune):
+      raise ValueError("Further targets cannot be used with manifest, journal, streaming, "
+                       "delta_threshold, renames, checksums or prune")
 
     if self.SRC[-1] == os.sep: self.SRC = self.SRC[:-1]
     if self.DST[-1] == os.sep: self.DST = self.DST[:-1]
@@ -238,6 +2093,10 @@ class job:
 #      raise ValueError("Invalid DST directory: "+self.DST)
 #    if not os.path.isdir(self.BAK): 
 #      raise ValueError("Invalid BAK directory: "+self.BAK)
+    # a cancel() of a previous run does not stop this one
+    self.halt.clear()
+    # all projects of a run share the I/O limits
+    self.scheduler = _scheduler(self.workers, self.max_bytes_per_sec, self.max_ops_per_sec)
     if self.sync_deleted: 
       print("[WARNING] sync_deleted is NOT recommended if multiple machines or backup jobs use DST!\n")
 
@@ -271,8 +2130,93 @@ class job:
     self.LOG.info("DST = '"+self.DST+"'")
     if self.BAK is not None: self.LOG.info("BAK = '"+self.BAK+"'")
     self.LOG.info("num_bak = "+str(self.num_bak)+"")
+    if self.manifest: self.LOG.info("manifest = '"+self.manifest_file()+"'")
+    if self.workers != 1: self.LOG.info("workers = "+str(self.workers))
+    if self.max_bytes_per_sec is not None: 
+      self.LOG.info("max_bytes_per_sec = "+str(self.max_bytes_per_sec))
+    if self.max_ops_per_sec is not None: 
+      self.LOG.info("max_ops_per_sec = "+str(self.max_ops_per_sec))
+    if self.delta_threshold is not None: 
+      self.LOG.info("delta_threshold = "+str(self.delta_threshold))
+    if self.compare != "mtime": self.LOG.info("compare = "+self.compare)
+    if self.streaming: self.LOG.info("streaming = True")
+    if self.renames: self.LOG.info("renames = True")
+    if self.prune: self.LOG.info("tree_cache = '"+self.tree_file()+"'")
+    if self.filters: self.LOG.info("filters = "+str(self.filters))
+    if self.filter_file is not None: self.LOG.info("filter_file = '"+self.filter_file+"'")
+    if self.checksums: 
+      self.LOG.info("checksums = True (verify_sample = "+str(self.verify_sample)+")")
+    if self.journal: self.LOG.info("journal = '"+self.journal_file()+"'")
+    if self.bak_pack is not None: 
+      self.LOG.info("bak_pack = "+str(self.bak_pack)+" ("+str(self.bak_compression)+")")
+    if self.bak_dedup: self.LOG.info("bak_store = '"+str(self.store_path())+"'")
+    for dst_path, bak_path in self.targets: 
+      self.LOG.info("+DST = '"+dst_path+"'"+(" (BAK = '"+bak_path+"')" if bak_path else ""))
     self.LOG.info("sync_deleted = "+str(self.sync_deleted)+"\n\n")
 
+  def options(self):
+    # keyword arguments of sync_directory() given by the job's settings
+
+    options = dict(num_bak=self.num_bak, sync_deleted=self.sync_deleted, 
+                   manifest=self.manifest_file(), verify=self.verify, 
+                   workers=self.scheduler, delta_threshold=self.delta_threshold,
+                   compare=self.compare, hash_cache=self.DST+"_fsync.hashes", 
+                   progress=self.progress, streaming=self.streaming, 
+                   journal=self.journal_file(), halt=self.halt, bak_pack=self.bak_pack,
+                   bak_compression=self.bak_compression, bak_store=self.store_path(),
+                   renames=self.renames, checksums=self.checksums, 
+                   verify_sample=self.verify_sample, tree_cache=self.tree_file(),
+                   filters=self.filter())
+    return(options)
+
+  def destinations(self):
+    # DST and BAK of the job, or lists of them if there are further <targets>
+
+    if not self.targets: return(self.DST, self.BAK)
+    return([self.DST]+[dst_path for dst_path, _ in self.targets], 
+           [self.BAK]+[bak_path for _, bak_path in self.targets])
+
+  def manifest_file(self):
+    # SQLite file of the DST manifest, stored next to the log file
+
+    if not self.manifest: return(None)
+    return(self.DST+"_fsync.db")
+
+  def store_path(self):
+    # object store shared by all BAK directories of the job
+
+    if (not self.bak_dedup) or (self.BAK is None): return(None)
+    return(self.BAK+os.sep+"__fsync_objects")
+
+  def filter(self):
+    # futil.Filter of the job's <filters> followed by the rules in <filter_file>
+
+    if (self.filters is None) and (self.filter_file is None): return(None)
+    return(futil.Filter(self.filters or [], self.filter_file))
+
+  def tree_file(self):
+    # SQLite file of the SRC directory summaries, stored next to the log file
+
+    if not self.prune: return(None)
+    return(self.DST+"_fsync.tree")
+
+  def journal_file(self):
+    # SQLite file of the transfer journal, stored next to the log file
+
+    if not self.journal: return(None)
+    return(self.DST+"_fsync.journal")
+
+  def cancel(self):
+    """ Stop the running sync of this job safely, e.g. from another thread
+
+    Files that are being transferred are completed and no further ones are
+    started. With <journal> set, the next run finishes the remaining files. 
+    A watch() stops after its current step.
+
+    """
+
+    self.halt.set()
+
   def finish(self):
     self.LOG.info("\n__________________________________________________\n\n\n")
     self.LOG.handlers.clear()
@@ -281,21 +2225,24 @@ class job:
   def sync_directory(self):
     # Sync the entire directory tree
 
-    self.check_single()
+    self.check_single(fanout=True)
     self.init_logger()
     
-    sync_directory(self.SRC, self.DST, self.BAK, num_bak=self.num_bak, 
-                   sync_deleted=self.sync_deleted, logger=self.LOG)
+    report = sync_directory(self.SRC, *self.destinations(), logger=self.LOG, 
+                            **self.options())
     
     self.finish()
+    return(report)
 
 
-  def sync_individual(self, include=None, exclude=None):
+  def sync_individual(self, include=None, exclude=None, parallel=1):
     """ Sync the individual folders contained by <SRC>
 
     This starts an individual sync job for each first-level subdirectory and 
     lets you include or exclude only some of them. By default, all of them are
-    synchronized, including the root directory.
+    synchronized, including the root directory. Subdirectories excluded by the
+    job's <filters> are skipped, and within each subdirectory, the filters 
+    still apply relative to <SRC> (see futil.Filter.subtree).
 
     Parameters
     ----------
@@ -305,6 +2252,17 @@ class job:
     exclude : list of str or None
       list of subdirectories that are NOT to be synchronized, where "." 
       represents the root directory. Only takes effect if include is None.
+    parallel : int
+      number of subdirectories that are synchronized at the same time. Their
+      log messages are still written one subdirectory after the other.
+
+    Returns
+    -------
+    summary : dict
+      report of each subdirectory (and ".") as returned by sync_directory(). A
+      failing subdirectory does not stop the others, its report has "ok" set to
+      False and the exception message in "error". Subdirectories that had not
+      started before cancel() are missing.
 
     """
 
@@ -324,14 +2282,17 @@ class job:
       sync_root = False
     if (include is not None) and ("." not in include): 
       sync_root = False
-    if sync_root:
-      self.LOG.info("_ROOT_:")
-      sync_directory(self.SRC, self.DST, self.BAK, num_bak=self.num_bak, 
-                     include_subdirs=False, sync_deleted=self.sync_deleted, logger=self.LOG)
+    projects = []
+    if sync_root: projects.append((".", self.SRC, self.DST, self.BAK, False))
     
     # sync subdirectories
     src_projects = [self.SRC+os.sep+obj for obj in os.listdir(self.SRC) if os.path.isdir(self.SRC+os.sep+obj)]
-    bak_projects = [self.BAK+os.sep+os.path.split(obj)[-1] for obj in src_projects]
+    filters = self.filter()
+    if filters is not None:
+      src_projects = [obj for obj in src_projects 
+                      if not filters.excluded(os.path.split(obj)[-1], True)]
+    if self.BAK is None: bak_projects = [None for obj in src_projects]
+    else: bak_projects = [self.BAK+os.sep+os.path.split(obj)[-1] for obj in src_projects]
 
     if include is not None:
       #print("[WARNING] INCLUDE option not thoroughly tested yet!")
@@ -345,21 +2306,169 @@ class job:
     for src_project,bak_project in zip(src_projects,bak_projects):
       _,project = os.path.split(src_project)
       dst_project = self.DST+os.sep+project
+      projects.append((project, src_project, dst_project, bak_project, True))
+
+    # the root directory creates DST (or copies a new SRC as a whole) before
+    # the subdirectories start
+    tasks = [partial(self._sync_project, *args) for args in projects]
+    summary = {}
+    if sync_root: summary.update(futil.runTasks(tasks[:1], 1, self.LOG, self.halt))
+    summary.update(futil.runTasks(tasks[len(summary):], parallel, self.LOG, self.halt))
+    failed = [project for project, report in summary.items() if not report["ok"]]
+    if len(failed) > 0:
+      self.LOG.info("[WARNING] "+str(len(failed))+" of "+str(len(summary))
+                    +" projects failed: "+str(failed))
+
+    self.finish()
+    return(summary)
+
+
+  def _sync_project(self, project, src_path, dst_path, bak_path, include_subdirs, 
+                    logger):
+    # sync a single project of sync_individual() without raising
 
-      self.LOG.info(project+":")
-      sync_directory(src_project, dst_project, bak_project, num_bak=self.num_bak,
-                     sync_deleted=self.sync_deleted, logger=self.LOG)
+    if project == ".": logger.info("_ROOT_:")
+    else: logger.info(project+":")
+    options = self.options()
+    if (options["filters"] is not None) and (project != "."): 
+      options["filters"] = options["filters"].subtree(project)
+    try:
+      report = sync_directory(src_path, dst_path, bak_path, include_subdirs=include_subdirs, 
+                              logger=logger, **options)
+    except Exception as err:
+      logger.info(" [ERROR] synchronization failed, check logfile for full traceback\n")
+      logger.debug(traceback.format_exc()+"\n")
+      report = new_report(src_path, dst_path)
+      report.update(ok=False, error=repr(err))
+    return(project, report)
+
+
+  def audit(self):
+    """ Check DST against the checksums recorded by previous runs
+
+    See audit_directory(). Only files copied with <checksums> (or compared with
+    compare="hash") have a checksum. SRC is not read.
+
+    Returns
+    -------
+    audit : dict
+      as returned by audit_directory()
+
+    """
+
+    self.check_single()
+    self.init_logger()
+
+    audit = audit_directory(self.DST, self.DST+"_fsync.hashes", logger=self.LOG, 
+                            workers=self.scheduler)
+
+    self.finish()
+    return(audit)
+
+
+  def sync_snapshot(self):
+    """ Take a hard-linked snapshot of <SRC> in a new subdirectory of <DST>
+
+    Unchanged files are shared with the previous snapshot and <num_bak> is 
+    the number of snapshots kept. <BAK> is not used. See sync_snapshot().
+
+    """
+
+    global TIMESIG
+    self.check_single()
+    TIMESIG = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+    self.init_logger()
+
+    sync_snapshot(self.SRC, self.DST, num_snapshots=self.num_bak, 
+                  logger=self.LOG, workers=self.scheduler)
 
     self.finish()
 
 
+  def watch(self, interval=1, debounce=2, reconcile=3600, duration=None):
+    """ Keep <DST> synchronized with <SRC> until interrupted
+
+    After an initial sync_directory(), changes in <SRC> are collected with 
+    futil.watchTree() (inotify on Linux, polling elsewhere). Once no new 
+    changes arrived for <debounce> seconds, only the affected paths are 
+    synchronized with sync_paths(), which keeps the BAK and num_bak behaviour.
+    The whole tree is compared again every <reconcile> seconds, whenever 
+    events were lost and after a synchronization failed, so errors are logged
+    without ending the watch.
+
+    Parameters
+    ----------
+    interval : float
+      maximum time in seconds to wait for new changes at once
+    debounce : float
+      quiet time in seconds after the last change before syncing
+    reconcile : float or None
+      time in seconds between two full synchronizations
+    duration : float or None
+      time in seconds after which watching stops. By default, watching only 
+      stops with a KeyboardInterrupt.
+
+    """
+
+    global TIMESIG
+    self.check_single()
+    self.init_logger()
+
+    start = time.monotonic()
+    last_reconcile = None
+    watcher = futil.watchTree(self.SRC)
+    pending = set()
+    last_change = start
+    try:
+      while ((duration is None) or (time.monotonic()-start < duration)) and not self.halt.is_set():
+        now = time.monotonic()
+        TIMESIG = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        try:
+          if (last_reconcile is None) or ((reconcile is not None) and (now-last_reconcile >= reconcile)):
+            self.LOG.info("[full reconcile]")
+            sync_directory(self.SRC, self.DST, self.BAK, logger=self.LOG, **self.options())
+            last_reconcile = now
+            pending = set()
+
+          changes = watcher.read(interval)
+          if changes is None: 
+            self.LOG.info("[WARNING] file system events were lost")
+            last_reconcile = None
+            continue
+          if len(changes) > 0:
+            pending |= changes
+            last_change = time.monotonic()
+          if (len(pending) > 0) and (time.monotonic()-last_change >= debounce):
+            self.LOG.info("["+datetime.now().strftime("%H:%M:%S")+"] "+str(len(pending))+" changed path(s)")
+            sync_paths(self.SRC, self.DST, pending, self.BAK, num_bak=self.num_bak, 
+                       sync_deleted=self.sync_deleted, logger=self.LOG, 
+                       manifest=self.manifest_file(), workers=self.scheduler, 
+                       delta_threshold=self.delta_threshold, bak_pack=self.bak_pack,
+                       bak_compression=self.bak_compression, bak_store=self.store_path(),
+                       filters=self.filter())
+            pending = set()
+        # e.g. files vanishing before they are copied, which a full reconcile fixes
+        except Exception:
+          self.LOG.info("[ERROR] synchronization failed, check logfile for full traceback")
+          self.LOG.debug(traceback.format_exc()+"\n")
+          last_reconcile = None
+          pending = set()
+          self.halt.wait(interval)
+    except KeyboardInterrupt:
+      self.LOG.info("watching stopped by user")
+    finally:
+      watcher.close()
+      self.finish()
+
+
   def sync_root(self):
     # synchronize only the files in the root directory
 
-    self.check_single()
+    self.check_single(fanout=True)
     self.init_logger()
     
-    sync_directory(self.SRC, self.DST, self.BAK, num_bak=self.num_bak, 
-                     include_subdirs=False, sync_deleted=self.sync_deleted, logger=self.LOG)
+    report = sync_directory(self.SRC, *self.destinations(), include_subdirs=False, 
+                            logger=self.LOG, **self.options())
     
-    self.finish()
\ No newline at end of file
+    self.finish()
+    return(report)
\ No newline at end of file
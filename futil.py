@@ -28,13 +28,213 @@ SOFTWARE.
 
 
 
-import os, sys, shutil
+import os, sys, shutil, re, copy
 import logging, traceback
+import hashlib, sqlite3, errno, threading
+import ctypes, ctypes.util, select, struct, time, bisect, asyncio, mmap
+from array import array
+try: import fcntl
+except ImportError: fcntl = None
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 
 
 # ----- Utility Functions ----- #
 
+class LogBuffer:
+  """ Stand-in for a logging.Logger that keeps messages until they are flushed
+
+  Used to write the messages of tasks running in parallel in a fixed order.
+
+  """
+
+  def __init__(self):
+    self.records = []
+
+  def log(self, level, msg): self.records.append((level, msg))
+  def debug(self, msg): self.log(logging.DEBUG, msg)
+  def info(self, msg): self.log(logging.INFO, msg)
+  def warning(self, msg): self.log(logging.WARNING, msg)
+  def error(self, msg): self.log(logging.ERROR, msg)
+
+  def flush(self, logger=logging):
+    # pass all kept messages on to <logger>
+
+    for level, msg in self.records: logger.log(level, msg)
+    self.records = []
+
+
+def runTasks(tasks, workers=1, logger=logging, halt=None):
+  """ Run tasks concurrently and yield their results in order
+
+  Each task is called with a logger as its only argument. With several workers, 
+  every task gets its own LogBuffer, which is flushed to <logger> in the order
+  of <tasks>, so the log does not depend on the order in which tasks finish.
+  If a task raises, the tasks that have not started yet are cancelled and the 
+  exception is re-raised once its messages are logged. <tasks> is consumed 
+  lazily and at most 2*<workers> tasks are pending at any time, so it can be a 
+  generator producing tasks while earlier ones are running. Once <halt> is set,
+  no further tasks are started, but the results of those already started are 
+  still yielded. With a Scheduler as <workers>, it decides how many tasks run 
+  at the same time and how fast they start and copy data.
+
+  Parameters
+  ----------
+  tasks : iterable of callable
+    functions taking a logger as their only argument
+  workers : int or Scheduler
+    maximum number of tasks running at the same time
+  logger : logging.Logger
+    Logger, to which the messages of all tasks are redirected
+  halt : threading.Event or None
+    event that stops the execution of further tasks
+
+  Yields
+  ------
+  result : object
+    return value of each task, in the order of <tasks>
+
+  """
+
+  if isinstance(workers, Scheduler):
+    run = workers.run
+    tasks = (partial(run, task) for task in tasks)
+    workers = workers.max_workers
+  if (workers is None) or (workers <= 1):
+    for task in tasks: 
+      if (halt is not None) and halt.is_set(): return
+      yield(task(logger))
+    return
+
+  pool = ThreadPoolExecutor(workers)
+  pending = deque()
+  tasks = iter(tasks)
+  try:
+    while True:
+      for task in tasks:
+        if (halt is not None) and halt.is_set(): break
+        buf = LogBuffer()
+        pending.append((pool.submit(task, buf), buf))
+        if len(pending) >= 2*workers: break
+      if not pending: break
+      future, buf = pending.popleft()
+      try: result = future.result()
+      finally: buf.flush(logger)
+      yield(result)
+  finally: pool.shutdown(wait=True, cancel_futures=True)
+
+
+_local = threading.local() # Scheduler of the task running in each thread
+
+
+class Scheduler:
+  """ Limits and adapts the I/O of tasks run by runTasks()
+
+  Tasks passed to runTasks() with a Scheduler as <workers> are started at most
+  <max_ops_per_sec> times per second, and the files copied by copydata(), 
+  copyfiles() and deltafile() within them are written in chunks of 
+  THROTTLE_CHUNK bytes at most <max_bytes_per_sec> in total. Both limits are 
+  token buckets that allow bursts of one second. 
+
+  If <min_workers> is smaller than <max_workers>, the number of concurrent 
+  tasks is tuned by hill climbing: every <interval> seconds, it is changed by 
+  one in the same direction as before if the throughput in bytes per second 
+  increased, and in the other direction otherwise. This finds the concurrency 
+  at which the storage is fastest, or the smallest one that exhausts the 
+  byte limit. A Scheduler can be shared by several runs, e.g. all projects 
+  of a job, which then share its limits.
+
+  Parameters
+  ----------
+  max_workers : int
+    maximum number of tasks running at the same time
+  min_workers : int or None
+    minimum number of concurrent tasks, None for a fixed <max_workers>
+  max_bytes_per_sec : float or None
+    limit of the bytes copied per second, None for no limit
+  max_ops_per_sec : float or None
+    limit of the tasks started per second, None for no limit
+  interval : float
+    seconds between two adjustments of the concurrency
+
+  """
+
+  def __init__(self, max_workers=1, min_workers=None, max_bytes_per_sec=None, 
+               max_ops_per_sec=None, interval=1.):
+    self.max_workers = max(1, max_workers)
+    self.min_workers = self.max_workers if min_workers is None else max(1, min_workers)
+    self.workers = self.min_workers
+    self.rates = dict(bytes=max_bytes_per_sec, ops=max_ops_per_sec)
+    self.interval = interval
+    self.active = 0
+    self.bytes_done = 0
+    now = time.monotonic()
+    self._tokens = {kind: rate for kind, rate in self.rates.items()}
+    self._stamps = {kind: now for kind in self.rates}
+    self._lock = threading.Lock()
+    self._cond = threading.Condition()
+    self._step = 1
+    self._last = (now, 0, 0.) # time, bytes_done and throughput of the last step
+
+  def _reserve(self, kind, amount, now):
+    # take <amount> tokens of a bucket and return the seconds to wait for them
+
+    rate = self.rates[kind]
+    if (not rate) or (not amount): return(0.)
+    tokens = min(rate, self._tokens[kind]+(now-self._stamps[kind])*rate)
+    self._stamps[kind] = now
+    self._tokens[kind] = tokens-amount
+    return(max(0., (amount-tokens)/rate))
+
+  def take(self, nbytes=0, ops=0):
+    """ Count <nbytes> and <ops> and wait until the limits allow them """
+
+    with self._lock:
+      now = time.monotonic()
+      self.bytes_done += nbytes
+      delay = max(self._reserve("bytes", nbytes, now), self._reserve("ops", ops, now))
+    if delay > 0: time.sleep(delay)
+
+  def _adapt(self):
+    # one step of hill climbing on the throughput, called with self._cond held
+
+    now = time.monotonic()
+    last, last_bytes, last_rate = self._last
+    if (self.min_workers == self.max_workers) or (now-last < self.interval): return
+    rate = (self.bytes_done-last_bytes)/(now-last)
+    if rate < last_rate: self._step = -self._step
+    workers = min(self.max_workers, max(self.min_workers, self.workers+self._step))
+    if workers == self.workers: self._step = -self._step
+    self.workers = workers
+    self._last = (now, self.bytes_done, rate)
+
+  def run(self, task, logger=logging):
+    """ Run a task of runTasks() once the concurrency and ops limits allow it """
+
+    with self._cond:
+      while self.active >= self.workers: self._cond.wait()
+      self.active += 1
+    self.take(ops=1)
+    outer = getattr(_local, "scheduler", None)
+    _local.scheduler = self
+    try: return(task(logger))
+    finally:
+      _local.scheduler = outer
+      with self._cond:
+        self.active -= 1
+        self._adapt()
+        self._cond.notify_all()
+
+
+def _charge(nbytes):
+  # count copied bytes towards the Scheduler of the current task, if any
+
+  scheduler = getattr(_local, "scheduler", None)
+  if scheduler is not None: scheduler.take(nbytes)
+
+
 def find(string, container):
   """ Find an string in an container of strings
 
@@ -55,6 +255,267 @@ def find(string, container):
   return(-1)
 
 
+def diffFiles(src_files, src_time, dst_files, dst_time, tolerance=1):
+  """ Classify the files of a source and a destination listing
+
+  Both listings are indexed once, so every relative path is classified in a 
+  single pass without any calls to the file system.
+
+  Parameters
+  ----------
+  src_files : list of str
+    relative paths of all files in the source directory
+  src_time : list of float
+    modification times corresponding to <src_files>
+  dst_files : list of str
+    relative paths of all files in the destination directory
+  dst_time : list of float
+    modification times corresponding to <dst_files>
+  tolerance : float
+    number of seconds by which a source file has to be newer than its 
+    counterpart in the destination to be considered changed
+
+  Returns
+  -------
+  new_files : list of str
+    files that only exist in the source, in the order of <src_files>
+  changed_files : list of str
+    files that are newer in the source, in the order of <src_files>
+  unchanged_files : list of str
+    files that exist in both and are not newer in the source
+  deleted_files : list of str
+    files that only exist in the destination, in the order of <dst_files>
+
+  """
+
+  src_index = dict(zip(src_files, src_time))
+  dst_index = dict(zip(dst_files, dst_time))
+
+  new_files = []; changed_files = []; unchanged_files = []
+  for file, time in src_index.items():
+    dst = dst_index.get(file)
+    if dst is None: new_files.append(file)
+    elif time > dst + tolerance: changed_files.append(file)
+    else: unchanged_files.append(file)
+  deleted_files = [file for file in dst_index if file not in src_index]
+
+  return(new_files, changed_files, unchanged_files, deleted_files)
+
+
+def hashfile(filename, block_size=1<<20):
+  """ Compute the BLAKE2b hash of a file's content as a hex string """
+
+  digest = hashlib.blake2b()
+  with open(filename, "rb") as fid:
+    for block in iter(lambda: fid.read(block_size), b""): digest.update(block)
+  return(digest.hexdigest())
+
+
+class HashCache:
+  """ Persistent cache of file content hashes
+
+  Hashes are stored in an SQLite database together with the size, modification
+  time and inode of the file they were computed from, and are only reused as
+  long as these do not change. New hashes are written when the cache is closed.
+
+  Parameters
+  ----------
+  filename : str or None
+    SQLite database file. If None, hashes are only cached in memory.
+
+  """
+
+  def __init__(self, filename=None):
+    if filename is None: filename = ":memory:"
+    # the cache may be handed between threads, but is never used concurrently
+    self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+    self.db.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, "
+                    "size INTEGER, mtime_ns INTEGER, inode INTEGER, hash TEXT)")
+    self.db.commit()
+    self.updates = {}
+
+  def hash(self, filename, entry=None):
+    """ Return the hash of a file, reading it only if it is not cached
+
+    <entry> is the file's Entry from scanTree(), otherwise it is stat'ed.
+
+    """
+
+    path = os.path.abspath(filename)
+    if entry is None: 
+      stat = os.stat(filename)
+      key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    else: key = (entry.size, entry.mtime_ns, entry.inode)
+
+    row = self.updates.get(path)
+    if row is None:
+      row = self.db.execute("SELECT size, mtime_ns, inode, hash FROM hashes "
+                            "WHERE path=?", (path,)).fetchone()
+    if (row is not None) and (tuple(row[:3]) == key): return(row[3])
+    digest = hashfile(filename)
+    self.updates[path] = key+(digest,)
+    return(digest)
+
+  def cached(self, filename, entry=None):
+    """ Return the recorded hash of a file without reading it, or None
+
+    Unlike hash(), the file is never read, so the result is what it should 
+    contain as long as its size, modification time and inode are unchanged.
+
+    """
+
+    if entry is None: 
+      stat = os.stat(filename)
+      key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    else: key = (entry.size, entry.mtime_ns, entry.inode)
+    row = self.recorded(filename)
+    if (row is not None) and (tuple(row[:3]) == key): return(row[3])
+    return(None)
+
+  def recorded(self, filename):
+    """ Return the (size, mtime_ns, inode, hash) recorded for a path, or None
+
+    The path is neither read nor stat'ed, so it need not exist anymore, e.g. 
+    to recognize a file that has been renamed since by its inode.
+
+    """
+
+    path = os.path.abspath(filename)
+    row = self.updates.get(path)
+    if row is None:
+      row = self.db.execute("SELECT size, mtime_ns, inode, hash FROM hashes "
+                            "WHERE path=?", (path,)).fetchone()
+    return(None if row is None else tuple(row))
+
+  def store(self, filename, digest):
+    # register the known hash of a file, e.g. after it has been copied
+
+    stat = os.stat(filename)
+    self.updates[os.path.abspath(filename)] = (stat.st_size, stat.st_mtime_ns, 
+                                               stat.st_ino, digest)
+
+  def close(self):
+    with self.db:
+      self.db.executemany("INSERT OR REPLACE INTO hashes VALUES (?,?,?,?,?)", 
+        [(path,)+row for path, row in self.updates.items()])
+    self.db.close()
+
+
+class TreeSummary:
+  """ Persistent summaries of the directories of a tree to skip unchanged subtrees
+
+  For each directory, its modification time, number of entries, subdirectories
+  and a digest are stored. The digest covers the name, size and modification
+  time of every file in the directory and the digests of all subdirectories,
+  so it stays the same only while no entry has been added, removed, renamed
+  or modified anywhere in the subtree. Checking this takes one scan of the 
+  tree, after which the unchanged subtrees need not be compared with another 
+  tree at all.
+
+  Parameters
+  ----------
+  filename : str or None
+    SQLite database file, which can hold the summaries of several trees. If 
+    None, summaries are only kept in memory.
+
+  """
+
+  def __init__(self, filename=None):
+    if filename is None: filename = ":memory:"
+    self.db = sqlite3.connect(filename, timeout=60)
+    self.db.execute("CREATE TABLE IF NOT EXISTS dirs (root TEXT, path TEXT, "
+                    "mtime_ns INTEGER, count INTEGER, subdirs TEXT, digest TEXT, "
+                    "PRIMARY KEY (root, path))")
+    self.db.commit()
+    self.root = None
+    self.updates = {}
+
+  def unchanged(self, fullpath, key="", filter=None):
+    """ Return the topmost subtrees of <fullpath> unchanged since the last commit()
+
+    The new summaries of all directories are kept until commit() is called, 
+    e.g. once the tree has been synchronized successfully. A subtree also 
+    counts as changed if <key>, e.g. the Filter.key() of the rules used with
+    the tree, differs from that of the last commit(). Entries excluded by the
+    Filter <filter> are skipped like in scanTree(), so they are neither walked
+    nor part of the summaries.
+
+    Returns
+    -------
+    pruned : set of str
+      relative paths of the unchanged directories, which are not within 
+      another unchanged directory. The root directory is never included.
+
+    """
+
+    if fullpath[-1] != os.sep: fullpath += os.sep
+    self.root = os.path.abspath(fullpath)
+    old = {row[0]: row[1:] for row in self.db.execute(
+      "SELECT path, mtime_ns, count, subdirs, digest FROM dirs WHERE root=?", (self.root,))}
+
+    # directories in pre-order with the metadata of their files
+    order = []; summaries = {}
+    stack = [""]
+    while stack:
+      folder = stack.pop()
+      try: 
+        mtime_ns = os.stat(fullpath+folder).st_mtime_ns
+        with os.scandir(fullpath+folder) as it: objs = sorted(it, key=lambda e: e.name)
+      except FileNotFoundError: continue
+      subdirs = []; files = hashlib.blake2b(digest_size=16); count = 0
+      for obj in objs:
+        path = folder+os.sep+obj.name if folder else obj.name
+        try:
+          is_dir = obj.is_dir()
+          early = (filter is not None) and (is_dir or not filter.predicates)
+          if early and filter.excluded(path, is_dir): continue
+          if is_dir: 
+            subdirs.append(obj.name); count += 1
+            continue
+          stat = obj.stat()
+        except FileNotFoundError: continue
+        if (filter is not None) and (not early) and filter.excluded(path, False, stat): continue
+        count += 1
+        files.update(obj.name.encode(errors="surrogateescape")+b"\0"
+                     +struct.pack("<qq", stat.st_size, stat.st_mtime_ns))
+      summaries[folder] = (mtime_ns, count, subdirs, files.digest())
+      order.append(folder)
+      stack += [folder+os.sep+name if folder else name for name in reversed(subdirs)]
+
+    # digests from the bottom up
+    digests = {}
+    for folder in reversed(order):
+      mtime_ns, count, subdirs, files = summaries[folder]
+      digest = hashlib.blake2b(key.encode(errors="surrogateescape")+b"\0"
+                               +struct.pack("<qq", mtime_ns, count)+files, digest_size=16)
+      for name in subdirs:
+        child = folder+os.sep+name if folder else name
+        digest.update((name+"\0"+digests.get(child, "")+"\0").encode(errors="surrogateescape"))
+      digests[folder] = digest.hexdigest()
+    self.updates = {folder: (mtime_ns, count, "\0".join(subdirs), digests[folder])
+                    for folder, (mtime_ns, count, subdirs, _) in summaries.items()}
+
+    pruned = set(); covered = set()
+    for folder in order[1:]:
+      if os.path.dirname(folder) in covered: 
+        covered.add(folder)
+      elif (folder in old) and (old[folder][3] == digests[folder]): 
+        pruned.add(folder); covered.add(folder)
+    return(pruned)
+
+  def commit(self):
+    # replace the stored summaries with those of the last call of unchanged()
+
+    if self.root is None: return
+    with self.db:
+      self.db.execute("DELETE FROM dirs WHERE root=?", (self.root,))
+      self.db.executemany("INSERT INTO dirs VALUES (?,?,?,?,?,?)", 
+        [(self.root, path)+row for path, row in self.updates.items()])
+
+  def close(self):
+    self.db.close()
+
+
 def mkdirtree(paths):
   """ Make a whole tree of directories
 
@@ -69,9 +530,144 @@ def mkdirtree(paths):
   for path in paths: os.makedirs(path, exist_ok=True)
 
 
+FICLONE = 0x40049409 # Linux ioctl creating a reflink of a whole file
+COPY_BUFSIZE = 8<<20 # buffer size of the user-space copy loop
+THROTTLE_CHUNK = 1<<20 # size of the copied chunks within a Scheduler
+COPY_METHODS = ["reflink", "copy_file_range", "sendfile", "readinto"]
+UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, 
+               errno.ENOSYS, errno.ENOTTY, errno.EBADF, errno.EPERM}
+
+_copy_methods = {} # (source device, destination device) -> first working method
+_copy_lock = threading.Lock()
+
+
+def _available(method):
+  if method == "reflink": return((fcntl is not None) and sys.platform.startswith("linux"))
+  if method == "copy_file_range": return(hasattr(os, "copy_file_range"))
+  if method == "sendfile": return(hasattr(os, "sendfile") and sys.platform.startswith("linux"))
+  return(True)
+
+
+def _copydata(src, dst, size, method):
+  # copy the content of file object <src> to <dst> using <method>
+
+  if method == "reflink":
+    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    return
+
+  # within a Scheduler, data is copied in small chunks charged to its limits
+  chunk = 1<<30
+  if getattr(_local, "scheduler", None) is not None: chunk = THROTTLE_CHUNK
+  copied = 0
+  if method == "copy_file_range":
+    while copied < size:
+      n = os.copy_file_range(src.fileno(), dst.fileno(), min(size-copied, chunk))
+      if n == 0: break
+      copied += n
+      _charge(n)
+  elif method == "sendfile":
+    while copied < size:
+      n = os.sendfile(dst.fileno(), src.fileno(), copied, min(size-copied, chunk))
+      if n == 0: break
+      copied += n
+      _charge(n)
+  else:
+    buf = bytearray(min(COPY_BUFSIZE, chunk))
+    view = memoryview(buf)
+    while True:
+      n = src.readinto(buf)
+      if not n: break
+      dst.write(view[:n])
+      copied += n
+      _charge(n)
+    return
+  # some file systems silently copy nothing, e.g. with copy_file_range
+  if copied < size: raise OSError(errno.ENOTSUP, method+" copied only part of the file")
+
+
+def copydata(sourcename, destname):
+  """ Copy the content of a file with the fastest method available
+
+  The methods in COPY_METHODS are tried in order: a reflink clone (btrfs, XFS),
+  os.copy_file_range(), os.sendfile() and finally a loop with a large buffer.
+  The first method that works is remembered for each pair of source and 
+  destination devices, so the detection is not repeated for every file.
+  Within a task of a Scheduler, the data is copied in chunks that are 
+  charged to its limits. No metadata is copied.
+
+  Parameters
+  ----------
+  sourcename: str
+    file to be copied
+  destname: str
+    exact file name, to which <sourcename> is copied
+
+  Returns
+  -------
+  method : str
+    the method that was used
+  size : int
+    number of bytes copied
+
+  """
+
+  with open(sourcename, "rb") as src, open(destname, "wb") as dst:
+    size = os.fstat(src.fileno()).st_size
+    key = (os.fstat(src.fileno()).st_dev, os.fstat(dst.fileno()).st_dev)
+    with _copy_lock: first = _copy_methods.get(key, 0)
+    for i in range(first, len(COPY_METHODS)):
+      method = COPY_METHODS[i]
+      if not _available(method): continue
+      try: _copydata(src, dst, size, method)
+      except OSError as err:
+        if (err.errno not in UNSUPPORTED) or (method == "readinto"): raise
+        src.seek(0); dst.seek(0); dst.truncate()
+        continue
+      if i != first:
+        with _copy_lock: _copy_methods[key] = i
+      return(method, size)
+
+
+TMP_SUFFIX = ".fsync_tmp"
+
+
+def tempname(destname):
+  # hidden file next to <destname>, to which it is written before being renamed
+
+  head, tail = os.path.split(destname)
+  return(os.path.join(head, "."+tail+TMP_SUFFIX))
+
+
+def _isTemp(name):
+  # whether <name> is a temporary file of tempname(), e.g. left by a killed copy
+
+  return(name.startswith(".") and name.endswith(TMP_SUFFIX))
+
+
+def _copy2(sourcename, destname):
+  # copy content and metadata like shutil.copy2, but with copydata() to a
+  # temporary file that is renamed into place
+
+  if os.path.isdir(destname): 
+    destname = os.path.join(destname, os.path.basename(sourcename))
+  tmpname = tempname(destname)
+  try:
+    copydata(sourcename, tmpname)
+    shutil.copystat(sourcename, tmpname)
+    os.replace(tmpname, destname)
+  except BaseException:
+    if os.path.lexists(tmpname): os.remove(tmpname)
+    raise
+  return(destname)
+
+
 def copyfile(sourcename, destname, logger=logging):
   """ Copy a file
 
+  The content is copied with copydata(), the metadata like in shutil.copy2().
+  Both are written to a temporary file (see tempname()), which is renamed to
+  <destname> once it is complete, so an interrupted copy never leaves a 
+  partial file under <destname>.
   Any exceptions are redirected to the logging module.
   Inconsequential metadata mismatch errors are not raised.
 
@@ -84,18 +680,252 @@ def copyfile(sourcename, destname, logger=logging):
   logger: logging.Logger
     Logger, to which potential errors and warnings are redirected 
 
+  Returns
+  -------
+  size : int
+    number of bytes copied
+
   """
 
-  try: shutil.copy2(sourcename,destname)
-  except OSError: 
-    if os.path.isfile(destname): 
+  if os.path.isdir(destname): 
+    destname = os.path.join(destname, os.path.basename(sourcename))
+  tmpname = tempname(destname)
+  try: 
+    _, size = copydata(sourcename, tmpname)
+    try: shutil.copystat(sourcename, tmpname)
+    except OSError: 
       print(" [WARNING] file metadata could not be copied")
-    else:
-      logger.debug(traceback.format_exc()+"\n")
-      raise
+    os.replace(tmpname, destname)
   except BaseException:
     logger.debug(traceback.format_exc()+"\n")
+    if os.path.lexists(tmpname): os.remove(tmpname)
     raise
+  return(size)
+
+
+MMAP_THRESHOLD = 64<<20 # files from this size are mapped into memory by hashcopy()
+
+
+def _readback(filename, digest):
+  # compare the hash of a file written just now, bypassing the page cache if possible
+
+  with open(filename, "rb") as fid:
+    os.fsync(fid.fileno())
+    if hasattr(os, "posix_fadvise"): 
+      os.posix_fadvise(fid.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+  if hashfile(filename) != digest:
+    raise OSError(errno.EIO, "Copy does not match its checksum", filename)
+
+
+def hashcopy(sourcename, destname, readback=False, logger=logging):
+  """ Copy a file like copyfile(), computing its hash from the copied data
+
+  The BLAKE2b hash (see hashfile()) is computed from the same buffers that are
+  written to <destname>, so no file is read twice. Files of at least 
+  MMAP_THRESHOLD bytes are mapped into memory instead of read into a buffer. 
+  If <readback>, the copy is read again before it is renamed into place, and 
+  an OSError is raised if it does not match. 
+
+  Parameters
+  ----------
+  sourcename: str
+    file to be copied
+  destname: str
+    exact file name, to which <sourcename> is copied
+  readback: bool
+    whether to verify the copy by reading it back
+  logger: logging.Logger
+    Logger, to which potential errors and warnings are redirected 
+
+  Returns
+  -------
+  size : int
+    number of bytes copied
+  digest : str
+    hash of the copied content
+
+  """
+
+  tmpname = tempname(destname)
+  digest = hashlib.blake2b()
+  chunk = COPY_BUFSIZE
+  if getattr(_local, "scheduler", None) is not None: chunk = THROTTLE_CHUNK
+  try:
+    size = 0
+    with open(sourcename, "rb") as src, open(tmpname, "wb") as dst:
+      if os.fstat(src.fileno()).st_size >= MMAP_THRESHOLD:
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+          for offset in range(0, len(mm), chunk):
+            with view[offset:offset+chunk] as block:
+              digest.update(block)
+              dst.write(block)
+              _charge(len(block))
+          size = len(mm)
+      else:
+        buf = bytearray(chunk)
+        view = memoryview(buf)
+        while True:
+          n = src.readinto(buf)
+          if not n: break
+          digest.update(view[:n])
+          dst.write(view[:n])
+          size += n
+          _charge(n)
+    digest = digest.hexdigest()
+    if readback: _readback(tmpname, digest)
+    try: shutil.copystat(sourcename, tmpname)
+    except OSError: 
+      print(" [WARNING] file metadata could not be copied")
+    os.replace(tmpname, destname)
+  except BaseException:
+    logger.debug(traceback.format_exc()+"\n")
+    if os.path.lexists(tmpname): os.remove(tmpname)
+    raise
+  return(size, digest)
+
+
+def copyfiles(sourcename, destnames, logger=logging):
+  """ Copy a file to several destinations, reading it only once
+
+  Each buffer read from <sourcename> is written to all <destnames>, so the 
+  source is read once no matter how many copies are made. Like in copyfile(),
+  every copy is written to a temporary file, which is renamed once it is 
+  complete, and the metadata is copied like in shutil.copy2().
+
+  Parameters
+  ----------
+  sourcename: str
+    file to be copied
+  destnames: list of str
+    exact file names, to which <sourcename> is copied
+  logger: logging.Logger
+    Logger, to which potential errors and warnings are redirected 
+
+  Returns
+  -------
+  size : int
+    number of bytes copied to each destination
+
+  """
+
+  if len(destnames) == 1: return(copyfile(sourcename, destnames[0], logger))
+  tmpnames = [tempname(destname) for destname in destnames]
+  dsts = []
+  try:
+    size = 0
+    with open(sourcename, "rb") as src:
+      dsts = [open(tmpname, "wb") for tmpname in tmpnames]
+      buf = bytearray(COPY_BUFSIZE)
+      if getattr(_local, "scheduler", None) is not None: buf = bytearray(THROTTLE_CHUNK)
+      view = memoryview(buf)
+      while True:
+        n = src.readinto(buf)
+        if not n: break
+        for dst in dsts: dst.write(view[:n])
+        size += n
+        _charge(n)
+      for dst in dsts: dst.close()
+    for tmpname, destname in zip(tmpnames, destnames):
+      try: shutil.copystat(sourcename, tmpname)
+      except OSError: 
+        print(" [WARNING] file metadata could not be copied")
+      os.replace(tmpname, destname)
+  except BaseException:
+    logger.debug(traceback.format_exc()+"\n")
+    for dst in dsts: dst.close()
+    for tmpname in tmpnames: 
+      if os.path.lexists(tmpname): os.remove(tmpname)
+    raise
+  return(size)
+
+
+def clonefile(sourcename, destname, logger=logging):
+  """ Clone a file as a reflink that shares its data blocks with the original
+
+  This only works on copy-on-write file systems (e.g. btrfs or XFS), where the
+  clone takes no time and space until either file is modified. The metadata 
+  is copied like in copyfile().
+
+  Parameters
+  ----------
+  sourcename: str
+    file to be cloned
+  destname: str
+    exact file name of the clone
+  logger: logging.Logger
+    Logger, to which potential errors and warnings are redirected
+
+  Returns
+  -------
+  cloned : bool
+    False if the file system does not support reflinks, in which case 
+    <destname> is not created.
+
+  """
+
+  if not _available("reflink"): return(False)
+  try:
+    with open(sourcename, "rb") as src, open(destname, "xb") as dst:
+      try: fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+      except OSError: 
+        cloned = False
+      else: cloned = True
+    if not cloned: 
+      os.remove(destname)
+      return(False)
+    shutil.copystat(sourcename, destname)
+  except BaseException:
+    logger.debug(traceback.format_exc()+"\n")
+    raise
+  return(True)
+
+
+def deltafile(sourcename, destname, block_size=1<<20, logger=logging):
+  """ Update a file in place, writing only the blocks that have changed
+
+  <destname> is compared to <sourcename> block by block and only differing 
+  blocks are overwritten, before its size and metadata are adjusted. This is 
+  much faster than a full copy for large files with few changes, e.g. VM 
+  images, as long as reading <destname> is cheaper than writing it.
+
+  Parameters
+  ----------
+  sourcename: str
+    file with the new content
+  destname: str
+    existing file, which is updated to match <sourcename>
+  block_size: int
+    size of the compared blocks in bytes
+  logger: logging.Logger
+    Logger, to which potential errors and warnings are redirected
+
+  Returns
+  -------
+  written : int
+    number of bytes written to <destname>
+
+  """
+
+  written = 0
+  try:
+    with open(sourcename, "rb") as src, open(destname, "r+b") as dst:
+      offset = 0
+      while True:
+        block = src.read(block_size)
+        if not block: break
+        _charge(len(block))
+        dst.seek(offset)
+        if dst.read(len(block)) != block:
+          dst.seek(offset)
+          dst.write(block)
+          written += len(block)
+        offset += len(block)
+      dst.truncate(offset)
+    shutil.copystat(sourcename, destname)
+  except BaseException:
+    logger.debug(traceback.format_exc()+"\n")
+    raise
+  return(written)
 
 
 def movefile(sourcename, destname, logger=logging):
@@ -137,7 +967,7 @@ def copytree(sourcename, destname, logger=logging):
 
   """
 
-  try: shutil.copytree(sourcename, destname)
+  try: shutil.copytree(sourcename, destname, copy_function=_copy2)
   except OSError: 
     msg = """
 ------------------- WARNING -------------------
@@ -222,6 +1052,456 @@ def relDirsFiles(fullpath):
   return(folderlist, filelist)
 
 
+Entry = namedtuple("Entry", ["path", "size", "mtime_ns", "inode", "is_dir"])
+
+
+class FileTable:
+  """ Compact table of the file entries of a directory tree
+
+  Instead of one Entry object and one full relative path per file, directory 
+  prefixes are stored once and referenced by index, and sizes, modification 
+  times, inodes and flags are kept in typed arrays, so a file costs little more
+  than its name. Entries can be appended in any order. Lookups by relative path 
+  use a binary search over an index sorted by directory and name, which is 
+  built on the first lookup after an append.
+
+  Parameters
+  ----------
+  entries : iterable of Entry
+    initial entries of the table, e.g. from scanTree()
+
+  """
+
+  def __init__(self, entries=()):
+    self.dirs = []
+    self.dir_ids = {}
+    self.names = []
+    self.dir = array("I")
+    self.size = array("q")
+    self.mtime_ns = array("q")
+    self.inode = array("Q")
+    self.flags = array("B")
+    self.order = None
+    for entry in entries: self.append(entry)
+
+  def append(self, entry):
+    folder, sep, name = entry.path.rpartition(os.sep)
+    folder += sep
+    dir_id = self.dir_ids.get(folder)
+    if dir_id is None:
+      dir_id = self.dir_ids[folder] = len(self.dirs)
+      self.dirs.append(sys.intern(folder))
+    self.names.append(name)
+    self.dir.append(dir_id)
+    self.size.append(entry.size)
+    self.mtime_ns.append(entry.mtime_ns)
+    self.inode.append(entry.inode)
+    self.flags.append(int(entry.is_dir))
+    self.order = None
+
+  def __len__(self):
+    return(len(self.names))
+
+  def __getitem__(self, row):
+    return(Entry(self.path(row), self.size[row], self.mtime_ns[row], 
+                 self.inode[row], bool(self.flags[row])))
+
+  def __iter__(self):
+    for row in range(len(self.names)): yield(self[row])
+
+  def __contains__(self, path):
+    return(self.find(path) >= 0)
+
+  def path(self, row):
+    return(self.dirs[self.dir[row]]+self.names[row])
+
+  def key(self, row):
+    # sort key of a row: directory prefix and name
+    return((self.dirs[self.dir[row]], self.names[row]))
+
+  def sorted_rows(self):
+    # row numbers ordered by directory prefix and name
+
+    if self.order is None:
+      self.order = array("I", sorted(range(len(self.names)), key=self.key))
+    return(self.order)
+
+  def find(self, path):
+    # row number of the entry with relative <path>, or -1 if there is none
+
+    folder, sep, name = path.rpartition(os.sep)
+    key = (folder+sep, name)
+    order = self.sorted_rows()
+    i = bisect.bisect_left(order, key, key=self.key)
+    if (i < len(order)) and (self.key(order[i]) == key): return(order[i])
+    return(-1)
+
+  def get(self, path, default=None):
+    row = self.find(path)
+    if row < 0: return(default)
+    return(self[row])
+
+
+def diffTables(src_table, dst_table, tolerance=1):
+  """ Classify the entries of a source and a destination FileTable
+
+  Counterpart of diffFiles() for FileTables. Both tables are walked once in 
+  their sorted order, and row numbers instead of paths are returned, so the 
+  result stays small for trees with many unchanged files.
+
+  Parameters
+  ----------
+  src_table : FileTable
+    entries of the source directory
+  dst_table : FileTable
+    entries of the destination directory
+  tolerance : float
+    number of seconds by which a source file has to be newer than its 
+    counterpart in the destination to be considered changed
+
+  Returns
+  -------
+  new_rows : array of int
+    rows of <src_table> that only exist in the source, in table order
+  changed_rows : array of int
+    rows of <src_table> that are newer in the source
+  unchanged_rows : array of int
+    rows of <src_table> that exist in both and are not newer in the source
+  deleted_rows : array of int
+    rows of <dst_table> that only exist in the destination, in table order
+
+  """
+
+  src_order = src_table.sorted_rows(); dst_order = dst_table.sorted_rows()
+  tolerance_ns = tolerance*1e9
+  new_rows = array("I"); changed_rows = array("I"); unchanged_rows = array("I")
+  deleted_rows = array("I")
+  i = j = 0
+  while (i < len(src_order)) or (j < len(dst_order)):
+    src = src_order[i] if i < len(src_order) else None
+    dst = dst_order[j] if j < len(dst_order) else None
+    src_key = src_table.key(src) if src is not None else None
+    dst_key = dst_table.key(dst) if dst is not None else None
+    if (dst is None) or ((src is not None) and (src_key < dst_key)):
+      new_rows.append(src); i += 1
+    elif (src is None) or (dst_key < src_key):
+      deleted_rows.append(dst); j += 1
+    else:
+      if src_table.mtime_ns[src] > dst_table.mtime_ns[dst] + tolerance_ns: 
+        changed_rows.append(src)
+      else: unchanged_rows.append(src)
+      i += 1; j += 1
+
+  return(array("I", sorted(new_rows)), array("I", sorted(changed_rows)), 
+         array("I", sorted(unchanged_rows)), array("I", sorted(deleted_rows)))
+
+
+SIZE_UNITS = {"": 1, "k": 1<<10, "M": 1<<20, "G": 1<<30, "T": 1<<40}
+AGE_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+PREDICATE = re.compile(r"^(size|age)\s*([<>])\s*(\d+(?:\.\d*)?)\s*([kMGTsmhdw]?)$")
+
+
+def _globRegex(pattern):
+  # regular expression of a gitignore-style glob without "!" and trailing "/"
+
+  anchored = "/" in pattern
+  if pattern.startswith("/"): pattern = pattern[1:]
+  regex = ""; i = 0
+  while i < len(pattern):
+    if pattern.startswith("**/", i): regex += "(?:.*/)?"; i += 3
+    elif pattern.startswith("**", i): regex += ".*"; i += 2
+    elif pattern[i] == "*": regex += "[^/]*"; i += 1
+    elif pattern[i] == "?": regex += "[^/]"; i += 1
+    elif (pattern[i] == "[") and ("]" in pattern[i+2:]):
+      j = pattern.index("]", i+2)
+      chars = pattern[i+1:j].replace("\\", "\\\\")
+      if chars[0] == "!": chars = "^"+chars[1:]
+      regex += "["+chars+"]"; i = j+1
+    else: regex += re.escape(pattern[i]); i += 1
+  if not anchored: regex = "(?:.*/)?"+regex
+  return(regex)
+
+
+class Filter:
+  """ Compiled gitignore-style rules that exclude entries from a directory tree
+
+  Each rule is a glob pattern, and the last rule matching an entry decides:
+  entries matching a plain pattern are excluded, those matching a pattern 
+  with a leading "!" are included again. Like in .gitignore files,
+
+  - "*" matches anything but "/", "?" one character and "[abc]" a class
+  - "**" matches across directories, e.g. "**/cache" or "logs/**"
+  - a pattern with a "/" is relative to the root of the tree, one without 
+    matches the name of an entry at any depth, e.g. "node_modules"
+  - a trailing "/" only matches directories, e.g. "build/"
+  - blank lines and lines starting with "#" are ignored
+
+  A rule matching a directory excludes its whole subtree, which scanTree() and
+  walkSorted() then never enter. Rules like "size>100M" or "age<1h" (units k,
+  M, G, T and s, m, h, d, w) exclude files by their size or time since their
+  last modification and are checked once they are stat'ed. Paths always use 
+  "/" within the rules.
+
+  All glob rules are compiled into a single regular expression for files and
+  one for directories, so the cost of a check hardly depends on the number of
+  rules. A Filter of a subtree (see subtree()) applies the same rules with 
+  paths relative to the root of the whole tree.
+
+  Parameters
+  ----------
+  rules : iterable of str
+    rules in the order of their precedence (the last one wins)
+  filename : str or None
+    file with one rule per line, which are applied after <rules>
+
+  """
+
+  def __init__(self, rules=(), filename=None):
+    rules = list(rules)
+    if filename is not None:
+      with open(filename) as fid: rules += fid.read().splitlines()
+    self.rules = []
+    self.predicates = []
+    self.prefix = ""
+    globs = []; now = time.time_ns()
+    for line in rules:
+      rule = line.strip()
+      if (not rule) or rule.startswith("#"): continue
+      include = rule.startswith("!")
+      if include: rule = rule[1:]
+      elif rule.startswith("\\"): rule = rule[1:]
+      self.rules.append(("!" if include else "")+rule)
+      index = len(self.rules)-1
+      match = PREDICATE.match(rule)
+      if match is not None:
+        kind, op, value, unit = match.groups()
+        units = SIZE_UNITS if kind == "size" else AGE_UNITS
+        if unit not in units: raise ValueError("Invalid unit in filter rule "+line)
+        if kind == "size": limit = float(value)*units[unit]
+        else: limit = now-float(value)*units[unit]*1e9
+        self.predicates.append((index, include, kind, op, limit))
+        continue
+      dirs_only = rule.endswith("/")
+      globs.append((index, include, dirs_only, _globRegex(rule.rstrip("/"))))
+
+    # the last matching rule is the first alternative in reversed order
+    globs.reverse()
+    self._globs = [(index, include) for index, include, _, _ in globs]
+    self._dirs = re.compile("|".join("("+regex+")(?:/.*)?" for _, _, _, regex in globs) or "(?!)")
+    self._files = re.compile("|".join("("+regex+(")/.*" if dirs_only else ")(?:/.*)?")
+                                      for _, _, dirs_only, regex in globs) or "(?!)")
+
+  def _predicate(self, kind, op, limit, stat):
+    # whether a size or age rule matches the os.stat_result or Entry <stat>
+
+    if isinstance(stat, Entry): value = stat.size if kind == "size" else stat.mtime_ns
+    else: value = stat.st_size if kind == "size" else stat.st_mtime_ns
+    # a file is older than an age if it was modified before the limit
+    if kind == "age": op = "<" if op == ">" else ">"
+    return(value > limit if op == ">" else value < limit)
+
+  def excluded(self, path, is_dir=False, stat=None):
+    """ Whether an entry of the tree is excluded by the rules
+
+    Parameters
+    ----------
+    path : str
+      path of the entry relative to the root of the tree
+    is_dir : bool
+      whether the entry is a directory
+    stat : os.stat_result, Entry or None
+      metadata of a file for the size and age rules, which are ignored if None
+
+    """
+
+    if os.sep != "/": path = path.replace(os.sep, "/")
+    path = self.prefix+path
+    match = (self._dirs if is_dir else self._files).fullmatch(path)
+    index, exclude = -1, False
+    if match is not None: 
+      index, include = self._globs[match.lastindex-1]
+      exclude = not include
+    if (stat is not None) and not is_dir:
+      for i, include, kind, op, limit in reversed(self.predicates):
+        if i < index: break
+        if self._predicate(kind, op, limit, stat): return(not include)
+    return(exclude)
+
+  def key(self):
+    # digest of the rules and prefix, which changes whenever the Filter would
+    # exclude other entries (apart from the passing of time in age rules)
+
+    return(hashlib.blake2b(("\n".join(self.rules)+"\0"+self.prefix).encode(
+      errors="surrogateescape"), digest_size=16).hexdigest())
+
+  def subtree(self, folder):
+    """ Filter with the same rules for the entries of the subdirectory <folder>
+
+    Its paths are matched as <folder>/path, so a rule like "/docs/" means the 
+    same in the subtree as in the whole tree.
+
+    """
+
+    sub = copy.copy(self)
+    sub.prefix = self.prefix+folder.replace(os.sep, "/").strip("/")+"/"
+    return(sub)
+
+
+def scanTree(fullpath, include_subdirs=True, prune=None, filter=None):
+  """ Walk a directory tree and yield the metadata of every entry
+
+  Directories are walked iteratively and in the same order as relDirsFiles(),
+  using os.scandir() so that each entry is stat'ed exactly once. Entries that 
+  vanish while the tree is walked and the temporary files of interrupted 
+  copies (see tempname()) are skipped.
+
+  Parameters
+  ----------
+  fullpath : str
+    path to the folder whose contents are listed
+  include_subdirs : bool
+    whether to walk the whole directory tree or just the root directory
+  prune : set of str or None
+    relative paths of directories that are yielded, but not walked (see 
+    TreeSummary)
+  filter : Filter or None
+    rules excluding entries, which are neither yielded nor walked. Entries 
+    excluded by their path are not even stat'ed.
+
+  Yields
+  ------
+  entry : Entry
+    (path, size, mtime_ns, inode, is_dir) record, where path is relative to
+    <fullpath>
+
+  """
+
+  if fullpath[-1] != os.sep: fullpath += os.sep
+
+  queue = deque([""])
+  while queue:
+    folder = queue.popleft()
+    with os.scandir(fullpath+folder) as it: lsdir = sorted(it, key=lambda e: e.name)
+    for obj in lsdir:
+      if _isTemp(obj.name): continue
+      try:
+        is_dir = obj.is_dir()
+        early = (filter is not None) and (is_dir or not filter.predicates)
+        if early and filter.excluded(folder+obj.name, is_dir): continue
+        stat = obj.stat()
+      except FileNotFoundError: continue
+      if (filter is not None) and (not early) and filter.excluded(folder+obj.name, is_dir, stat):
+        continue
+      if is_dir and include_subdirs and ((prune is None) or (folder+obj.name not in prune)): 
+        queue.append(folder+obj.name+os.sep)
+      yield Entry(folder+obj.name, stat.st_size, stat.st_mtime_ns, stat.st_ino, is_dir)
+
+
+def walkSorted(fullpath, include_subdirs=True, filter=None):
+  """ Walk a directory tree depth-first in sorted order
+
+  Unlike scanTree(), every directory is immediately followed by its contents,
+  so the entries come out ordered by their path components and two trees can 
+  be compared with mergeDiff() without keeping their listings in memory. Only
+  the listings of the directories on the current path are held at any time.
+
+  Parameters
+  ----------
+  fullpath : str
+    path to the folder whose contents are listed
+  include_subdirs : bool
+    whether to walk the whole directory tree or just the root directory
+  filter : Filter or None
+    rules excluding entries like in scanTree()
+
+  Yields
+  ------
+  entry : Entry
+    (path, size, mtime_ns, inode, is_dir) record, where path is relative to
+    <fullpath>
+
+  """
+
+  if fullpath[-1] != os.sep: fullpath += os.sep
+
+  with os.scandir(fullpath) as it: lsdir = sorted(it, key=lambda e: e.name)
+  stack = [("", iter(lsdir))]
+  while stack:
+    folder, lsdir = stack[-1]
+    obj = next(lsdir, None)
+    if obj is None:
+      stack.pop()
+      continue
+    if _isTemp(obj.name): continue
+    try:
+      is_dir = obj.is_dir()
+      early = (filter is not None) and (is_dir or not filter.predicates)
+      if early and filter.excluded(folder+obj.name, is_dir): continue
+      stat = obj.stat()
+    except FileNotFoundError: continue
+    if (filter is not None) and (not early) and filter.excluded(folder+obj.name, is_dir, stat):
+      continue
+    yield Entry(folder+obj.name, stat.st_size, stat.st_mtime_ns, stat.st_ino, is_dir)
+    if not (is_dir and include_subdirs): continue
+    # the directory may have been removed (or replaced by a file) since
+    try:
+      with os.scandir(obj.path) as it: lsdir = sorted(it, key=lambda e: e.name)
+    except (FileNotFoundError, NotADirectoryError): continue
+    stack.append((folder+obj.name+os.sep, iter(lsdir)))
+
+
+def mergeDiff(src_entries, dst_entries, tolerance=1):
+  """ Classify the entries of two sorted walks in a single merge pass
+
+  Streaming counterpart of diffFiles() for the output of walkSorted(). A path
+  that is a directory on one side and a file on the other is reported as 
+  deleted and then as new.
+
+  Parameters
+  ----------
+  src_entries : iterable of Entry
+    entries of the source directory, as yielded by walkSorted()
+  dst_entries : iterable of Entry
+    entries of the destination directory, as yielded by walkSorted()
+  tolerance : float
+    number of seconds by which a source file has to be newer than its 
+    counterpart in the destination to be considered changed
+
+  Yields
+  ------
+  status : str
+    "new", "changed", "unchanged" or "deleted"
+  src_entry : Entry or None
+  dst_entry : Entry or None
+
+  """
+
+  def _next(entries):
+    entry = next(entries, None)
+    if entry is None: return(None, None)
+    return(entry, entry.path.split(os.sep))
+
+  src_entries = iter(src_entries); dst_entries = iter(dst_entries)
+  src, src_key = _next(src_entries)
+  dst, dst_key = _next(dst_entries)
+  while (src is not None) or (dst is not None):
+    if (dst is None) or ((src is not None) and (src_key < dst_key)):
+      yield("new", src, None)
+      src, src_key = _next(src_entries)
+    elif (src is None) or (dst_key < src_key):
+      yield("deleted", None, dst)
+      dst, dst_key = _next(dst_entries)
+    else:
+      if src.is_dir != dst.is_dir:
+        yield("deleted", None, dst)
+        yield("new", src, None)
+      elif (not src.is_dir) and (src.mtime_ns > dst.mtime_ns + tolerance*1e9):
+        yield("changed", src, dst)
+      else: yield("unchanged", src, dst)
+      src, src_key = _next(src_entries)
+      dst, dst_key = _next(dst_entries)
+
+
 def recDirsFiles(fullpath):
   """ List the whole directory tree and all files contained in a directory
 
@@ -245,3 +1525,237 @@ def recDirsFiles(fullpath):
 
   return(folderlist, filelist)
 
+
+
+# ----- File System Watchers ----- #
+
+class Inotify:
+  """ Report changes in a directory tree using the Linux inotify API
+
+  Every directory of the tree is watched, including directories created later.
+  
+  Parameters
+  ----------
+  fullpath : str
+    path to the folder whose contents are watched
+
+  """
+
+  IN_MODIFY = 0x2; IN_ATTRIB = 0x4; IN_CLOSE_WRITE = 0x8
+  IN_MOVED_FROM = 0x40; IN_MOVED_TO = 0x80; IN_CREATE = 0x100; IN_DELETE = 0x200
+  IN_Q_OVERFLOW = 0x4000; IN_IGNORED = 0x8000; IN_ISDIR = 0x40000000
+  MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO 
+          | IN_CREATE | IN_DELETE)
+  IN_NONBLOCK = 0o4000; IN_CLOEXEC = 0o2000000
+
+  def __init__(self, fullpath):
+    if not sys.platform.startswith("linux"): raise OSError("inotify requires Linux")
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+    if self.fd < 0: raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    if fullpath[-1] != os.sep: fullpath += os.sep
+    self.fullpath = fullpath
+    self.folders = {}
+    self._watch_tree("")
+
+  def _watch_tree(self, folder):
+    # add watches to <folder> and all its subdirectories
+
+    for dirpath, dirnames, _ in os.walk(self.fullpath+folder):
+      wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.MASK)
+      if wd < 0: continue
+      rel = os.path.relpath(dirpath, self.fullpath)
+      self.folders[wd] = "" if rel == "." else rel+os.sep
+
+  def read(self, timeout=1):
+    """ Wait up to <timeout> seconds and return the set of changed relative paths
+
+    Returns None if events were lost, in which case the whole tree has to be
+    compared again.
+
+    """
+
+    changed = set()
+    if not select.select([self.fd], [], [], timeout)[0]: return(changed)
+    while True:
+      try: data = os.read(self.fd, 1<<16)
+      except BlockingIOError: break
+      pos = 0
+      while pos < len(data):
+        wd, mask, _, length = struct.unpack_from("iIII", data, pos)
+        name = os.fsdecode(data[pos+16:pos+16+length].rstrip(b"\0"))
+        pos += 16 + length
+        if mask & self.IN_Q_OVERFLOW: return(None)
+        if mask & self.IN_IGNORED: 
+          self.folders.pop(wd, None)
+          continue
+        if (wd not in self.folders) or (name == ""): continue
+        path = self.folders[wd]+name
+        changed.add(path)
+        if (mask & self.IN_ISDIR) and (mask & (self.IN_CREATE | self.IN_MOVED_TO)): 
+          self._watch_tree(path)
+    return(changed)
+
+  def close(self):
+    os.close(self.fd)
+
+
+class PollWatcher:
+  """ Report changes in a directory tree by comparing repeated scans
+
+  Fallback for Inotify on systems without inotify. Every call of read() walks
+  the whole tree with scanTree().
+
+  """
+
+  def __init__(self, fullpath):
+    self.fullpath = fullpath
+    self.state = self._scan()
+
+  def _scan(self):
+    return({e.path: (e.size, e.mtime_ns, e.is_dir) for e in scanTree(self.fullpath)})
+
+  def read(self, timeout=1):
+    """ Wait <timeout> seconds and return the set of changed relative paths """
+
+    time.sleep(timeout)
+    state = self._scan()
+    changed = {path for path in state.keys() | self.state.keys() 
+               if state.get(path) != self.state.get(path)}
+    self.state = state
+    return(changed)
+
+  def close(self):
+    pass
+
+
+def watchTree(fullpath):
+  """ Watch a directory tree with Inotify if possible, otherwise PollWatcher """
+
+  try: return(Inotify(fullpath))
+  except (OSError, AttributeError): return(PollWatcher(fullpath))
+
+
+
+# ----- Asynchronous I/O ----- #
+
+class AsyncIO:
+  """ Runs blocking file system calls from asyncio with many of them in flight
+
+  On network mounts (SMB, NFS), every stat, listing and open waits for a round 
+  trip to the server. Each call is run in a thread of its own pool, so up to 
+  <limit> of these round trips overlap, while the event loop keeps scheduling 
+  further calls. Use it as an async context manager or call close().
+
+  Parameters
+  ----------
+  limit : int
+    maximum number of calls in flight
+
+  """
+
+  def __init__(self, limit=32):
+    self.limit = limit
+    self.semaphore = asyncio.Semaphore(limit)
+    self.pool = ThreadPoolExecutor(limit)
+
+  async def run(self, func, *args, **kwargs):
+    # result of func(*args, **kwargs), called in a thread of the pool
+
+    async with self.semaphore:
+      loop = asyncio.get_running_loop()
+      return(await loop.run_in_executor(self.pool, partial(func, *args, **kwargs)))
+
+  def close(self):
+    self.pool.shutdown(wait=True)
+
+  async def __aenter__(self):
+    return(self)
+
+  async def __aexit__(self, *exc):
+    self.close()
+
+
+async def scanTreeAsync(fullpath, include_subdirs=True, aio=None):
+  """ Asynchronous scanTree(), listing all directories of a level concurrently
+
+  Parameters
+  ----------
+  fullpath : str
+    path to the folder whose contents are listed
+  include_subdirs : bool
+    whether to walk the whole directory tree or just the root directory
+  aio : AsyncIO or None
+    runner of the blocking calls, by default a new one with 32 calls in flight
+
+  Returns
+  -------
+  entries : list of Entry
+    the entries of scanTree(), in the same order
+
+  """
+
+  if aio is None:
+    async with AsyncIO() as aio: return(await scanTreeAsync(fullpath, include_subdirs, aio))
+  if fullpath[-1] != os.sep: fullpath += os.sep
+
+  # breadth-first like scanTree(), so the levels can be concatenated in order
+  entries = []
+  level = [""]
+  while level:
+    listings = await asyncio.gather(*[aio.run(_listEntries, fullpath, folder) 
+                                      for folder in level])
+    level = []
+    for listing in listings:
+      entries += listing
+      if include_subdirs: level += [e.path+os.sep for e in listing if e.is_dir]
+  return(entries)
+
+
+def _listEntries(fullpath, folder):
+  # entries of a single directory of scanTree() with paths relative to <fullpath>
+
+  try: 
+    return([entry._replace(path=folder+entry.path) 
+            for entry in scanTree(fullpath+folder, False)])
+  except FileNotFoundError: return([])
+
+
+async def runTasksAsync(tasks, aio, logger=logging):
+  """ Asynchronous runTasks(), yielding the results of blocking tasks in order
+
+  Each task is called with its own LogBuffer in a thread of <aio>, and the 
+  buffers are flushed to <logger> in the order of <tasks>. At most 
+  2*<aio.limit> tasks are pending at any time.
+
+  Parameters
+  ----------
+  tasks : iterable of callable
+    functions taking a logger as their only argument
+  aio : AsyncIO
+    runner of the tasks
+  logger : logging.Logger
+    Logger, to which the messages of all tasks are redirected
+
+  Yields
+  ------
+  result : object
+    return value of each task, in the order of <tasks>
+
+  """
+
+  pending = deque()
+  tasks = iter(tasks)
+  try:
+    while True:
+      for task in tasks:
+        buf = LogBuffer()
+        pending.append((asyncio.ensure_future(aio.run(task, buf)), buf))
+        if len(pending) >= 2*aio.limit: break
+      if not pending: break
+      future, buf = pending.popleft()
+      try: result = await future
+      finally: buf.flush(logger)
+      yield(result)
+  finally:
+    for future, buf in pending: future.cancel()
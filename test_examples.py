@@ -28,11 +28,13 @@ SOFTWARE.
 
 
 
-import os, sys
+import os, sys, errno
 sys.path.append("examples")
 import futil
 import fsync
 from time import sleep
+from threading import Event
+import asyncio, time, sqlite3
 
 
 
@@ -122,3 +124,737 @@ def test_projects():
     update_files(i)
     sync_projects()
     sleep(2)
+
+def test_diff_files():
+  src_files = ["a.txt", "ab.txt", "sub"+os.sep+"c.txt"]
+  dst_files = ["sub"+os.sep+"c.txt", "a.txt", "old.txt"]
+  new, changed, unchanged, deleted = futil.diffFiles(
+    src_files, [10., 20., 30.], dst_files, [30., 5., 1.])
+  assert new == ["ab.txt"]
+  assert changed == ["a.txt"]
+  assert unchanged == ["sub"+os.sep+"c.txt"]
+  assert deleted == ["old.txt"]
+
+def test_file_table():
+  src_files = ["a.txt", "ab.txt", "sub"+os.sep+"c.txt"]
+  dst_files = ["sub"+os.sep+"c.txt", "a.txt", "old.txt"]
+  src = futil.FileTable(futil.Entry(f, 1, int(t*1e9), 0, False) 
+                        for f, t in zip(src_files, [10., 20., 30.]))
+  dst = futil.FileTable(futil.Entry(f, 1, int(t*1e9), 0, False) 
+                        for f, t in zip(dst_files, [30., 5., 1.]))
+  assert [e.path for e in src] == src_files
+  assert src.get("sub"+os.sep+"c.txt").mtime_ns == 30*10**9
+  assert ("c.txt" not in src) and (src.find("sub") == -1)
+  assert src.dirs == ["", "sub"+os.sep]
+  new, changed, unchanged, deleted = futil.diffTables(src, dst)
+  assert [src.path(row) for row in new] == ["ab.txt"]
+  assert [src.path(row) for row in changed] == ["a.txt"]
+  assert [src.path(row) for row in unchanged] == ["sub"+os.sep+"c.txt"]
+  assert [dst.path(row) for row in deleted] == ["old.txt"]
+
+def test_scan_tree():
+  reset()
+  root = "examples"+os.sep+"local"
+  folders, files = futil.relDirsFiles(root)
+  entries = list(futil.scanTree(root))
+  assert [e.path for e in entries if e.is_dir] == folders
+  assert [e.path for e in entries if not e.is_dir] == files
+  file = [e for e in entries if not e.is_dir][0]
+  assert file.mtime_ns == os.stat(root+os.sep+file.path).st_mtime_ns
+  assert all(os.sep not in e.path for e in futil.scanTree(root, False))
+
+def test_manifest():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  dst = "examples"+os.sep+"external"+os.sep+"Projects"
+  db = dst+"_fsync.db"
+  fsync.sync_directory(src, dst, manifest=db)
+  entries = fsync.dst_manifest(db, dst).listing()
+  assert sorted(e.path for e in entries) == sorted(futil.relDirsFiles(src)[1])
+
+  # files removed behind fsync's back are only restored by a verified run
+  lost = dst+os.sep+entries[0].path
+  os.remove(lost)
+  fsync.sync_directory(src, dst, manifest=db)
+  assert not os.path.isfile(lost)
+  fsync.sync_directory(src, dst, manifest=db, verify=True)
+  assert os.path.isfile(lost)
+  os.remove(db)
+
+def test_parallel_workers():
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  dst = "examples"+os.sep+"external"+os.sep+"Projects"
+  bak = "examples"+os.sep+"external"+os.sep+".Projects"
+  logs = []
+  for workers in [1, 4]:
+    reset()
+    fsync.sync_directory(src, dst, bak, workers=workers)
+    update_files(1)
+    for file in futil.relDirsFiles(src)[1]:
+      os.utime(src+os.sep+file, (2e9, 2e9))
+    log = futil.LogBuffer()
+    fsync.sync_directory(src, dst, bak, workers=workers, logger=log)
+    logs.append([msg for _, msg in log.records])
+    for file in futil.relDirsFiles(src)[1]:
+      with open(dst+os.sep+file) as fid: assert fid.read() == "this is version 1\n"
+  assert logs[0] == logs[1]
+
+def test_file_to_folder():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  dst = "examples"+os.sep+"external"+os.sep+"Projects"
+  bak = "examples"+os.sep+"external"+os.sep+".Projects"
+  fsync.sync_directory(src, dst, bak)
+
+  # a file replaced by a folder of the same name is moved to BAK first
+  os.remove(src+os.sep+"Project0"+os.sep+"file0.dat")
+  os.makedirs(src+os.sep+"Project0"+os.sep+"file0.dat")
+  with open(src+os.sep+"Project0"+os.sep+"file0.dat"+os.sep+"y", "w") as fid: fid.write("y")
+  fsync.sync_directory(src, dst, bak, sync_deleted=True, workers=4)
+  assert futil.relDirsFiles(src)[1] == futil.relDirsFiles(dst)[1]
+  assert os.path.isfile(bak+os.sep+"Project0"+os.sep+"file0.dat")
+
+  # also when only the changed paths are synchronized
+  os.remove(src+os.sep+"Project1"+os.sep+"file1.dat")
+  os.makedirs(src+os.sep+"Project1"+os.sep+"file1.dat")
+  with open(src+os.sep+"Project1"+os.sep+"file1.dat"+os.sep+"y", "w") as fid: fid.write("y")
+  fsync.sync_paths(src, dst, ["Project1"+os.sep+"file1.dat"], bak, sync_deleted=True)
+  assert futil.relDirsFiles(src)[1] == futil.relDirsFiles(dst)[1]
+  assert os.path.isfile(bak+os.sep+"Project1"+os.sep+"file1.dat")
+
+  # and when the folders are created asynchronously
+  os.remove(src+os.sep+"Project_old"+os.sep+"file0.dat")
+  os.makedirs(src+os.sep+"Project_old"+os.sep+"file0.dat")
+  with open(src+os.sep+"Project_old"+os.sep+"file0.dat"+os.sep+"y", "w") as fid: fid.write("y")
+  asyncio.run(fsync.sync_directory_async(src, dst, bak, sync_deleted=True, workers=4))
+  assert futil.relDirsFiles(src)[1] == futil.relDirsFiles(dst)[1]
+  assert os.path.isfile(bak+os.sep+"Project_old"+os.sep+"file0.dat")
+
+def test_streaming():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  dst = "examples"+os.sep+"external"+os.sep+"Projects"
+  bak = "examples"+os.sep+"external"+os.sep+".Projects"
+  entries = list(futil.walkSorted(src))
+  assert sorted(e.path.split(os.sep) for e in entries) == [e.path.split(os.sep) for e in entries]
+  assert sorted(e.path for e in entries) == sorted(e.path for e in futil.scanTree(src))
+
+  fsync.sync_directory(src, dst, bak)
+  update_files(1)
+  files = futil.relDirsFiles(src)[1]
+  for file in files[1:]: os.utime(src+os.sep+file, (2e9, 2e9))
+  os.makedirs(src+os.sep+"New"+os.sep+"Sub")
+  with open(src+os.sep+"New"+os.sep+"Sub"+os.sep+"file.txt", "w") as fid: fid.write("new\n")
+  report = fsync.sync_directory(src, dst, bak, streaming=True, workers=2)
+  assert report["counts"]["changed"] == len(files)-1
+  assert report["counts"]["unchanged"] == 1
+  assert report["counts"]["new"] == 1
+  assert futil.relDirsFiles(src) == futil.relDirsFiles(dst)
+  for file in files[1:]:
+    with open(dst+os.sep+file) as fid: assert fid.read() == "this is version 1\n"
+
+  # files replaced by folders and folders replaced by files
+  os.remove(src+os.sep+"Project0"+os.sep+"file0.dat")
+  os.makedirs(src+os.sep+"Project0"+os.sep+"file0.dat")
+  with open(src+os.sep+"Project0"+os.sep+"file0.dat"+os.sep+"y", "w") as fid: fid.write("y")
+  futil.removetree(src+os.sep+"Project1"+os.sep+"Data")
+  with open(src+os.sep+"Project1"+os.sep+"Data", "w") as fid: fid.write("data\n")
+  report = fsync.sync_directory(src, dst, bak, sync_deleted=True, streaming=True, workers=4)
+  assert futil.relDirsFiles(src) == futil.relDirsFiles(dst)
+  with open(dst+os.sep+"Project1"+os.sep+"Data") as fid: assert fid.read() == "data\n"
+  assert report["counts"]["deleted"] == 3
+  assert os.path.isfile(bak+os.sep+"Project0"+os.sep+"file0.dat")
+
+def test_parallel_projects():
+  reset()
+  projects = fsync.job("projects", "examples"+os.sep+"local"+os.sep+"Projects",
+                       "examples"+os.sep+"external"+os.sep+"Projects", 
+                       "examples"+os.sep+"external"+os.sep+".Projects", manifest=True)
+  events = []
+  sync_project = projects._sync_project
+  def logged(project, *args):
+    events.append(("start", project))
+    try: return(sync_project(project, *args))
+    finally: events.append(("end", project))
+  projects._sync_project = logged
+  summary = projects.sync_individual(parallel=3)
+  del projects._sync_project
+  assert {project: report["ok"] for project, report in summary.items()} == \
+    {".": True, "Project0": True, "Project1": True, "Project_old": True}
+  # the root directory creates the new DST before the others start
+  assert events[:2] == [("start", "."), ("end", ".")]
+  futil.removetree(projects.SRC+os.sep+"Project1")
+  futil.removetree(projects.DST+os.sep+"Project0"+os.sep+"Data")
+  with open(projects.DST+os.sep+"Project0"+os.sep+"Data", "w") as fid: pass
+  summary = projects.sync_individual(parallel=3)
+  assert {project: report["ok"] for project, report in summary.items()} == \
+    {".": True, "Project0": False, "Project_old": True}
+  os.remove(projects.manifest_file())
+
+def test_delta_transfer():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Data Source"
+  dst = "examples"+os.sep+"external"+os.sep+"Data"
+  bak = "examples"+os.sep+"external"+os.sep+".Data"
+  old = os.urandom(3<<20)
+  with open(src+os.sep+"image.bin", "wb") as fid: fid.write(old)
+  fsync.sync_directory(src, dst)
+
+  new = old[:1000] + b"changed" + old[1007:] + b"appended"
+  with open(src+os.sep+"image.bin", "wb") as fid: fid.write(new)
+  os.utime(src+os.sep+"image.bin", (2e9, 2e9))
+  assert futil.deltafile(src+os.sep+"image.bin", dst+os.sep+"image.bin") == (1<<20) + 8
+  with open(dst+os.sep+"image.bin", "rb") as fid: assert fid.read() == new
+  assert os.path.getmtime(dst+os.sep+"image.bin") == 2e9
+
+  # the previous version is kept in BAK, whether it could be cloned or not
+  with open(src+os.sep+"image.bin", "wb") as fid: fid.write(old)
+  os.utime(src+os.sep+"image.bin", (3e9, 3e9))
+  fsync.sync_directory(src, dst, bak, delta_threshold=1<<20)
+  with open(dst+os.sep+"image.bin", "rb") as fid: assert fid.read() == old
+  versions = [obj for obj in os.listdir(bak) if obj.startswith("image")]
+  with open(bak+os.sep+versions[0], "rb") as fid: assert fid.read() == new
+
+def test_compare_hash():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Data Source"
+  dst = "examples"+os.sep+"external"+os.sep+"Data"
+  bak = "examples"+os.sep+"external"+os.sep+".Data"
+  cache = dst+"_fsync.hashes"
+  fsync.sync_directory(src, dst, bak, compare="hash", hash_cache=cache)
+
+  # touched files only get their metadata updated
+  os.utime(src+os.sep+"file0.dat", (2e9, 2e9))
+  log = futil.LogBuffer()
+  fsync.sync_directory(src, dst, bak, compare="hash", hash_cache=cache, logger=log)
+  assert " (touched) 'file0.dat' updating metadata in DST" in [msg for _, msg in log.records]
+  assert os.path.getmtime(dst+os.sep+"file0.dat") == 2e9
+  assert os.listdir(bak) == []
+
+  # changed content is detected even if SRC is older
+  with open(src+os.sep+"file1.dat", "w") as fid: fid.write("this is version 9\n")
+  os.utime(src+os.sep+"file1.dat", (1e9, 1e9))
+  fsync.sync_directory(src, dst, bak, compare="hash", hash_cache=cache)
+  with open(dst+os.sep+"file1.dat") as fid: assert fid.read() == "this is version 9\n"
+  assert len(os.listdir(bak)) == 1
+  os.remove(cache)
+
+def test_bak_index():
+  reset()
+  bak = "examples"+os.sep+"external"+os.sep+".Data"
+  futil.mkdirtree(bak+os.sep+"sub")
+  for timesig in ["2022-01-01_000000", "2022-01-02_000000", "2022-01-03_000000"]:
+    for name in ["a__fsync_"+timesig+"__.txt", "ab__fsync_"+timesig+"__.txt"]:
+      with open(bak+os.sep+"sub"+os.sep+name, "w") as fid: pass
+  index = fsync.bak_index(bak)
+  file = "sub"+os.sep+"a.txt"
+  assert len(index.versions(file)) == 3
+  index.prune(file, 1)
+  assert index.versions(file) == [bak+os.sep+"sub"+os.sep+"a__fsync_2022-01-03_000000__.txt"]
+  assert len(index.versions("sub"+os.sep+"ab.txt")) == 3
+  assert len(os.listdir(bak+os.sep+"sub")) == 4
+  new = index.add(file, "2022-01-04_000000")
+  assert index.versions(file)[-1] == new
+
+def test_bak_pack():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  dst = "examples"+os.sep+"external"+os.sep+"Projects"
+  bak = "examples"+os.sep+"external"+os.sep+".Projects"
+  big = "Project0"+os.sep+"big.dat"
+  with open(src+os.sep+big, "wb") as fid: fid.write(bytes(1000))
+  fsync.sync_directory(src, dst, bak)
+  files = futil.relDirsFiles(src)[1]
+  timesig = fsync.TIMESIG
+  for i in range(1, 4):
+    fsync.TIMESIG = "2030-01-0%i_000000" % i
+    update_files(i)
+    for file in files: os.utime(src+os.sep+file, (2e9+10*i, 2e9+10*i))
+    fsync.sync_directory(src, dst, bak, num_bak=2, bak_pack=100, bak_compression="gz")
+  fsync.TIMESIG = timesig
+
+  # the oldest archive is removed once all of its versions are pruned
+  assert sorted(obj for obj in os.listdir(bak) if obj.startswith("__fsync_pack_")) == \
+    ["__fsync_pack_2030-01-02_000000.tar.gz", "__fsync_pack_2030-01-03_000000.tar.gz"]
+  index = fsync.bak_index(bak)
+  assert all(len(index.versions(file)) == 2 for file in files)
+  assert all(os.path.isfile(v) for v in index.versions(big))
+  file = [file for file in files if file != big][0]
+  index.restore(file, "2030-01-02_000000", dst+os.sep+"restored.txt")
+  with open(dst+os.sep+"restored.txt") as fid: assert fid.read() == "this is version 1\n"
+
+def test_bak_dedup():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  bak = "examples"+os.sep+"external"+os.sep+".Projects"
+  files = futil.relDirsFiles(src)[1]
+  timesig = fsync.TIMESIG
+  for i, version in enumerate([0, 1, 0, 1]):
+    projects = fsync.job("projects", src, "examples"+os.sep+"external"+os.sep+"Projects",
+                         bak, num_bak=2, bak_dedup=True)
+    fsync.TIMESIG = "2030-01-0%i_000000" % (i+1)
+    update_files(version)
+    for file in files: os.utime(src+os.sep+file, (2e9+10*i, 2e9+10*i))
+    projects.sync_individual()
+  fsync.TIMESIG = timesig
+
+  # identical versions of all projects share one object per content
+  store = fsync.object_store(projects.store_path())
+  assert sorted(store.refs().values()) == [len(files), len(files)]
+  assert len(os.listdir(projects.store_path())) == 3
+  file = "Project0"+os.sep+"Data"+os.sep+"file1.dat"
+  restored = "examples"+os.sep+"external"+os.sep+"restored.dat"
+  fsync.bak_index(bak+os.sep+"Project0").restore(file[9:], "2030-01-03_000000", restored)
+  with open(restored) as fid: assert fid.read() == "this is version 1\n"
+
+  # the counts always match the recorded versions, also when a version is replaced
+  index = fsync.bak_index(bak+os.sep+"Project0", store=projects.store_path())
+  index.dedup(file[9:], src+os.sep+"file0.dat", "2030-01-04_000000")
+  index.close()
+  recorded = {}
+  for folder, _, names in os.walk(bak):
+    if "__fsync_bak.db" not in names: continue
+    db = sqlite3.connect(folder+os.sep+"__fsync_bak.db")
+    for digest, in db.execute("SELECT digest FROM versions WHERE digest IS NOT NULL"): 
+      recorded[digest] = recorded.get(digest, 0)+1
+    db.close()
+  assert store.refs() == recorded
+
+def test_fanout():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  dsts = ["examples"+os.sep+"external"+os.sep+name for name in ["Projects", "Mirror"]]
+  baks = ["examples"+os.sep+"external"+os.sep+name for name in [".Projects", ".Mirror"]]
+  files = futil.relDirsFiles(src)[1]
+  fsync.sync_directory(src, dsts[0], baks[0])
+
+  # every file is read once, although the new mirror needs all of them
+  update_files(1)
+  for file in files[1:]: os.utime(src+os.sep+file, (2e9, 2e9))
+  reads = []
+  copyfiles = futil.copyfiles
+  futil.copyfiles = lambda source, dests, **kw: reads.append(source) or copyfiles(source, dests, **kw)
+  try: reports = fsync.sync_directory(src, dsts, baks, workers=2)
+  finally: futil.copyfiles = copyfiles
+  assert sorted(reads) == sorted(src+os.sep+file for file in files)
+  assert [report["counts"]["changed"] for report in reports] == [len(files)-1, 0]
+  assert [report["counts"]["new"] for report in reports] == [0, len(files)]
+  for dst in dsts:
+    assert futil.relDirsFiles(src) == futil.relDirsFiles(dst)
+    for file in files[1:]:
+      with open(dst+os.sep+file) as fid: assert fid.read() == "this is version 1\n"
+  assert len(fsync.bak_index(baks[0]).versions(files[1])) == 1
+
+  # a destination that fails does not stop the others
+  update_files(2)
+  for file in files: os.utime(src+os.sep+file, (3e9, 3e9))
+  def full(copy):
+    def copy_or_fail(source, dest, **kw):
+      if dsts[1] in str(dest): raise OSError(errno.ENOSPC, "No space left on device")
+      return(copy(source, dest, **kw))
+    return(copy_or_fail)
+  copyfile = futil.copyfile
+  futil.copyfiles, futil.copyfile = full(copyfiles), full(copyfile)
+  try: reports = fsync.sync_directory(src, dsts, baks, workers=2)
+  finally: futil.copyfiles, futil.copyfile = copyfiles, copyfile
+  assert reports[0]["ok"] and not reports[1]["ok"]
+  assert "No space" in reports[1]["error"]
+  assert [report["counts"]["changed"] for report in reports] == [len(files), 0]
+  for file in files:
+    with open(dsts[0]+os.sep+file) as fid: assert fid.read() == "this is version 2\n"
+
+  # a file replaced by a folder is moved to BAK first, a destination without
+  # BAK keeps the file and fails, while the other destination is synchronized
+  os.remove(src+os.sep+"Project0"+os.sep+"file0.dat")
+  os.makedirs(src+os.sep+"Project0"+os.sep+"file0.dat")
+  with open(src+os.sep+"Project0"+os.sep+"file0.dat"+os.sep+"y", "w") as fid: fid.write("y")
+  with open(dsts[1]+os.sep+"Project0"+os.sep+"file0.dat", "w") as fid: fid.write("old")
+  reports = fsync.sync_fanout(src, dsts, [baks[0], None], sync_deleted=True, workers=2)
+  assert reports[0]["ok"] and not reports[1]["ok"]
+  assert futil.relDirsFiles(src)[1] == futil.relDirsFiles(dsts[0])[1]
+  assert os.path.isfile(baks[0]+os.sep+"Project0"+os.sep+"file0.dat")
+  assert os.path.isfile(dsts[1]+os.sep+"Project0"+os.sep+"file0.dat")
+
+def test_job_targets():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  dst = "examples"+os.sep+"external"+os.sep+"Projects"
+  mirror = "examples"+os.sep+"external"+os.sep+"Mirror"
+  job = fsync.job("targets", src, dst, targets=[(mirror, None)])
+  reports = job.sync_directory()
+  assert [report["ok"] for report in reports] == [True, True]
+  assert futil.relDirsFiles(src) == futil.relDirsFiles(mirror)
+
+  # the other methods and options would leave the further targets behind
+  for method in [job.sync_individual, job.watch, job.audit, job.sync_snapshot]:
+    try: method(); assert False
+    except ValueError as err: assert "targets" in str(err)
+  job.manifest = True
+  try: job.sync_directory(); assert False
+  except ValueError as err: assert "manifest" in str(err)
+
+def test_renames():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  dst = "examples"+os.sep+"external"+os.sep+"Projects"
+  bak = "examples"+os.sep+"external"+os.sep+".Projects"
+  fsync.sync_directory(src, dst, bak)
+  files = futil.relDirsFiles(src+os.sep+"Project1")[1]
+
+  # a renamed project is linked in DST, where its old path remains
+  os.rename(src+os.sep+"Project1", src+os.sep+"Renamed")
+  report = fsync.sync_directory(src, dst, bak, renames=True)
+  assert report["counts"]["renamed"] == len(files) and report["counts"]["new"] == 0
+  for file in files:
+    assert os.path.samefile(dst+os.sep+"Project1"+os.sep+file, dst+os.sep+"Renamed"+os.sep+file)
+
+  # with sync_deleted, it is moved instead of backing up the old path, and files
+  # cached under their old SRC path with the same inode are not read again
+  cache = dst+"_fsync.hashes"
+  fsync.sync_directory(src, dst, bak, compare="hash", hash_cache=cache)
+  os.rename(src+os.sep+"Renamed", src+os.sep+"Moved")
+  reads = []
+  hashfile = futil.hashfile
+  futil.hashfile = lambda filename, *args: reads.append(filename) or hashfile(filename, *args)
+  try: 
+    report = fsync.sync_directory(src, dst, bak, sync_deleted=True, renames=True, 
+                                  compare="hash", hash_cache=cache)
+  finally: futil.hashfile = hashfile
+  assert reads == []
+  assert report["counts"]["renamed"] == len(files) and report["counts"]["new"] == 0
+  assert report["counts"]["deleted"] == len(files)
+  assert futil.relDirsFiles(src)[1] == futil.relDirsFiles(dst)[1]
+
+  # files sharing only their size and modification time are copied
+  os.remove(src+os.sep+"file0.dat")
+  with open(src+os.sep+"other.dat", "w") as fid: fid.write("this is version X\n")
+  os.utime(src+os.sep+"other.dat", ns=(0, os.stat(dst+os.sep+"file0.dat").st_mtime_ns))
+  report = fsync.sync_directory(src, dst, bak, sync_deleted=True, renames=True)
+  assert (report["counts"]["renamed"], report["counts"]["new"]) == (0, 1)
+  with open(dst+os.sep+"other.dat") as fid: assert fid.read() == "this is version X\n"
+
+def test_checksums():
+  reset()
+  projects = fsync.job("projects", "examples"+os.sep+"local"+os.sep+"Projects",
+                       "examples"+os.sep+"external"+os.sep+"Projects",
+                       checksums=True, verify_sample=1.)
+  projects.sync_directory()
+  files = futil.relDirsFiles(projects.SRC)[1]
+  cache = futil.HashCache(projects.DST+"_fsync.hashes")
+  for file in files:
+    assert cache.cached(projects.DST+os.sep+file) == futil.hashfile(projects.SRC+os.sep+file)
+  cache.close()
+  assert projects.audit() == dict(checked=len(files), unknown=0, corrupt=[])
+
+  # silent corruption keeps the size and modification time of the file
+  corrupt = projects.DST+os.sep+files[0]
+  stat = os.stat(corrupt)
+  with open(corrupt, "r+") as fid: fid.write("THIS")
+  os.utime(corrupt, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+  assert projects.audit()["corrupt"] == [files[0]]
+
+def test_tree_cache():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  dst = "examples"+os.sep+"external"+os.sep+"Projects"
+  bak = "examples"+os.sep+"external"+os.sep+".Projects"
+  tree = dst+"_fsync.tree"
+  fsync.sync_directory(src, dst, bak, tree_cache=tree)
+  summary = futil.TreeSummary(tree)
+  assert summary.unchanged(src) == {"Project0", "Project1", "Project_old"}
+
+  # only the subtree with a new file is scanned, the others are not deleted
+  with open(src+os.sep+"Project1"+os.sep+"Data"+os.sep+"new.dat", "w") as fid: fid.write("new\n")
+  assert summary.unchanged(src) == {"Project0", "Project_old"}
+  summary.close()
+  report = fsync.sync_directory(src, dst, bak, sync_deleted=True, tree_cache=tree)
+  assert report["counts"]["new"] == 1 and report["counts"]["deleted"] == 0
+  assert futil.relDirsFiles(src) == futil.relDirsFiles(dst)
+
+  # files modified in place are found as well
+  file = "Project0"+os.sep+"Data"+os.sep+"file0.dat"
+  with open(src+os.sep+file, "a") as fid: fid.write("appended\n")
+  os.utime(src+os.sep+file, (2e9, 2e9))
+  summary = futil.TreeSummary(tree)
+  assert summary.unchanged(src) == {"Project1", "Project_old"}
+  summary.close()
+  assert fsync.sync_directory(src, dst, bak, tree_cache=tree)["counts"]["changed"] == 1
+  with open(dst+os.sep+file) as fid: assert fid.read() == "this is version 0\nappended\n"
+
+  # files included by relaxed filters are synced, although their subtree is unchanged
+  excluded = dst+os.sep+"Project_old"+os.sep+"file1.dat"
+  os.remove(excluded)
+  fsync.sync_directory(src, dst, bak, tree_cache=tree, filters=["file1.dat"])
+  assert not os.path.isfile(excluded)
+  fsync.sync_directory(src, dst, bak, tree_cache=tree, filters=["file1.txt"])
+  assert os.path.isfile(excluded)
+
+  # excluded entries are neither walked nor part of the summaries
+  rules = futil.Filter(["Data/"])
+  summary = futil.TreeSummary(tree)
+  summary.unchanged(src, rules.key(), rules)
+  summary.commit()
+  assert "Project1"+os.sep+"Data" not in summary.updates
+  with open(src+os.sep+"Project1"+os.sep+"Data"+os.sep+"other.dat", "w") as fid: fid.write("x\n")
+  assert summary.unchanged(src, rules.key(), rules) == {"Project0", "Project1", "Project_old"}
+  summary.close()
+
+def test_filters():
+  rules = futil.Filter(["node_modules", "build/", "*.log", "!keep.log", "/top.txt",
+                        "docs/**/*.tmp", "size>1k", "!big/**"])
+  assert rules.excluded("a"+os.sep+"node_modules", True)
+  assert rules.excluded("a"+os.sep+"node_modules"+os.sep+"x.js")
+  assert rules.excluded("build", True) and not rules.excluded("build")
+  assert rules.excluded("a"+os.sep+"b.log") and not rules.excluded("a"+os.sep+"keep.log")
+  assert rules.excluded("top.txt") and not rules.excluded("a"+os.sep+"top.txt")
+  assert not rules.subtree("a").excluded("top.txt")
+  assert rules.subtree("docs").excluded("a"+os.sep+"b.tmp")
+  assert rules.excluded("docs"+os.sep+"a"+os.sep+"b.tmp") and rules.excluded("docs"+os.sep+"b.tmp")
+  big = futil.Entry("a.bin", 2000, 0, 0, False)
+  assert rules.excluded("a.bin", False, big) and not rules.excluded("big"+os.sep+"a.bin", False, big)
+
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  dst = "examples"+os.sep+"external"+os.sep+"Projects"
+  modules = src+os.sep+"Project0"+os.sep+"node_modules"
+  os.makedirs(modules)
+  for name in [modules+os.sep+"lib.js", src+os.sep+"Project1"+os.sep+"debug.log"]:
+    with open(name, "w") as fid: fid.write("excluded\n")
+  with open(src+os.sep+"Project1"+os.sep+"large.dat", "wb") as fid: fid.write(bytes(2000))
+  filter_file = "examples"+os.sep+"external"+os.sep+"filters.txt"
+  with open(filter_file, "w") as fid: fid.write("# build artefacts\nnode_modules/\nsize>1k\n")
+
+  # excluded subtrees are not walked, and excluded files in DST are kept
+  assert not any("node_modules" in e.path for e in futil.scanTree(src, filter=futil.Filter(["node_modules/"])))
+  os.makedirs(dst+os.sep+"Project1")
+  with open(dst+os.sep+"Project1"+os.sep+"old.log", "w") as fid: fid.write("kept\n")
+  projects = fsync.job("projects", src, dst, "examples"+os.sep+"external"+os.sep+".Projects",
+                       sync_deleted=True, filters=["*.log", "Project_old/", "/file0.dat", 
+                                                   "/Project1/Data/"], filter_file=filter_file)
+  summary = projects.sync_individual()
+  assert sorted(summary) == [".", "Project0", "Project1"]
+  # anchored rules are relative to SRC in every project, as with sync_directory()
+  expected = [file for file in futil.relDirsFiles(src)[1]
+              if ("node_modules" not in file) and not file.endswith((".log", "large.dat"))
+              and not file.startswith(("Project_old", "Project1"+os.sep+"Data"))
+              and (file != "file0.dat")]
+  assert sorted(futil.relDirsFiles(dst)[1]) == sorted(expected+["Project1"+os.sep+"old.log"])
+
+def test_scheduler():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Data Source"+os.sep+"image.bin"
+  dst = "examples"+os.sep+"external"+os.sep+"image.bin"
+  with open(src, "wb") as fid: fid.write(os.urandom(3<<20))
+
+  # the first second is a burst, the remaining MB takes half a second
+  scheduler = futil.Scheduler(max_bytes_per_sec=2<<20)
+  start = time.perf_counter()
+  list(futil.runTasks([lambda logger: futil.copyfile(src, dst, logger)], scheduler))
+  assert time.perf_counter()-start > 0.4
+  assert scheduler.bytes_done == 3<<20
+
+  # results keep their order, and the concurrency climbs while it pays off
+  scheduler = futil.Scheduler(8, 1, interval=0.)
+  active = []
+  tasks = [lambda logger, i=i: futil._charge(i) or active.append(scheduler.active) 
+           or sleep(0.01) or i for i in range(40)]
+  assert list(futil.runTasks(tasks, scheduler)) == list(range(40))
+  assert 1 < max(active) <= 8
+
+  report = fsync.sync_directory("examples"+os.sep+"local"+os.sep+"Projects",
+                                "examples"+os.sep+"external"+os.sep+"Projects",
+                                workers="auto", max_ops_per_sec=100)
+  assert report["ok"] and (report["counts"]["new"] > 0)
+
+def test_copydata():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Data Source"+os.sep+"image.bin"
+  dst = "examples"+os.sep+"external"+os.sep+"image.bin"
+  data = os.urandom((9<<20)+1)
+  with open(src, "wb") as fid: fid.write(data)
+  os.utime(src, (2e9, 2e9))
+
+  # every method available here produces an identical copy
+  for method in futil.COPY_METHODS[1:]:
+    if not futil._available(method): continue
+    with open(src, "rb") as s, open(dst, "wb") as d: 
+      futil._copydata(s, d, len(data), method)
+    with open(dst, "rb") as fid: assert fid.read() == data
+
+  method, size = futil.copydata(src, dst)
+  assert (method in futil.COPY_METHODS) and (size == len(data))
+  assert futil.copyfile(src, dst) == len(data)
+  with open(dst, "rb") as fid: assert fid.read() == data
+  assert os.path.getmtime(dst) == 2e9
+
+def test_snapshots():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Data Source"
+  snap = "examples"+os.sep+"external"+os.sep+"Snapshots"
+  timesigs = ["2022-01-0"+str(i)+"_000000" for i in range(1,4)]
+  timesig = fsync.TIMESIG
+  try:
+    for i, snapshot in enumerate(timesigs):
+      fsync.TIMESIG = snapshot
+      if i == 2: 
+        with open(src+os.sep+"file0.dat", "w") as fid: fid.write("this is version 2\n")
+      fsync.sync_snapshot(src, snap, num_snapshots=2)
+  finally: fsync.TIMESIG = timesig
+  assert sorted(os.listdir(snap)) == timesigs[1:]
+
+  old, new = snap+os.sep+timesigs[1], snap+os.sep+timesigs[2]
+  file = "Folder0"+os.sep+"file1.dat"
+  assert os.stat(old+os.sep+file).st_ino == os.stat(new+os.sep+file).st_ino
+  assert os.stat(old+os.sep+"file0.dat").st_ino != os.stat(new+os.sep+"file0.dat").st_ino
+  with open(new+os.sep+"file0.dat") as fid: assert fid.read() == "this is version 2\n"
+
+  # each snapshot of a job gets its own time signature
+  snapshots = fsync.job("snapshots", src, snap)
+  snapshots.BAK = None
+  snapshots.num_bak = 4
+  snapshots.sync_snapshot()
+  sleep(1)
+  snapshots.sync_snapshot()
+  assert len(os.listdir(snap)) == 4
+
+def test_watch():
+  reset()
+  data = fsync.job("data", "examples"+os.sep+"local"+os.sep+"Data Source",
+                   "examples"+os.sep+"external"+os.sep+"Data",
+                   "examples"+os.sep+"external"+os.sep+".Data", sync_deleted=True)
+  def change():
+    sleep(1.5)
+    with open(data.SRC+os.sep+"file0.dat", "w") as fid: fid.write("this is version 1\n")
+    futil.mkdirtree(data.SRC+os.sep+"Folder2")
+    with open(data.SRC+os.sep+"Folder2"+os.sep+"new.dat", "w") as fid: fid.write("new\n")
+    os.remove(data.SRC+os.sep+"Folder1"+os.sep+"file1.dat")
+  import threading
+  thread = threading.Thread(target=change)
+  thread.start()
+  data.watch(interval=0.2, debounce=0.5, duration=3.5)
+  thread.join()
+  with open(data.DST+os.sep+"file0.dat") as fid: assert fid.read() == "this is version 1\n"
+  assert os.path.isfile(data.DST+os.sep+"Folder2"+os.sep+"new.dat")
+  assert not os.path.isfile(data.DST+os.sep+"Folder1"+os.sep+"file1.dat")
+  assert os.path.isfile(data.BAK+os.sep+"Folder1"+os.sep+"file1.dat")
+  assert len(os.listdir(data.BAK)) == 2
+
+  # a failing sync is followed by a full reconcile instead of ending the watch
+  def change_twice():
+    for i in range(2):
+      sleep(1)
+      with open(data.SRC+os.sep+"file"+str(i)+".dat", "w") as fid: fid.write("this is version 2\n")
+  sync_paths = fsync.sync_paths
+  def vanished(*args, **kwargs):
+    fsync.sync_paths = sync_paths
+    raise FileNotFoundError("vanished")
+  fsync.sync_paths = vanished
+  thread = threading.Thread(target=change_twice)
+  thread.start()
+  try: data.watch(interval=0.2, debounce=0.3, duration=3.5)
+  finally: fsync.sync_paths = sync_paths
+  thread.join()
+  for i in range(2):
+    with open(data.DST+os.sep+"file"+str(i)+".dat") as fid: assert fid.read() == "this is version 2\n"
+
+def test_poll_watcher():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Data Source"
+  watcher = futil.PollWatcher(src)
+  with open(src+os.sep+"file2.dat", "w") as fid: pass
+  os.remove(src+os.sep+"file0.dat")
+  assert watcher.read(0) == {"file0.dat", "file2.dat"}
+
+def test_report():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  dst = "examples"+os.sep+"external"+os.sep+"Projects"
+  bak = "examples"+os.sep+"external"+os.sep+".Projects"
+  n = len(futil.relDirsFiles(src)[1])
+  phases = []
+  report = fsync.sync_directory(src, dst, bak, progress=lambda r: phases.append(r["phase"]))
+  assert report["counts"]["new"] == report["files_total"] == report["files_done"] == n
+  assert report["bytes_copied"] == n*len("this is version 0\n")
+  assert phases == ["scan_src", "scan_dst", "diff", "mkdirtree"]+(n+1)*["transfer"]
+
+  update_files(1)
+  for file in futil.relDirsFiles(src)[1]: os.utime(src+os.sep+file, (2e9, 2e9))
+  report = fsync.sync_directory(src, dst, bak, workers=2)
+  assert report["counts"] == dict(new=0, changed=n, touched=0, unchanged=0, deleted=0, 
+                                 renamed=0)
+  assert report["phases"]["bak_rotation"] > 0
+  assert report["wall_time"] >= report["phases"]["transfer"]
+
+def test_resume():
+  reset()
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  dst = "examples"+os.sep+"external"+os.sep+"Projects"
+  bak = "examples"+os.sep+"external"+os.sep+".Projects"
+  journal = dst+"_fsync.journal"
+  fsync.sync_directory(src, dst, bak)
+  update_files(1)
+  files = futil.relDirsFiles(src)[1]
+  for file in files: os.utime(src+os.sep+file, (2e9, 2e9))
+  halt = Event()
+  def cancel(report):
+    if report["files_done"] == 3: halt.set()
+  report = fsync.sync_directory(src, dst, bak, journal=journal, halt=halt, progress=cancel)
+  assert (report["ok"], report["error"], report["files_done"]) == (False, "cancelled", 3)
+
+  # the next run only finishes the remaining files without scanning again
+  report = fsync.sync_directory(src, dst, bak, journal=journal, workers=2)
+  assert report["ok"] and (report["counts"]["changed"] == len(files)-3)
+  assert report["phases"]["scan_src"] == 0
+  for file in files:
+    with open(dst+os.sep+file) as fid: assert fid.read() == "this is version 1\n"
+    assert len(fsync.bak_index(bak).versions(file)) == 1
+  assert not any(file.endswith(futil.TMP_SUFFIX) for file in futil.relDirsFiles(dst)[1])
+  assert fsync.transfer_journal(journal, dst).pending() is None
+  os.remove(journal)
+
+  # temporary files of killed copies are neither synced nor moved to BAK
+  for file in files[:2]: 
+    with open(futil.tempname(dst+os.sep+file), "w") as fid: fid.write("partial")
+  os.remove(src+os.sep+files[0])
+  os.utime(src+os.sep+files[1], (3e9, 3e9))
+  report = fsync.sync_directory(src, dst, bak, sync_deleted=True)
+  assert (report["counts"]["deleted"], report["counts"]["changed"]) == (1, 1)
+  assert not any(file.endswith(futil.TMP_SUFFIX) for file in futil.relDirsFiles(dst)[1])
+  assert not any(file.endswith(futil.TMP_SUFFIX) for file in futil.relDirsFiles(bak)[1])
+
+class SlowIO(futil.AsyncIO):
+  # stand-in for a network mount, where every call waits for a round trip
+  latency = 0.05
+  calls = 0
+
+  async def run(self, func, *args, **kwargs):
+    def slow(*args, **kwargs):
+      sleep(self.latency)
+      return(func(*args, **kwargs))
+    self.calls += 1
+    return(await super().run(slow, *args, **kwargs))
+
+def test_async():
+  src = "examples"+os.sep+"local"+os.sep+"Projects"
+  dst = "examples"+os.sep+"external"+os.sep+"Projects"
+  bak = "examples"+os.sep+"external"+os.sep+".Projects"
+  logs = []; counts = []
+  for mode in ["sync", "async"]:
+    reset()
+    fsync.sync_directory(src, dst, bak)
+    update_files(1)
+    for file in futil.relDirsFiles(src)[1]: os.utime(src+os.sep+file, (2e9, 2e9))
+    log = futil.LogBuffer()
+    if mode == "sync": report = fsync.sync_directory(src, dst, bak, logger=log)
+    else:
+      aio = SlowIO(16)
+      start = time.perf_counter()
+      report = asyncio.run(fsync.sync_directory_async(src, dst, bak, logger=log, aio=aio))
+      aio.close()
+      assert time.perf_counter()-start < 0.5*aio.calls*aio.latency
+    logs.append([msg for _, msg in log.records])
+    counts.append(report["counts"])
+    for file in futil.relDirsFiles(src)[1]:
+      with open(dst+os.sep+file) as fid: assert fid.read() == "this is version 1\n"
+  assert logs[0] == logs[1]
+  assert counts[0] == counts[1]